@@ -0,0 +1,52 @@
+"""
+datastore 讀寫: marshmallow schema 與 trusted codec 比較
+
+產生約 --size MB 的 datastore 檔案，分別量測 json 解析之後以 schema / codec 建立用戶物件，
+以及用戶物件輸出為 json 的時間
+
+    PYTHONPATH=src python benchmarks/bench_codec.py [--size 50] [--repeat 3]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+from switchbot.domain import model
+from switchbot.adapters import codec
+from bench_schema import _make_user_data, _best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=float, default=50, help='datastore size in MB')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    user_size = len(json.dumps(_make_user_data(0), indent=2, ensure_ascii=False).encode())
+    users = model.SwitchBotUserRepo.load_many(
+        [_make_user_data(n) for n in range(int(args.size * 1024 * 1024 / user_size))])
+    with tempfile.TemporaryDirectory() as tmp:
+        file = os.path.join(tmp, '.datastore')
+        with open(file, 'w', encoding='utf-8') as fh:
+            fh.write(json.dumps(codec.dump_users(users), indent=2, ensure_ascii=False))
+        print(f'{len(users)} users, {os.path.getsize(file) / 1024 / 1024:.1f} MB, best of {args.repeat}')
+
+        def _read():
+            with open(file, encoding='utf-8') as fh:
+                return json.loads(fh.read())
+
+        content = _read()
+        cases = [
+            ('json parse', _read),
+            ('load schema', lambda: model.SwitchBotUserRepo.load_many(content)),
+            ('load codec', lambda: codec.load_users(content)),
+            ('dump schema', lambda: model.SwitchBotUserRepo.dump_many(users)),
+            ('dump codec', lambda: codec.dump_users(users)),
+        ]
+        for name, fn in cases:
+            elapsed = _best(fn, args.repeat)
+            print(f'{name:<12} {elapsed:8.3f}s {len(users) / elapsed:10.0f} users/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+datastore 用戶資料 load/dump throughput
+
+before: 每次 load/dump 建立新的 schema (nested 欄位為 List(Nested(...)))，逐一處理用戶
+after: module 層級 schema singleton，SwitchBotUserRepo.load_many/dump_many 一次處理
+
+    PYTHONPATH=src python benchmarks/bench_schema.py [--users 10000] [--repeat 3]
+"""
+import argparse
+import time
+from marshmallow import fields
+from switchbot.domain import model
+from switchbot.adapters.iot_api_server import FakeApiServer
+
+
+class _LegacyUserRepoSchema(model.SwitchBotUserRepoSchema):
+    devices = fields.List(fields.Nested(model.SwitchBotDeviceSchema()))
+    states = fields.List(fields.Nested(model.SwitchBotStatusSchema()))
+    changes = fields.List(fields.Nested(model.SwitchBotChangeReportSchema()))
+
+
+def _make_user_data(n: int) -> dict:
+    return {
+        'userId': f'uid-{n}',
+        'userSecret': f'secret-{n}',
+        'userToken': f'token-{n}',
+        'devices': [dict(d, deviceId=f"{d['deviceId']}-{n}") for d in FakeApiServer.jsonDevices],
+        'states': [dict(s, deviceId=f"{s['deviceId']}-{n}") for s in FakeApiServer.jsonStates],
+        'changes': [{
+            'eventType': 'changeReport', 'eventVersion': '1',
+            'context': {'deviceType': 'WoPlugUS', 'deviceMac': f'6055F92FCFD2-{n}', 'powerState': 'ON',
+                        'timeOfSample': 1698720698088 + i}
+        } for i in range(3)],
+        'scenes': [],
+        'webhooks': [],
+        'subscribers': ['aog'],
+    }
+
+
+def _best(fn, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    content = [_make_user_data(n) for n in range(args.users)]
+    users = model.SwitchBotUserRepo.load_many(content)
+    cases = [
+        ('load before', lambda: [_LegacyUserRepoSchema().load(data) for data in content]),
+        ('load after', lambda: model.SwitchBotUserRepo.load_many(content)),
+        ('dump before', lambda: [_LegacyUserRepoSchema().dump(u) for u in users]),
+        ('dump after', lambda: model.SwitchBotUserRepo.dump_many(users)),
+    ]
+    print(f'{args.users} users, best of {args.repeat}')
+    for name, fn in cases:
+        elapsed = _best(fn, args.repeat)
+        print(f'{name:<12} {elapsed:8.3f}s {args.users / elapsed:10.0f} users/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""
+datastore snapshot 格式比較: pretty-printed JSON 與 length-prefixed binary record
+
+binary record 內容是 compact JSON，檔案較小、寫入較快 (10 MB JSON datastore: 7.1 MB, write 0.38s -> 0.12s)，
+但讀取逐筆 json.loads，比單一 JSON 檔稍慢 (read 0.12s -> 0.13s)
+
+    PYTHONPATH=src python benchmarks/bench_snapshot.py [--size 50] [--repeat 3]
+"""
+import argparse
+import json
+import os
+import tempfile
+from switchbot.adapters import file_datastore
+from bench_schema import _make_user_data, _best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=float, default=50, help='JSON datastore size in MB')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    user_size = len(json.dumps(_make_user_data(0), indent=2, ensure_ascii=False).encode())
+    content = [_make_user_data(n) for n in range(int(args.size * 1024 * 1024 / user_size))]
+    print(f'{len(content)} users, best of {args.repeat}')
+    with tempfile.TemporaryDirectory() as tmp:
+        for snapshot_format in file_datastore.SNAPSHOT_FORMATS:
+            file = os.path.join(tmp, f'.datastore.{snapshot_format}')
+            write = _best(lambda: file_datastore.atomic_write(
+                file, file_datastore.encode_snapshot(content, snapshot_format)), args.repeat)
+            read = _best(lambda: file_datastore.read_snapshot(file), args.repeat)
+            print(f'{snapshot_format:<8} {os.path.getsize(file) / 1024 / 1024:7.1f} MB'
+                  f'  write {write:7.3f}s  read {read:7.3f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -32,28 +32,63 @@ class SyncIotApi(AbstractIotApi):
 
 
 class AsyncIotApi(AbstractIotApi):
+    """
+    長期共用一個 aiohttp.ClientSession (第一次使用時在當下 event loop 建立)，
+    以 limit/limit_per_host 限制同時連線數，回傳 response json
+    """
+    def __init__(self, limit: int = 100, limit_per_host: int = 10, timeout: float = 10):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self._session = None  # type: aiohttp.ClientSession
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self._session
+
     async def get(self, url, **kwargs):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, **kwargs) as response:
-                return await response.text()
+        async with self.session.get(url, **kwargs) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
 
     async def post(self, url, data=None, **kwargs):
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, data=data, **kwargs) as response:
-                return await response.text()
+        async with self.session.post(url, data=data, **kwargs) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
 
 
 if __name__ == '__main__':
     config_use_async = True  # 或從設定檔載入
     client = AsyncIotApi() if config_use_async else SyncIotApi()
 
+    # get 回傳 response json，需使用回傳 JSON 的 endpoint
+    url = 'http://httpbin.org/get'
+
     # 使用同步客戶端
     if not config_use_async:
-        response = client.get('http://example.com')
-        print(response.text)
+        response = client.get(url)
+        print(response.json())
 
-    # 使用非同步客戶端
+    # 使用非同步客戶端，結束時關閉共用的 session
     else:
-        loop = asyncio.get_event_loop()
-        response = loop.run_until_complete(client.get('http://example.com'))
-        print(response)
\ No newline at end of file
+        async def main():
+            async with client:
+                print(await client.get(url))
+
+        asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,110 @@
+"""
+datastore 用戶資料的 trusted codec
+
+datastore 檔案與 journal 由本系統寫入，內容已經過 schema 驗證，讀寫時不需要 marshmallow 逐欄位驗證與轉換；
+codec 依 domain schema 的欄位定義 (attribute、data_key、load_default、nested schema) 產生，
+直接以 dict 建立 / 輸出 domain 物件，輸出格式與 schema dump 相同。
+外部輸入 (SwitchBot API 回應、webhook、intent request) 仍以 marshmallow schema 驗證
+"""
+import copy
+from typing import Any, Callable, Dict, Iterable, List, Tuple, Type
+from marshmallow import Schema, fields, missing
+from switchbot.domain import model
+
+
+def _make_user_repo(data: dict) -> model.SwitchBotUserRepo:
+    data['subscribers'] = set(data['subscribers'])
+    return model.SwitchBotUserRepo(**data)
+
+
+# schema 對應的 post_load 物件建立方式
+_FACTORIES = {
+    model.SwitchBotDeviceSchema: lambda data: model.SwitchBotDevice(**data),
+    model.SwitchBotStatusSchema: lambda data: model.SwitchBotStatus(**data),
+    model.SwitchBotChangeReportSchema: lambda data: model.SwitchBotChangeReport(**data),
+    model.SwitchBotUserRepoSchema: _make_user_repo,
+}  # type: Dict[Type[Schema], Callable[[dict], Any]]
+
+_PLAIN, _LIST, _DICT, _NESTED = range(4)
+
+
+class SchemaCodec:
+    """
+    依 schema 欄位產生的 codec，load/dump 結果與 schema.load/schema.dump 相同，但不做型別驗證與轉換；
+    list/dict 欄位與 schema 一樣建立淺層複本，dump 結果不會與 domain 物件共用可變的內容
+    """
+    def __init__(self, schema: Schema, skip_dump: Callable[[str, Any], bool] = None):
+        self.factory = _FACTORIES[type(schema)]
+        self.skip_dump = skip_dump if skip_dump else lambda key, value: value is None
+        self._fields = []  # type: List[Tuple[str, str, Any, int, SchemaCodec]]
+        for name, field in schema.fields.items():
+            nested = None
+            if isinstance(field, fields.Nested):
+                kind, nested = _NESTED, SchemaCodec(field.schema)
+            elif isinstance(field, fields.List):
+                kind = _LIST
+            elif isinstance(field, fields.Dict):
+                kind = _DICT
+            else:
+                kind = _PLAIN
+            self._fields.append((field.attribute or name, field.data_key or name, field.load_default, kind, nested))
+
+    def load(self, data: dict):
+        kwargs = {}
+        for attr, key, default, kind, nested in self._fields:
+            if key in data:
+                value = data[key]
+                if value is not None:
+                    if kind == _NESTED:
+                        value = [nested.load(item) for item in value]
+                    elif kind == _LIST:
+                        value = list(value)
+                    elif kind == _DICT:
+                        value = dict(value)
+            elif default is not missing:
+                value = default() if callable(default) else copy.copy(default)
+            else:
+                continue
+            kwargs[attr] = value
+        return self.factory(kwargs)
+
+    def dump(self, obj) -> dict:
+        data = {}
+        for attr, key, _, kind, nested in self._fields:
+            value = getattr(obj, attr, None)
+            if value is not None:
+                if kind == _NESTED:
+                    value = [nested.dump(item) for item in value]
+                elif kind == _LIST:
+                    value = list(value)
+                elif kind == _DICT:
+                    value = dict(value)
+            if not self.skip_dump(key, value):
+                data[key] = value
+        return data
+
+
+_user_codec = SchemaCodec(
+    model.SwitchBotUserRepoSchema(),
+    skip_dump=lambda key, value: value is None or (key == 'version' and value == 0)
+)
+
+
+def load_user(data: dict) -> model.SwitchBotUserRepo:
+    return _user_codec.load(data)
+
+
+def dump_user(user: model.SwitchBotUserRepo) -> dict:
+    data = _user_codec.dump(user)
+    if 'subscribers' in data:
+        # 與 SwitchBotUserRepoSchema 相同，subscribers 排序後輸出
+        data['subscribers'].sort()
+    return data
+
+
+def load_users(content: Iterable[dict]) -> List[model.SwitchBotUserRepo]:
+    return [_user_codec.load(data) for data in content]
+
+
+def dump_users(users: Iterable[model.SwitchBotUserRepo]) -> List[dict]:
+    return [dump_user(u) for u in users]
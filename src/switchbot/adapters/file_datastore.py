@@ -1,8 +1,14 @@
 import os
+import stat
+import time
+import struct
 import logging
 import json
-from typing import List
+import tempfile
+import threading
+from typing import List, Dict, Set, Iterable, Optional, Tuple, Union
 from switchbot.domain import model
+from switchbot.adapters import codec
 
 logger = logging.getLogger(__name__)
 
@@ -11,82 +17,638 @@ class DatastoreSchemaError(Exception):
     pass
 
 
+_file_locks = {}  # type: Dict[str, threading.RLock]
+_file_locks_guard = threading.Lock()
+
+
+def _get_file_lock(file: str) -> threading.RLock:
+    with _file_locks_guard:
+        return _file_locks.setdefault(os.path.abspath(file), threading.RLock())
+
+
+def _fsync_dir(directory: str):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:  # platform without directory fd (windows)
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write(file: str, content: Union[str, bytes]):
+    """寫入同目錄暫存檔並 fsync 之後 rename 取代目標檔案，再 fsync 目錄，crash 時不會留下寫到一半的檔案"""
+    directory = os.path.dirname(os.path.abspath(file))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(file)}.', suffix='.tmp')
+    try:
+        with (os.fdopen(fd, 'wb') if isinstance(content, bytes) else os.fdopen(fd, 'w', encoding='utf-8')) as fh:
+            fh.write(content)
+            fh.flush()
+            os.fsync(fh.fileno())
+        if os.path.exists(file):
+            os.chmod(tmp, stat.S_IMODE(os.stat(file).st_mode))
+        os.replace(tmp, file)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    _fsync_dir(directory)
+
+
+SNAPSHOT_JSON = 'json'
+SNAPSHOT_BINARY = 'binary'
+SNAPSHOT_FORMATS = (SNAPSHOT_JSON, SNAPSHOT_BINARY)
+# binary snapshot: 檔頭之後每個用戶一筆 record，record 為 4 bytes (big-endian) 長度 + 無空白的 UTF-8 JSON；
+# record 內容仍是 JSON，只節省檔案大小與寫入時間 (不需要 indent)，讀取比單一 JSON 檔稍慢 (逐筆 json.loads)，
+# 不是為了加快啟動載入 (見 benchmarks/bench_snapshot.py)
+_BINARY_MAGIC = b'SBDS\x01'
+_RECORD_LEN = struct.Struct('>I')
+
+
+def encode_snapshot(content: List[dict], snapshot_format: str = SNAPSHOT_JSON) -> Union[str, bytes]:
+    if snapshot_format == SNAPSHOT_JSON:
+        return json.dumps(content, indent=2, ensure_ascii=False)
+    if snapshot_format == SNAPSHOT_BINARY:
+        parts = [_BINARY_MAGIC]
+        for data in content:
+            record = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            parts.append(_RECORD_LEN.pack(len(record)))
+            parts.append(record)
+        return b''.join(parts)
+    raise ValueError(f'unknown snapshot format {snapshot_format}')
+
+
+def decode_snapshot(raw: bytes) -> List[dict]:
+    """snapshot 內容依檔頭判斷為 binary 或 JSON 格式"""
+    if not raw.startswith(_BINARY_MAGIC):
+        content = json.loads(raw)
+        if not isinstance(content, list):
+            raise DatastoreSchemaError
+        return content
+    content = []
+    pos, end = len(_BINARY_MAGIC), len(raw)
+    while pos < end:
+        if pos + _RECORD_LEN.size > end:
+            raise DatastoreSchemaError(f'truncated record header at {pos}')
+        size, = _RECORD_LEN.unpack_from(raw, pos)
+        pos += _RECORD_LEN.size
+        if pos + size > end:
+            raise DatastoreSchemaError(f'truncated record at {pos}')
+        content.append(json.loads(raw[pos:pos + size]))
+        pos += size
+    return content
+
+
+def read_snapshot(file: str) -> List[dict]:
+    with open(file, 'rb') as fh:
+        return decode_snapshot(fh.read())
+
+
+def convert_snapshot(src: str, dst: str, snapshot_format: str) -> int:
+    """snapshot 檔案轉換為 snapshot_format 格式 (src 與 dst 可以相同)，回傳用戶數"""
+    content = read_snapshot(src)
+    atomic_write(dst, encode_snapshot(content, snapshot_format))
+    return len(content)
+
+
+# (uid, 原本的常駐用戶, 原本的 committed 內容)
+_Undo = Tuple[str, Optional[model.SwitchBotUserRepo], Optional[dict]]
+
+
+class _CommitBatch:
+    def __init__(self):
+        self.puts = {}  # type: Dict[str, model.SwitchBotUserRepo]
+        self.deletes = set()  # type: Set[str]
+        self.undo = []  # type: List[_Undo]
+        self.done = threading.Event()
+        self.error = None  # type: Optional[BaseException]
+
+    def merge(self, puts: List[model.SwitchBotUserRepo], deletes: List[str]):
+        for uid in deletes:
+            self.puts.pop(uid, None)
+            self.deletes.add(uid)
+        for u in puts:
+            self.deletes.discard(u.uid)
+            self.puts[u.uid] = u
+
+
+def _stat_signature(file: str) -> Optional[Tuple[int, int, int]]:
+    try:
+        st = os.stat(file)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
 class FileDatastore:
-    _users = []  # type: List['model.SwitchBotUserRepo']
+    """
+    _users 以 uid 為 key 並保留檔案中的用戶順序，另外維護兩個 hash index 讓 webhook 熱路徑不需要掃描全部用戶：
+    _secret_index: secret -> user, _dev_index: device_id -> uid
+    (_user_dev_ids 為 _dev_index 的反向索引，用於移除用戶或設備時不必掃描 _dev_index)
+    datastore 常駐於 process 之中 (見 get_datastore)，refresh() 以檔案 inode/mtime/size 判斷是否被外部修改，
+    只有在檔案被外部修改時才重新載入。
+    檔案一律以 atomic_write 寫入；group_commit_window (秒) 大於 0 時，在 window 之內到達的 write 會合併成
+    一次寫入 (group commit)，第一個 write 的 thread 等待 window 之後負責寫檔，所有 write 都在寫檔完成後才返回。
+    snapshot_format 決定寫入的檔案格式 (SNAPSHOT_JSON 或 SNAPSHOT_BINARY)，讀取時依檔頭判斷，兩種格式都可以載入。
+    常駐用戶物件會被 DatastoreSession 直接修改 (尚未 commit)，寫檔只使用 _committed 中每個用戶最後 commit 的內容，
+    其他 session 未 commit 的修改不會因為別的 commit 寫入檔案
+    """
+    _users = {}  # type: Dict[str, 'model.SwitchBotUserRepo']
+    group_commit_window = 0.0
 
-    def __init__(self, file: str):
+    def __init__(self, file: str, snapshot_format: str = SNAPSHOT_JSON):
+        if snapshot_format not in SNAPSHOT_FORMATS:
+            raise ValueError(f'unknown snapshot format {snapshot_format}')
+        self.snapshot_format = snapshot_format
         self._file = file
-        if os.path.exists(file):
-            with open(self._file, 'r') as fh:
-                content = json.loads(fh.read())
-                if not isinstance(content, list):
-                    raise DatastoreSchemaError
-            self._users = [model.SwitchBotUserRepo.load(data) for data in content]
-        else:
-            self._users = []
+        self._lock = _get_file_lock(file)
+        self._batch = None  # type: Optional[_CommitBatch]
+        self._user_locks = {}  # type: Dict[str, threading.RLock]
+        self._user_locks_guard = threading.Lock()
+        self._sessions = threading.local()
+        with self._lock:
+            self._load()
 
-    def commit(self):
+    def user_lock(self, uid: str) -> threading.RLock:
+        """用戶 lock，同一時間只有一個 DatastoreSession 可以修改該用戶"""
+        with self._user_locks_guard:
+            return self._user_locks.setdefault(uid, threading.RLock())
+
+    def _on_write(self, user: model.SwitchBotUserRepo):
+        """常駐用戶的 write hook，交給目前 thread 的 DatastoreSession 處理；不在 session 之中的修改不需要 lock"""
+        session = getattr(self._sessions, 'current', None)
+        if session is not None:
+            session.begin_write(user)
+
+    def _signature(self):
+        return _stat_signature(self._file)
+
+    def _load(self):
+        self._users = {}
+        self._committed = {}  # type: Dict[str, dict]
+        self._secret_index = {}  # type: Dict[str, model.SwitchBotUserRepo]
+        self._dev_index = {}  # type: Dict[str, str]
+        self._user_dev_ids = {}  # type: Dict[str, Set[str]]
+        self._stat = self._signature()
+        if os.path.exists(self._file):
+            for data in read_snapshot(self._file):
+                user = codec.load_user(data)
+                self._put(user)
+                self._committed[user.uid] = data
+
+    def refresh(self):
+        with self._lock:
+            if self._signature() != self._stat:
+                logger.info(f'datastore {self._file} modified externally, reload')
+                self._load()
+
+    def _put(self, user: model.SwitchBotUserRepo):
+        origin = self._users.get(user.uid)
+        if origin is not None and origin is not user:
+            self._unindex_user(origin)
+        self._users[user.uid] = user
+        user.set_write_hook(self._on_write)
+        self._secret_index[user.secret] = user
+        self.reindex_devices(user)
+
+    def _remove(self, uid: str):
+        u = self._users.pop(uid, None)
+        if u is not None:
+            self._unindex_user(u)
+        return u
+
+    def _unindex_user(self, user: model.SwitchBotUserRepo):
+        if self._secret_index.get(user.secret) is user:
+            del self._secret_index[user.secret]
+        for dev_id in self._user_dev_ids.pop(user.uid, set()):
+            if self._dev_index.get(dev_id) == user.uid:
+                del self._dev_index[dev_id]
+
+    def reindex_devices(self, user: model.SwitchBotUserRepo):
+        """refresh device_id -> uid entries after user device list changed (request_sync)"""
+        dev_ids = {d.device_id for d in user.devices}
+        for dev_id in self._user_dev_ids.get(user.uid, set()) - dev_ids:
+            if self._dev_index.get(dev_id) == user.uid:
+                del self._dev_index[dev_id]
+        for dev_id in dev_ids:
+            self._dev_index[dev_id] = user.uid
+        self._user_dev_ids[user.uid] = dev_ids
+
+    def reindex(self, users: Iterable[model.SwitchBotUserRepo]):
+        for u in users:
+            if self._users.get(u.uid) is u:
+                self.reindex_devices(u)
+
+    def _apply(self, puts: List[model.SwitchBotUserRepo], deletes: Iterable[str]):
+        """套用到常駐的用戶與 index，回傳實際刪除的 uid 與還原用的 _Undo 紀錄"""
+        undo = []  # type: List[_Undo]
+        removed = []
+        for uid in deletes:
+            u = self._remove(uid)
+            if u is not None:
+                removed.append(uid)
+                undo.append((uid, u, self._committed.pop(uid, None)))
+        for u in puts:
+            undo.append((u.uid, self._users.get(u.uid), self._committed.get(u.uid)))
+            self._put(u)
+            self._committed[u.uid] = codec.dump_user(u)
+        return removed, undo
+
+    def _revert(self, undo: List[_Undo]):
+        """寫檔失敗時還原 _apply，常駐資料與檔案內容保持一致"""
+        for uid, origin, committed in reversed(undo):
+            if origin is None:
+                self._remove(uid)
+            else:
+                self._put(origin)
+            if committed is None:
+                self._committed.pop(uid, None)
+            else:
+                self._committed[uid] = committed
+
+    def write(self, puts: List[model.SwitchBotUserRepo], deletes: Iterable[str]):
+        """apply committed users of a DatastoreSession and persist them, reverted in memory if persisting fails"""
+        with self._lock:
+            deletes, undo = self._apply(puts=puts, deletes=deletes)
+            if not self.group_commit_window:
+                try:
+                    self._persist(puts=puts, deletes=deletes)
+                except BaseException:
+                    self._revert(undo)
+                    raise
+                self._stat = self._signature()
+                return
+            leader = self._batch is None
+            if leader:
+                self._batch = _CommitBatch()
+            batch = self._batch
+            batch.merge(puts=puts, deletes=deletes)
+            batch.undo.extend(undo)
+        if leader:
+            time.sleep(self.group_commit_window)
+            self._flush_batch()
+        batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+
+    def _flush_batch(self):
+        with self._lock:
+            batch, self._batch = self._batch, None
+            try:
+                self._persist(puts=list(batch.puts.values()), deletes=list(batch.deletes))
+                self._stat = self._signature()
+            except BaseException as e:
+                logger.exception(f'datastore {self._file} group commit failed')
+                self._revert(batch.undo)
+                batch.error = e
+            finally:
+                batch.done.set()
+
+    def _persist(self, puts: List[model.SwitchBotUserRepo], deletes: List[str]):
         self._save()
 
+    def restore(self, users: List[model.SwitchBotUserRepo]):
+        """put back user snapshots of a rolled back DatastoreSession, memory only"""
+        with self._lock:
+            for u in users:
+                self._put(u)
+
+    def _commit_resident(self):
+        """直接使用 add/delete 的呼叫端 (不經過 DatastoreSession)，以目前的常駐用戶作為 commit 內容"""
+        self._committed = {uid: codec.dump_user(u) for uid, u in self._users.items()}
+
+    def commit(self):
+        with self._lock:
+            self._commit_resident()
+            self._save()
+            self._stat = self._signature()
+
     def _save(self):
-        with open(self._file, 'w') as fh:
-            content = [model.SwitchBotUserRepo.dump(u) for u in self._users]
-            fh.write(json.dumps(content, indent=2, ensure_ascii=False))
+        atomic_write(self._file, encode_snapshot(list(self._committed.values()), self.snapshot_format))
 
     def register_user(self, user: model.SwitchBotUserRepo):
-        n, u = next(((n, u) for n, u in enumerate(self._users) if u.uid == user.secret), (None, None))
+        u = self._secret_index.get(user.secret)
         if u is None:
-            self._users.append(user)
+            self.write(puts=[user], deletes=[])
         else:
             logger.warning(f'register w/ secret already exist on user {u.uid}, skip')
-            # del self._users[n]
-            # self._users.append(user)
-        self._save()
 
     def unregister_user(self, user: model.SwitchBotUserRepo):
         uid = user.uid
-        n, u = next(((n, u) for n, u in enumerate(self._users) if u.uid == uid), (None, None))
+        u = self._users.get(uid)
         if u is None:
             m = f'user uid {uid} not exist'
             logger.warning(m)
             raise ValueError(m)
-        else:
-            del self._users[n]
-            logger.info(f'unregister user {u}, replaced with new user {u}')
-        self._save()
+        self.write(puts=[], deletes=[uid])
+        logger.info(f'unregister user {u}')
 
     def get_by_secret(self, secret: str) -> model.SwitchBotUserRepo:
-        return next((u for u in self._users if u.secret == secret), None)
+        return self._secret_index.get(secret)
 
     def get_by_uid(self, uid: str) -> model.SwitchBotUserRepo:
-        return next((u for u in self._users if u.uid == uid), None)
+        return self._users.get(uid)
 
     def get_by_dev_id(self, dev_id) -> model.SwitchBotUserRepo:
-        return next((u for u in self._users for d in u.devices if d.device_id == dev_id), None)
+        u = self._users.get(self._dev_index.get(dev_id))
+        if u is not None and u.get_dev_by_id(dev_id) is None:
+            # device removed from user after last reindex
+            with self._lock:
+                self.reindex_devices(u)
+            return None
+        return u
 
     def get_dev_state(self, uid: str, dev_id: str) -> model.SwitchBotStatus:
         u = self.get_by_uid(uid=uid)
-        return next((s for s in u.states if s.device_id == dev_id), None)
+        return u.get_dev_state(dev_id=dev_id)
 
     def get_dev_last_change_report(self, uid: str, dev_id: str) -> model.SwitchBotChangeReport:
         u = self.get_by_uid(uid=uid)
-        return next((c for c in u.changes[::-1] if c.context.get("deviceMac") == dev_id), None)
+        return u.get_dev_last_change_report(dev_id=dev_id)
 
     def count(self) -> int:
         return len(self._users)
 
     def delete(self, uid):
-        n = next((n for n, u in enumerate(self._users) if u.uid == uid), None)
-        if n is not None:
-            del self._users[n]
+        self._remove(uid)
+
+    def add(self, user):
+        u = self._secret_index.get(user.secret)
+        if u:
+            logger.warning(f'user secret already used by {u.uid}, skip')
+        else:
+            self._put(user)
+
+
+class JournalFileDatastore(FileDatastore):
+    """
+    journal (WAL) 模式：file 為 snapshot (與 FileDatastore 相同的格式)，
+    commit 時只把有變動的用戶以一行一筆 record 附加到 {file}.journal：
+      {"op": "put", "user": {...}} 或 {"op": "del", "uid": "..."}
+    啟動時載入 snapshot 之後依序 replay {file}.journal.compacting 與 {file}.journal。
+    journal 累積超過 compact_threshold 筆之後，以背景 thread 將 journal 合併回 snapshot：
+    1. (lock) journal 改名為 .journal.compacting，之後的 commit 寫入新的 journal
+    2. 以 raw dict 合併 snapshot 與 .journal.compacting，寫入暫存檔
+    3. (lock) 暫存檔取代 snapshot，移除 .journal.compacting
+    put/del record 都是 idempotent，步驟 3 中斷時重新 replay .journal.compacting 不影響結果。
+    lock 只保護同一個 process 內的 datastore instance。
+    """
+    compact_threshold = 1000
+
+    def __init__(self, file: str, compact_threshold: Optional[int] = None, snapshot_format: str = SNAPSHOT_JSON):
+        self._journal = f'{file}.journal'
+        self._sealed = f'{file}.journal.compacting'
+        self._compact_lock = _get_file_lock(self._sealed)
+        if compact_threshold is not None:
+            self.compact_threshold = compact_threshold
+        super().__init__(file, snapshot_format=snapshot_format)
+
+    def _signature(self):
+        return tuple(_stat_signature(f) for f in [self._file, self._sealed, self._journal])
+
+    def _load(self):
+        super()._load()
+        self._journal_records = 0
+        for journal in [self._sealed, self._journal]:
+            self._replay(journal)
+
+    def _replay(self, journal: str):
+        if not os.path.exists(journal):
+            return
+        with open(journal, 'r', encoding='utf-8') as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f'skip incomplete journal record in {journal}: {line!r}')
+                    continue
+                if record.get('op') == 'put':
+                    user = codec.load_user(record.get('user'))
+                    self._put(user)
+                    self._committed[user.uid] = record.get('user')
+                elif record.get('op') == 'del':
+                    self._remove(record.get('uid'))
+                    self._committed.pop(record.get('uid'), None)
+                else:
+                    raise DatastoreSchemaError(f'unknown journal record {record}')
+                if journal == self._journal:
+                    self._journal_records += 1
+
+    def _persist(self, puts: List[model.SwitchBotUserRepo], deletes: List[str]):
+        records = [json.dumps({'op': 'del', 'uid': uid}, ensure_ascii=False) for uid in deletes]
+        records.extend(json.dumps({'op': 'put', 'user': self._committed[u.uid]}, ensure_ascii=False)
+                       for u in puts)
+        if not records:
+            return
+        with open(self._journal, 'a', encoding='utf-8') as fh:
+            fh.write(''.join(f'{r}\n' for r in records))
+            fh.flush()
+            os.fsync(fh.fileno())
+        self._journal_records += len(records)
+        if self._journal_records < self.compact_threshold or os.path.exists(self._sealed):
+            return
+        os.replace(self._journal, self._sealed)
+        _fsync_dir(os.path.dirname(os.path.abspath(self._file)))
+        self._journal_records = 0
+        threading.Thread(target=self.compact, name=f'compact-{self._file}', daemon=True).start()
+
+    def commit(self):
+        """checkpoint: write full snapshot and drop journal"""
+        with self._compact_lock, self._lock:
+            self._commit_resident()
+            self._save()
+            for journal in [self._sealed, self._journal]:
+                if os.path.exists(journal):
+                    os.remove(journal)
+            self._journal_records = 0
+            self._stat = self._signature()
+
+    def compact(self):
+        """fold sealed journal into snapshot, on raw dict records without marshmallow loading"""
+        with self._compact_lock:
+            if not os.path.exists(self._sealed):
+                return
+            content = read_snapshot(self._file) if os.path.exists(self._file) else []
+            records = {data.get('userId'): data for data in content}
+            with open(self._sealed, 'r', encoding='utf-8') as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if record.get('op') == 'put':
+                        data = record.get('user')
+                        records[data.get('userId')] = data
+                    elif record.get('op') == 'del':
+                        records.pop(record.get('uid'), None)
+            content = encode_snapshot(list(records.values()), self.snapshot_format)
+            with self._lock:
+                atomic_write(self._file, content)
+                os.remove(self._sealed)
+                self._stat = self._signature()
+            logger.info(f'datastore {self._file} compacted, {len(records)} users')
+
+
+class DatastoreSession:
+    """
+    unit of work 使用的 transactional view，以 copy-on-write 實作 rollback：
+    view 直接交出常駐 datastore 的用戶物件 (即 repository.seen 中的用戶)，查詢不取得 lock 也不複製。
+    常駐用戶的 write hook 在每次修改之前呼叫目前 thread 的 session (begin_write)，
+    用戶第一次被修改之前取得該用戶的 lock (最多等待 lock_timeout 秒，逾時 raise model.ConcurrentUpdateError)
+    並 dump 一份 snapshot，commit/rollback 時釋放，同一用戶同一時間只會被一個 uow 修改；
+    取得 lock 時用戶已被其他 uow commit (version 不同) 或 rollback (物件已被取代) 也 raise ConcurrentUpdateError，
+    由 messagebus 重新執行 handler。lock 只在修改到 commit 之間持有，handler 修改之前的 iot 呼叫不會阻擋其他 uow。
+    commit 時只把修改過的用戶、新增與刪除的用戶交給 datastore.write，rollback 時以 snapshot 還原被修改過的用戶；
+    close() (uow 結束) 之後的查詢與修改都不經過 session
+    """
+    lock_timeout = 10.0
+
+    def __init__(self, store: FileDatastore):
+        self._store = store
+        self._active = True
+        self._locks = []  # type: List[threading.RLock]
+        self._versions = {}  # type: Dict[str, int]
+        self._touched = {}  # type: Dict[str, model.SwitchBotUserRepo]
+        self._snapshots = {}  # type: Dict[str, dict]
+        self._added = {}  # type: Dict[str, model.SwitchBotUserRepo]
+        self._deleted = set()  # type: Set[str]
+        store._sessions.current = self
+
+    def _acquire(self, uid: str):
+        lock = self._store.user_lock(uid)
+        if not lock.acquire(timeout=self.lock_timeout):
+            raise model.ConcurrentUpdateError(f'user {uid} is locked by another unit of work')
+        self._locks.append(lock)
+
+    def begin_write(self, user: model.SwitchBotUserRepo):
+        """write hook: 用戶第一次被修改之前取得 lock、確認沒有被其他 uow 修改並保存 snapshot"""
+        if user.uid in self._touched or user.uid in self._added:
+            return
+        self._acquire(user.uid)
+        if self._store.get_by_uid(uid=user.uid) is not user or \
+                user.version != self._versions.get(user.uid, user.version):
+            raise model.ConcurrentUpdateError(f'user {user.uid} was updated by another unit of work')
+        self._snapshots[user.uid] = codec.dump_user(user)
+        self._touched[user.uid] = user
+
+    def _checkout(self, user: Optional[model.SwitchBotUserRepo]) -> Optional[model.SwitchBotUserRepo]:
+        if user is None or user.uid in self._deleted:
+            return None
+        if user.uid in self._touched:
+            return self._touched[user.uid]
+        if self._active:
+            self._versions.setdefault(user.uid, user.version)
+        return user
+
+    def get_by_uid(self, uid: str) -> model.SwitchBotUserRepo:
+        if uid in self._added:
+            return self._added[uid]
+        return self._checkout(self._store.get_by_uid(uid=uid))
+
+    def get_by_secret(self, secret: str) -> model.SwitchBotUserRepo:
+        u = next((u for u in self._added.values() if u.secret == secret), None)
+        if u is not None:
+            return u
+        return self._checkout(self._store.get_by_secret(secret=secret))
+
+    def get_by_dev_id(self, dev_id) -> model.SwitchBotUserRepo:
+        # device list of added/touched users may be changed (request_sync) before commit reindex them
+        for users in [self._added, self._touched]:
+            u = next((u for u in users.values() if u.get_dev_by_id(dev_id) is not None), None)
+            if u is not None and u.uid not in self._deleted:
+                return u
+        return self._checkout(self._store.get_by_dev_id(dev_id=dev_id))
+
+    def reindex(self, users: Iterable[model.SwitchBotUserRepo]):
+        """device lookups already search checked out users, nothing to do"""
+        pass
+
+    def count(self) -> int:
+        added = sum(1 for uid in self._added if self._store.get_by_uid(uid) is None)
+        deleted = sum(1 for uid in self._deleted if self._store.get_by_uid(uid) is not None)
+        return self._store.count() + added - deleted
 
     def add(self, user):
-        u = next((u for u in self._users if u.secret == user.secret), None)
+        u = self.get_by_secret(secret=user.secret)
         if u:
             logger.warning(f'user secret already used by {u.uid}, skip')
         else:
-            self._users.append(user)
+            self._deleted.discard(user.uid)
+            self._added[user.uid] = user
+
+    def delete(self, uid):
+        if uid not in self._deleted and self._store.get_by_uid(uid=uid) is not None:
+            self._acquire(uid)
+        self._added.pop(uid, None)
+        self._deleted.add(uid)
+
+    def commit(self):
+        puts = [u for uid, u in self._touched.items() if uid not in self._deleted]
+        puts.extend(self._added.values())
+        for u in puts:
+            u.version += 1
+        if puts or self._deleted:
+            self._store.write(puts=puts, deletes=self._deleted)
+        self._reset()
+
+    def rollback(self):
+        restored = codec.load_users(self._snapshots.values())
+        if restored:
+            self._store.restore(restored)
+        self._reset()
+
+    def _reset(self):
+        for u in self._touched.values():
+            u.mark_clean()
+        for u in self._added.values():
+            u.mark_clean()
+        self._versions = {}
+        self._touched = {}
+        self._snapshots = {}
+        self._added = {}
+        self._deleted = set()
+        while self._locks:
+            self._locks.pop().release()
+
+    def close(self):
+        """結束 session，之後的查詢直接讀取 datastore"""
+        self.rollback()
+        self._active = False
+        if getattr(self._store._sessions, 'current', None) is self:
+            self._store._sessions.current = None
+
+
+_datastores = {}  # type: Dict[str, FileDatastore]
+_datastores_guard = threading.Lock()
+
+
+def get_datastore(file: str, journal: bool = False, group_commit_window: Optional[float] = None,
+                  snapshot_format: Optional[str] = None) -> FileDatastore:
+    """process-lifetime datastore, loaded once and reloaded only when the file is modified externally"""
+    path = os.path.abspath(file)
+    cls = JournalFileDatastore if journal else FileDatastore
+    with _datastores_guard:
+        store = _datastores.get(path)
+        if type(store) is not cls:
+            store = _datastores[path] = cls(file, snapshot_format=snapshot_format or SNAPSHOT_JSON)
+            reload = False
+        else:
+            reload = True
+            if snapshot_format is not None:
+                if snapshot_format not in SNAPSHOT_FORMATS:
+                    raise ValueError(f'unknown snapshot format {snapshot_format}')
+                store.snapshot_format = snapshot_format
+        if group_commit_window is not None:
+            store.group_commit_window = group_commit_window
+    if reload:
+        store.refresh()
+    return store
 
 
-def session_factory(file: str):
-    return FileDatastore(file)
+def session_factory(file: str, journal: bool = False, group_commit_window: Optional[float] = None,
+                    snapshot_format: Optional[str] = None):
+    return DatastoreSession(get_datastore(file, journal=journal, group_commit_window=group_commit_window,
+                                          snapshot_format=snapshot_format))
@@ -6,16 +6,29 @@ import hmac
 import base64
 import uuid
 import os
+import re
 import logging
+import threading
+import asyncio
 import requests
-from typing import List, Set, Union
+from requests.adapters import HTTPAdapter
+from typing import List, Set, Union, Dict, Tuple, Optional
 from http import HTTPStatus
 from switchbot.domain import model
+from switchbot.adapters._iot import AsyncIotApi
+from switchbot.adapters.quota import RequestQuota, Priority
+from switchbot.adapters.resilience import CircuitBreaker, CircuitBreakers, backoff_delays, current_deadline
 
 # from switchbot.domain.model import SwitchBotDevice, SwitchBotStatus, SwitchBotScene
 
 logger = logging.getLogger(__name__)
 SWITCHBOT_API_URI = os.getenv('SWITCHBOT_API_URI', 'https://api.switch-bot.com')
+SWITCHBOT_API_POOL_SIZE = int(os.getenv('SWITCHBOT_API_POOL_SIZE', '10'))
+SWITCHBOT_API_CONNECT_TIMEOUT = float(os.getenv('SWITCHBOT_API_CONNECT_TIMEOUT', '3.05'))
+SWITCHBOT_API_READ_TIMEOUT = float(os.getenv('SWITCHBOT_API_READ_TIMEOUT', '10'))
+SWITCHBOT_API_RETRIES = int(os.getenv('SWITCHBOT_API_RETRIES', '2'))
+SWITCHBOT_API_CIRCUIT_FAILURES = int(os.getenv('SWITCHBOT_API_CIRCUIT_FAILURES', '5'))
+SWITCHBOT_API_CIRCUIT_RESET = float(os.getenv('SWITCHBOT_API_CIRCUIT_RESET', '30'))
 
 
 class SwitchBotAPIServerError(Exception):
@@ -26,6 +39,68 @@ class SwitchBotAPIResponseError(Exception):
     pass
 
 
+class SwitchBotAPIQuotaExceeded(SwitchBotAPIServerError):
+    pass
+
+
+class SwitchBotAPIRetryableError(SwitchBotAPIServerError):
+    """暫時性錯誤，idempotent 呼叫可以重試"""
+    pass
+
+
+class SwitchBotAPIRateLimited(SwitchBotAPIRetryableError):
+    """HTTP 429"""
+    def __init__(self, *args, retry_after: float = None):
+        super().__init__(*args)
+        self.retry_after = retry_after
+
+
+class SwitchBotAPIUnavailable(SwitchBotAPIRetryableError):
+    """HTTP 5xx"""
+    pass
+
+
+class SwitchBotAPITimeout(SwitchBotAPIRetryableError):
+    """連線失敗或逾時"""
+    pass
+
+
+class SwitchBotAPIClientError(SwitchBotAPIServerError):
+    """HTTP 4xx (429 除外) 或無法解析的 response，重試沒有意義"""
+    pass
+
+
+class SwitchBotAPICircuitOpen(SwitchBotAPIServerError):
+    """endpoint circuit breaker 開啟中，直接拒絕呼叫"""
+    pass
+
+
+def _classify_error(err: Exception) -> SwitchBotAPIServerError:
+    if isinstance(err, SwitchBotAPIServerError):
+        return err
+    if isinstance(err, (requests.Timeout, requests.ConnectionError)):
+        return SwitchBotAPITimeout(str(err))
+    if isinstance(err, requests.HTTPError) and err.response is not None:
+        status = err.response.status_code
+        if status == HTTPStatus.TOO_MANY_REQUESTS:
+            retry_after = err.response.headers.get('Retry-After')
+            return SwitchBotAPIRateLimited(
+                str(err), retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None)
+        if status >= 500:
+            return SwitchBotAPIUnavailable(str(err))
+    return SwitchBotAPIClientError(str(err))
+
+
+def _is_http_client_error(err: Exception) -> bool:
+    """SwitchBot API 正常回應了 HTTP 4xx，endpoint 本身是健康的"""
+    return isinstance(err, requests.HTTPError) and err.response is not None and 400 <= err.response.status_code < 500
+
+
+def _endpoint_key(method: str, endpoint: str) -> str:
+    """circuit breaker 以 endpoint 樣板區分，設備/場景 id 不各自計算"""
+    return method + ' ' + re.sub(r'/(devices|scenes)/[^/]+/', r'/\1/{id}/', endpoint)
+
+
 class AbstractIotApiServer(abc.ABC):
     def get_dev_list(self, secret: str, token: str) -> List[model.SwitchBotDevice]:
         raise NotImplementedError
@@ -58,13 +133,112 @@ class AbstractIotApiServer(abc.ABC):
     def delete_webhook_config(self, secret: str, token: str, url: str):
         raise NotImplementedError
 
+    def apply_change_report(self, dev_id: str, context: dict) -> Optional[model.SwitchBotStatus]:
+        """
+        webhook change report 通知，可以直接提供設備最新狀態時回傳 SwitchBotStatus (例如狀態快取)，
+        回傳 None 表示需要透過 get_dev_status 查詢
+        """
+        return None
+
     # def report_event(self, evt_type: str, evt_version: str, evt_context: dict):
     #     raise NotImplementedError
 
 
+class AbstractAsyncIotApiServer(abc.ABC):
+    """AbstractIotApiServer 的 asyncio 介面，method 與同步版本相同但皆為 coroutine"""
+    async def get_dev_list(self, secret: str, token: str) -> List[model.SwitchBotDevice]:
+        raise NotImplementedError
+
+    async def get_dev_status(self, secret: str, token: str, dev_id: str) -> model.SwitchBotStatus:
+        raise NotImplementedError
+
+    async def send_dev_ctrl_cmd(self, secret: str, token: str, dev_id: str, cmd_type: str, cmd_value: str,
+                                cmd_param: Union[str, dict]):
+        raise NotImplementedError
+
+    async def get_scene_list(self, secret: str, token: str) -> List[model.SwitchBotScene]:
+        raise NotImplementedError
+
+    async def exec_manual_scene(self, secret: str, token: str, scene_id: str):
+        raise NotImplementedError
+
+    async def create_webhook_config(self, secret: str, token: str, url: str):
+        raise NotImplementedError
+
+    async def read_webhook_config(self, secret: str, token: str) -> List[str]:
+        raise NotImplementedError
+
+    async def read_webhook_config_list(self, secret: str, token: str, url_list: List[str]):
+        raise NotImplementedError
+
+    async def update_webhook_config(self, secret: str, token: str, url: str, enable: bool):
+        raise NotImplementedError
+
+    async def delete_webhook_config(self, secret: str, token: str, url: str):
+        raise NotImplementedError
+
+
+_http_sessions = {}  # type: Dict[int, requests.Session]
+_http_sessions_lock = threading.Lock()
+
+
+def get_http_session(pool_size: int = SWITCHBOT_API_POOL_SIZE) -> requests.Session:
+    """
+    同一個 pool size 共用一個 requests.Session (跨用戶與 thread)，
+    連線由 urllib3 pool 保持 keep-alive，避免每個 request 都重新建立 TCP/TLS 連線
+    """
+    with _http_sessions_lock:
+        session = _http_sessions.get(pool_size)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_sessions[pool_size] = session
+        return session
+
+
 class SwitchBotApiServer(AbstractIotApiServer):
-    def __init__(self):
+    def __init__(self, pool_size: int = SWITCHBOT_API_POOL_SIZE,
+                 timeout: Tuple[float, float] = (SWITCHBOT_API_CONNECT_TIMEOUT, SWITCHBOT_API_READ_TIMEOUT),
+                 session: requests.Session = None, quota: RequestQuota = None,
+                 retries: int = SWITCHBOT_API_RETRIES, circuit_failures: int = SWITCHBOT_API_CIRCUIT_FAILURES,
+                 circuit_reset: float = SWITCHBOT_API_CIRCUIT_RESET):
         self.api_uri = SWITCHBOT_API_URI
+        self.timeout = timeout
+        self.session = session if session else get_http_session(pool_size)
+        self.quota = quota
+        self.retries = retries
+        self.breakers = CircuitBreakers(failure_threshold=circuit_failures, reset_timeout=circuit_reset)
+
+    def circuit_stats(self) -> Dict[str, Dict]:
+        """各 endpoint circuit breaker 狀態，供監控使用"""
+        return self.breakers.stats()
+
+    def remaining_quota(self, token: str) -> Optional[int]:
+        """用戶 token 今日剩餘的 request 額度，沒有設定 quota 時回傳 None"""
+        return self.quota.remaining(token) if self.quota else None
+
+    def _acquire(self, token: str, endpoint: str, priority: int):
+        if self.quota and not self.quota.acquire(token, priority=priority):
+            raise SwitchBotAPIQuotaExceeded(f'{endpoint} shed, remaining {self.quota.remaining(token)}')
+
+    def connection_stats(self) -> Dict[str, int]:
+        """api_uri 連線池統計: 建立的連線數、送出的 request 數與連線重用次數"""
+        adapter = self.session.get_adapter(self.api_uri)
+        pools = adapter.poolmanager.pools
+        connections, requests_sent = 0, 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            connections += pool.num_connections
+            requests_sent += pool.num_requests
+        return {
+            'connections': connections,
+            'requests': requests_sent,
+            'reused': requests_sent - connections
+        }
 
     @staticmethod
     def _get_auth_headers(secret: str, token: str, nonce=None):
@@ -98,46 +272,84 @@ class SwitchBotApiServer(AbstractIotApiServer):
         logger.debug(f'http headers {json.dumps(headers)}')
         return headers
 
-    def _get(self, endpoint: str, secret: str, token: str, params: dict = None):
-        try:
-            headers = self._get_auth_headers(secret, token)
-            if params:
-                resp = requests.get(
-                    url=f'{self.api_uri}{endpoint}',
-                    headers=headers,
-                    params=params
-                )
-            else:
-                resp = requests.get(
-                    url=f'{self.api_uri}{endpoint}',
-                    headers=headers
-                )
-
-            if resp.status_code != HTTPStatus.OK:
-                resp.raise_for_status()
-
-            logger.info(f'GET,{endpoint},{params},{resp.json()}')
-            return resp.json().get('body')
-        except Exception:
-            raise SwitchBotAPIServerError
-
-    def _post(self, secret: str, token: str, endpoint: str, data: dict):
-        try:
-            headers = self._get_auth_headers(secret, token)
-            # logger.debug(f'POST request {data}')
-            resp = requests.post(
-                url=f'{self.api_uri}{endpoint}',
-                headers=headers,
-                json=data
-            )
-
-            if resp.status_code != HTTPStatus.OK:
-                resp.raise_for_status()
-
-            logger.info(f'POST,{endpoint},{data},{resp.json()}')
-            return resp.json().get('body')
-        except Exception:
-            raise SwitchBotAPIServerError
+    def _timeout(self) -> Tuple[float, float]:
+        """目前 context 有 deadline 時，connect/read timeout 不超過剩餘時間"""
+        deadline = current_deadline()
+        if deadline is None:
+            return self.timeout
+        return tuple(max(0.001, deadline.clamp(t)) for t in self.timeout)  # requests 不接受 0
+
+    def _send(self, method: str, endpoint: str, secret: str, token: str, timeout: Tuple[float, float], **kwargs):
+        headers = self._get_auth_headers(secret, token)
+        resp = self.session.request(
+            method,
+            url=f'{self.api_uri}{endpoint}',
+            headers=headers,
+            timeout=timeout,
+            **kwargs
+        )
+        if resp.status_code != HTTPStatus.OK:
+            resp.raise_for_status()
+        return resp.json()
+
+    def _request(self, method: str, endpoint: str, secret: str, token: str, priority: int, idempotent: bool,
+                 **kwargs):
+        """
+        暫時性錯誤 (429/5xx/逾時) 時 idempotent 呼叫以 jittered exponential backoff 重試，
+        endpoint 連續失敗時 circuit breaker 開啟並直接拒絕呼叫；
+        目前 context 的 deadline 已過或等不及下次重試時 raise SwitchBotAPITimeout，
+        timeout 被 deadline 縮短而逾時不算 endpoint 失敗
+        """
+        breaker = self.breakers.get(_endpoint_key(method, endpoint))
+        delays = backoff_delays(self.retries if idempotent else 0)
+        deadline = current_deadline()
+        while True:
+            if deadline is not None and deadline.expired:
+                raise SwitchBotAPITimeout(f'{method} {endpoint} deadline exceeded')
+            if not breaker.allow():
+                raise SwitchBotAPICircuitOpen(f'{method} {endpoint}')
+            try:
+                self._acquire(token, endpoint, priority)
+            except SwitchBotAPIQuotaExceeded:
+                breaker.cancel()
+                raise
+            timeout = self._timeout()
+            try:
+                resp = self._send(method, endpoint, secret, token, timeout=timeout, **kwargs)
+            except Exception as err:
+                error = _classify_error(err)
+                if isinstance(error, SwitchBotAPITimeout) and tuple(timeout) != tuple(self.timeout):
+                    breaker.cancel()
+                    raise error from err
+                if not isinstance(error, SwitchBotAPIRetryableError):
+                    # 只有 HTTP 4xx 代表 endpoint 有回應，其他錯誤 (例如無法解析的 response) 不影響 circuit 狀態
+                    if _is_http_client_error(err):
+                        breaker.record_success()
+                    else:
+                        breaker.cancel()
+                    raise error from err
+                breaker.record_failure()
+                delay = next(delays, None)
+                if delay is None or breaker.state == CircuitBreaker.OPEN:
+                    raise error from err
+                if isinstance(error, SwitchBotAPIRateLimited) and error.retry_after:
+                    delay = max(delay, error.retry_after)
+                if deadline is not None and delay >= deadline.remaining():
+                    raise error from err
+                logger.warning(f'{method},{endpoint},{type(error).__name__}, retry in {delay:.2f}s')
+                time.sleep(delay)
+                continue
+            breaker.record_success()
+            logger.info(f'{method},{endpoint},{kwargs.get("params") or kwargs.get("json")},{resp}')
+            return resp.get('body')
+
+    def _get(self, endpoint: str, secret: str, token: str, params: dict = None, priority: int = Priority.NORMAL):
+        return self._request('GET', endpoint, secret, token, priority=priority, idempotent=True,
+                             params=params if params else None)
+
+    def _post(self, secret: str, token: str, endpoint: str, data: dict, priority: int = Priority.NORMAL,
+              idempotent: bool = False):
+        return self._request('POST', endpoint, secret, token, priority=priority, idempotent=idempotent, json=data)
 
     def get_dev_list(self, secret: str, token: str) -> List[model.SwitchBotDevice]:
         resp_body = self._get(
@@ -160,6 +372,7 @@ class SwitchBotApiServer(AbstractIotApiServer):
         resp_body = self._post(
             secret=secret,
             token=token,
+            priority=Priority.CRITICAL,
             endpoint=f'/v1.1/devices/{dev_id}/commands',
             data={
                 "commandType": cmd_type,
@@ -173,7 +386,8 @@ class SwitchBotApiServer(AbstractIotApiServer):
         resp_body = self._get(
             endpoint=f'/v1.1/devices/{dev_id}/status',
             secret=secret,
-            token=token
+            token=token,
+            priority=Priority.LOW
         )
         return model.SwitchBotStatus.load(resp_body)
 
@@ -192,7 +406,8 @@ class SwitchBotApiServer(AbstractIotApiServer):
             endpoint=f'/v1.1/scenes/{scene_id}/execute',
             secret=secret,
             token=token,
-            data={}
+            data={},
+            priority=Priority.CRITICAL
         )
         return resp_body
 
@@ -216,7 +431,8 @@ class SwitchBotApiServer(AbstractIotApiServer):
             endpoint=f'/v1.1/webhook/queryWebhook',
             secret=secret,
             token=token,
-            data={"action": "queryUrl"}
+            data={"action": "queryUrl"},
+            idempotent=True
         )
         if not isinstance(resp_body, dict):
             raise SwitchBotAPIResponseError
@@ -231,7 +447,8 @@ class SwitchBotApiServer(AbstractIotApiServer):
             data={
                 "action": "queryDetails",
                 "urls": url_list
-            }
+            },
+            idempotent=True
         )
         return resp_body
 
@@ -263,6 +480,171 @@ class SwitchBotApiServer(AbstractIotApiServer):
         return resp_body
 
 
+class AsyncSwitchBotApiServer(AbstractAsyncIotApiServer):
+    """
+    SwitchBotApiServer 的 asyncio 版本，所有 api method 皆為 coroutine，
+    透過 _iot.AsyncIotApi 共用一個長期的 aiohttp session，多設備/多用戶查詢可以同時進行
+    """
+    def __init__(self, limit: int = 100, limit_per_host: int = SWITCHBOT_API_POOL_SIZE,
+                 timeout: float = SWITCHBOT_API_READ_TIMEOUT, client: AsyncIotApi = None):
+        self.api_uri = SWITCHBOT_API_URI
+        self.client = client if client else AsyncIotApi(limit=limit, limit_per_host=limit_per_host,
+                                                        timeout=timeout)
+
+    async def _get(self, endpoint: str, secret: str, token: str, params: dict = None):
+        try:
+            resp = await self.client.get(
+                f'{self.api_uri}{endpoint}',
+                headers=SwitchBotApiServer._get_auth_headers(secret, token),
+                params=params if params else None
+            )
+            logger.info(f'GET,{endpoint},{params},{resp}')
+            return resp.get('body')
+        except Exception as err:
+            raise SwitchBotAPIServerError(f'GET {endpoint} failed, {type(err).__name__}: {err}') from err
+
+    async def _post(self, secret: str, token: str, endpoint: str, data: dict):
+        try:
+            resp = await self.client.post(
+                f'{self.api_uri}{endpoint}',
+                headers=SwitchBotApiServer._get_auth_headers(secret, token),
+                json=data
+            )
+            logger.info(f'POST,{endpoint},{data},{resp}')
+            return resp.get('body')
+        except Exception as err:
+            raise SwitchBotAPIServerError(f'POST {endpoint} failed, {type(err).__name__}: {err}') from err
+
+    async def close(self):
+        await self.client.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def get_dev_list(self, secret: str, token: str) -> List[model.SwitchBotDevice]:
+        resp_body = await self._get(
+            endpoint='/v1.1/devices',
+            secret=secret,
+            token=token
+        )
+        for _data in resp_body.get('infraredRemoteList'):
+            logger.warning(f'INFRARED REMOTE DEVICE NOT SUPPORTED YET: {_data}')
+        return [model.SwitchBotDevice.load(_data) for _data in resp_body.get('deviceList')]
+
+    async def get_dev_status(self, secret: str, token: str, dev_id: str) -> model.SwitchBotStatus:
+        resp_body = await self._get(
+            endpoint=f'/v1.1/devices/{dev_id}/status',
+            secret=secret,
+            token=token
+        )
+        return model.SwitchBotStatus.load(resp_body)
+
+    async def get_dev_all_status(self, secret: str, token: str,
+                                 dev_ids: List[str]) -> List[Union[model.SwitchBotStatus, Exception]]:
+        """同時查詢多個設備狀態，依 dev_ids 順序回傳，查詢失敗的設備回傳其 exception"""
+        return await asyncio.gather(
+            *[self.get_dev_status(secret=secret, token=token, dev_id=dev_id) for dev_id in dev_ids],
+            return_exceptions=True
+        )
+
+    async def send_dev_ctrl_cmd(self, secret: str, token: str, dev_id: str, cmd_type: str, cmd_value: str,
+                                cmd_param: Union[str, dict]):
+        resp_body = await self._post(
+            secret=secret,
+            token=token,
+            endpoint=f'/v1.1/devices/{dev_id}/commands',
+            data={
+                "commandType": cmd_type,
+                "command": cmd_value,
+                "parameter": cmd_param
+            }
+        )
+        return resp_body.values() if isinstance(resp_body, dict) else resp_body
+
+    async def get_scene_list(self, secret: str, token: str) -> List[model.SwitchBotScene]:
+        resp_body = await self._get(
+            endpoint=f'/v1.1/scenes',
+            secret=secret,
+            token=token
+        )
+        if not isinstance(resp_body, list):
+            raise SwitchBotAPIResponseError
+        return [model.SwitchBotScene.load(data) for data in resp_body]
+
+    async def exec_manual_scene(self, secret: str, token: str, scene_id: str):
+        return await self._post(
+            endpoint=f'/v1.1/scenes/{scene_id}/execute',
+            secret=secret,
+            token=token,
+            data={}
+        )
+
+    async def create_webhook_config(self, secret: str, token: str, url: str):
+        resp_body = await self._post(
+            endpoint=f'/v1.1/webhook/setupWebhook',
+            secret=secret,
+            token=token,
+            data={
+                "action": "setupWebhook",
+                "url": url,
+                "deviceList": "ALL"
+            }
+        )
+        if not isinstance(resp_body, dict):
+            raise SwitchBotAPIResponseError
+        return resp_body
+
+    async def read_webhook_config(self, secret: str, token: str) -> List[str]:
+        resp_body = await self._post(
+            endpoint=f'/v1.1/webhook/queryWebhook',
+            secret=secret,
+            token=token,
+            data={"action": "queryUrl"}
+        )
+        if not isinstance(resp_body, dict):
+            raise SwitchBotAPIResponseError
+        return resp_body.get('urls', [])
+
+    async def read_webhook_config_list(self, secret: str, token: str, url_list: List[str]):
+        return await self._post(
+            endpoint=f'/v1.1/webhook/queryWebhook',
+            secret=secret,
+            token=token,
+            data={
+                "action": "queryDetails",
+                "urls": url_list
+            }
+        )
+
+    async def update_webhook_config(self, secret: str, token: str, url: str, enable: bool):
+        return await self._post(
+            endpoint=f'/v1.1/webhook/updateWebhook',
+            secret=secret,
+            token=token,
+            data={
+                "action": "updateWebhook",
+                "config": {
+                    "url": url,
+                    "enable": True
+                }
+            }
+        )
+
+    async def delete_webhook_config(self, secret: str, token: str, url: str):
+        return await self._post(
+            endpoint=f'/v1.1/webhook/deleteWebhook',
+            secret=secret,
+            token=token,
+            data={
+                "action": "deleteWebhook",
+                "url": url
+            }
+        )
+
+
 class FakeApiServer(AbstractIotApiServer):
     """todo: response by fixed data"""
     jsonDevices = [
@@ -0,0 +1,226 @@
+"""
+設備狀態快取
+
+CachedIotApiServer 包在任何 AbstractIotApiServer 前面，get_dev_status 結果依設備類型的 TTL 快取，
+webhook change report 直接修補快取中的欄位，只有在快取過期 (change report 無法提供的欄位可能已經改變) 時，
+才需要再向雲端查詢設備狀態
+"""
+import time
+import threading
+import logging
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple, Union
+from switchbot.domain import model
+from switchbot.adapters.iot_api_server import AbstractIotApiServer, SwitchBotAPITimeout
+from switchbot.adapters.resilience import current_deadline
+
+logger = logging.getLogger(__name__)
+
+# 設備類型的狀態快取秒數，插座類的耗電欄位變化快，感測器類主要欄位皆由 change report 提供
+DEFAULT_STATUS_TTL = {
+    'Plug': 60,
+    'Plug Mini (US)': 60,
+    'Plug Mini (JP)': 60,
+    'Bot': 300,
+    'Curtain': 300,
+    'Lock': 300,
+    'Meter': 600,
+    'MeterPlus': 600,
+    'WoIOSensor': 600,
+    'Motion Sensor': 600,
+    'Contact Sensor': 600,
+}  # type: Dict[str, float]
+
+def _lower(v) -> str:
+    if not isinstance(v, str):
+        raise TypeError(f'expect str, got {type(v).__name__}')
+    return v.lower()
+
+
+# change report context 欄位對應到設備狀態 (SwitchBotStatusSchema data key) 欄位，以及值的轉換；
+# context 來自 webhook，轉換失敗 (TypeError/ValueError) 時不修補快取
+_CHANGE_REPORT_FIELDS = {
+    'powerState': ('power', _lower),
+    'battery': ('battery', int),
+    'temperature': ('temperature', float),
+    'humidity': ('humidity', int),
+    'lockState': ('lockState', _lower),
+    'openState': ('doorState', _lower),
+    'slidePosition': ('slidePosition', str),
+    'calibrate': ('calibrate', bool),
+    'group': ('group', bool),
+    'moving': ('moving', bool),
+    'brightness': ('brightness', str),
+    'color': ('color', str),
+    'colorTemperature': ('colorTemperature', int),
+    'detectionState': ('moveDetected', lambda v: v == 'DETECTED'),
+    'lightLevel': ('lightLevel', int),
+}
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None  # type: Optional[BaseException]
+
+
+class SingleFlight:
+    """
+    同一個 key 同時只有一個呼叫在進行，其他同 key 的呼叫等待並共用它的結果 (或 exception)，
+    等待不超過目前 context 的 deadline，逾時 raise SwitchBotAPITimeout；
+    coalesced 記錄共用結果而沒有實際呼叫的次數
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # type: Dict[Hashable, _Call]
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            deadline = current_deadline()
+            if not call.done.wait(timeout=deadline.remaining() if deadline is not None else None):
+                raise SwitchBotAPITimeout(f'wait for in-flight call {key} deadline exceeded')
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except BaseException as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'calls': self.calls, 'coalesced': self.coalesced, 'in_flight': len(self._calls)}
+
+
+class CachedIotApiServer(AbstractIotApiServer):
+    def __init__(self, iot: AbstractIotApiServer, ttl: Dict[str, float] = None, default_ttl: float = 30):
+        self.iot = iot
+        self.ttl = dict(DEFAULT_STATUS_TTL if ttl is None else ttl)
+        self.default_ttl = default_ttl
+        self._lock = threading.Lock()
+        self._states = {}  # type: Dict[str, Tuple[dict, float]]
+        self._generations = {}  # type: Dict[str, int]
+        self.hits = 0
+        self.misses = 0
+        self.flights = SingleFlight()
+
+    def stats(self) -> Dict[str, int]:
+        """快取命中與同時查詢合併的統計"""
+        with self._lock:
+            stats = {'hits': self.hits, 'misses': self.misses}
+        stats.update(self.flights.stats())
+        return stats
+
+    def _ttl_of(self, device_type: str) -> float:
+        return self.ttl.get(device_type, self.default_ttl)
+
+    def _get_fresh(self, dev_id: str) -> Optional[dict]:
+        entry = self._states.get(dev_id)
+        if entry is None:
+            return None
+        data, fetched_at = entry
+        if time.monotonic() - fetched_at >= self._ttl_of(data.get('deviceType')):
+            return None
+        return data
+
+    def invalidate(self, dev_id: str):
+        """
+        清除設備快取並遞增設備的 generation，invalidate 之前已經送出的查詢結果不寫入快取，
+        之後的查詢也不會與它合併
+        """
+        with self._lock:
+            self._drop(dev_id)
+
+    def _drop(self, dev_id: str):
+        self._states.pop(dev_id, None)
+        self._generations[dev_id] = self._generations.get(dev_id, 0) + 1
+
+    def get_dev_status(self, secret: str, token: str, dev_id: str) -> model.SwitchBotStatus:
+        with self._lock:
+            data = self._get_fresh(dev_id)
+            if data is not None:
+                self.hits += 1
+                return model.SwitchBotStatus.load(data)
+            self.misses += 1
+            generation = self._generations.get(dev_id, 0)
+
+        def _fetch():
+            _state = self.iot.get_dev_status(secret=secret, token=token, dev_id=dev_id)
+            if _state is not None:
+                with self._lock:
+                    if self._generations.get(dev_id, 0) == generation:
+                        self._states[dev_id] = (_state.dump(), time.monotonic())
+            return _state
+
+        # 同一設備同一 generation 同時的查詢只送出一次，其他呼叫共用結果
+        state = self.flights.do((token, dev_id, generation), _fetch)
+        return model.SwitchBotStatus.load(state.dump()) if state is not None else None
+
+    def apply_change_report(self, dev_id: str, context: dict) -> Optional[model.SwitchBotStatus]:
+        """
+        以 change report 修補快取中的設備狀態並回傳修補後的狀態，
+        快取不存在、已過期或 change report 欄位值無法轉換 (同時清除快取) 時回傳 None，由呼叫端再向雲端查詢
+        """
+        with self._lock:
+            data = self._get_fresh(dev_id)
+            if data is None:
+                return None
+            data = dict(data)
+            for key, (field, convert) in _CHANGE_REPORT_FIELDS.items():
+                if context.get(key) is not None:
+                    try:
+                        data[field] = convert(context.get(key))
+                    except (TypeError, ValueError) as err:
+                        logger.warning(f'dev {dev_id} change report {key}={context.get(key)!r} invalid, {err}')
+                        # 無法得知設備狀態變成什麼，快取不再可信
+                        self._drop(dev_id)
+                        return None
+            self._states[dev_id] = (data, self._states[dev_id][1])
+            self.hits += 1
+            return model.SwitchBotStatus.load(data)
+
+    def get_dev_list(self, secret: str, token: str) -> List[model.SwitchBotDevice]:
+        return self.iot.get_dev_list(secret=secret, token=token)
+
+    def send_dev_ctrl_cmd(self, secret: str, token: str, dev_id: str, cmd_type: str, cmd_value: str,
+                          cmd_param: Union[str, dict]):
+        self.invalidate(dev_id)
+        return self.iot.send_dev_ctrl_cmd(secret=secret, token=token, dev_id=dev_id, cmd_type=cmd_type,
+                                          cmd_value=cmd_value, cmd_param=cmd_param)
+
+    def get_scene_list(self, secret: str, token: str) -> List[model.SwitchBotScene]:
+        return self.iot.get_scene_list(secret=secret, token=token)
+
+    def exec_manual_scene(self, secret: str, token: str, scene_id: str):
+        return self.iot.exec_manual_scene(secret=secret, token=token, scene_id=scene_id)
+
+    def create_webhook_config(self, secret: str, token: str, url: str):
+        return self.iot.create_webhook_config(secret=secret, token=token, url=url)
+
+    def read_webhook_config(self, secret: str, token: str) -> List[str]:
+        return self.iot.read_webhook_config(secret=secret, token=token)
+
+    def read_webhook_config_list(self, secret: str, token: str, url_list: List[str]):
+        return self.iot.read_webhook_config_list(secret=secret, token=token, url_list=url_list)
+
+    def update_webhook_config(self, secret: str, token: str, url: str, enable: bool):
+        return self.iot.update_webhook_config(secret=secret, token=token, url=url, enable=enable)
+
+    def delete_webhook_config(self, secret: str, token: str, url: str):
+        return self.iot.delete_webhook_config(secret=secret, token=token, url=url)
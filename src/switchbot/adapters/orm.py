@@ -4,36 +4,113 @@ from sqlalchemy import (
     MetaData,
     Column,
     Integer,
+    BigInteger,
     String,
-    Date,
+    Boolean,
+    Float,
+    JSON,
     ForeignKey,
-    event,
+    Index,
 )
-from sqlalchemy.orm import mapper, relationship
-
-from switchbot.domain import model
+from sqlalchemy.engine import Engine
 
 logger = logging.getLogger(__name__)
 
+metadata = MetaData()
+
+users = Table(
+    "users",
+    metadata,
+    Column("uid", String(64), primary_key=True),
+    Column("secret", String(255), nullable=False, unique=True, index=True),
+    Column("token", String(255), nullable=False),
+    Column("scenes", JSON, nullable=False, default=list),
+    Column("webhooks", JSON, nullable=False, default=list),
+    Column("version", Integer, nullable=False, default=0),
+)
+
+devices = Table(
+    "devices",
+    metadata,
+    Column("user_id", ForeignKey("users.uid"), primary_key=True),
+    Column("device_id", String(64), primary_key=True),
+    Column("device_name", String(255)),
+    Column("device_type", String(64)),
+    Column("enable_cloud_service", Boolean),
+    Column("hub_device_id", String(64)),
+    Column("curtain_devices_ids", JSON),
+    Column("calibrate", Boolean),
+    Column("group", Boolean),
+    Column("master", Boolean),
+    Column("open_direction", String(32)),
+    Column("lock_devices_ids", JSON),
+    Column("group_name", String(255)),
+    Column("lock_device_id", String(64)),
+    Column("key_list", JSON),
+    Column("version", Integer),
+    Column("blind_tilt_devices_ids", JSON),
+    Column("direction", String(32)),
+    Column("slide_position", Integer),
+    Index("ix_devices_device_id", "device_id"),
+)
+
+states = Table(
+    "states",
+    metadata,
+    Column("user_id", ForeignKey("users.uid"), primary_key=True),
+    Column("device_id", String(64), primary_key=True),
+    Column("device_type", String(64)),
+    Column("hub_device_id", String(64)),
+    Column("power", String(16)),
+    Column("battery", Integer),
+    Column("version", String(32)),
+    Column("device_mode", String(32)),
+    Column("calibrate", Boolean),
+    Column("group", Boolean),
+    Column("moving", Boolean),
+    Column("slide_position", String(16)),
+    Column("temperature", Float),
+    Column("humidity", Integer),
+    Column("lock_state", String(32)),
+    Column("door_state", String(32)),
+    Column("working_status", String(32)),
+    Column("online_status", String(32)),
+    Column("move_detected", Boolean),
+    Column("brightness", String(16)),
+    Column("color", String(32)),
+    Column("color_temperature", Integer),
+    Column("voltage", Float),
+    Column("weight", Float),
+    Column("electricity_of_day", Integer),
+    Column("electric_current", Float),
+    Column("light_level", Integer),
+)
+
+change_reports = Table(
+    "change_reports",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("user_id", ForeignKey("users.uid"), nullable=False),
+    Column("device_id", String(64)),
+    Column("time_of_sample", BigInteger),
+    Column("event_type", String(64), nullable=False),
+    Column("event_version", String(16), nullable=False),
+    Column("context", JSON, nullable=False),
+    Index("ix_change_reports_device_time", "device_id", "time_of_sample"),
+)
+
+subscribers = Table(
+    "subscribers",
+    metadata,
+    Column("user_id", ForeignKey("users.uid"), primary_key=True),
+    Column("subscriber_id", String(64), primary_key=True),
+)
+
 
-def start_mappers():
-    # todo
-    logger.info("Starting mappers")
-    raise NotImplementedError
-    # lines_mapper = mapper(model.OrderLine, order_lines)
-    # batches_mapper = mapper(
-    #     model.Batch,
-    #     batches,
-    #     properties={
-    #         "_allocations": relationship(
-    #             lines_mapper,
-    #             secondary=allocations,
-    #             collection_class=set,
-    #         )
-    #     },
-    # )
-    # mapper(
-    #     model.Product,
-    #     products,
-    #     properties={"batches": relationship(batches_mapper)},
-    # )
+def start_mappers(engine: Engine):
+    """
+    domain model 不經過 SQLAlchemy instrument，由 repository.SqlAlchemyRepository 依照上面的 table 定義
+    自行把用戶拆成 row (data mapper)，這裡只負責在 engine 上建立 table 與 index
+    """
+    logger.info(f"Starting mappers on {engine.url}")
+    metadata.create_all(engine)
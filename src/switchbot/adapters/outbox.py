@@ -0,0 +1,155 @@
+"""
+domain event 的 transactional outbox
+
+uow 的 datastore commit 成功之後，把用戶產生的 event 寫入 outbox 檔案 (append-only, fsync)，
+message bus 每個 event handler 執行成功後記錄 ack (event id + handler 名稱)，全部 handler 完成後記錄 done。
+process 中斷時，尚未 done 的 event 在下次啟動時 replay (MessageBus.replay_outbox)，已 ack 的 handler 不會重複執行
+(at-least-once)；執行中的 process 不會重試失敗的 event，只有啟動時才 replay。
+event 欄位改變等原因無法還原的紀錄記錄 log 後略過
+"""
+import os
+import json
+import uuid
+import threading
+import logging
+from dataclasses import asdict
+from typing import Dict, List, Set, Tuple
+from switchbot.domain import events
+from switchbot.adapters.file_datastore import atomic_write, _get_file_lock
+
+logger = logging.getLogger(__name__)
+
+
+class FileOutbox:
+    """
+    outbox 檔案每行一筆紀錄:
+    {"op": "add", "id": ..., "type": "UserRegistered", "data": {...}}
+    {"op": "ack", "id": ..., "handler": "fetch_user_dev_list"}
+    {"op": "done", "id": ...}
+    紀錄數超過 compact_threshold 時，改寫為只包含未完成 event 的檔案
+    """
+    compact_threshold = 1000
+
+    def __init__(self, file: str):
+        self.file = file
+        self._lock = _get_file_lock(file)
+        self._pending = {}  # type: Dict[str, events.Event]
+        self._acked = {}  # type: Dict[str, Set[str]]
+        self._records = 0
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.file):
+            return
+        with open(self.file, encoding='utf-8') as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError:  # 寫到一半的最後一行
+                    logger.warning(f'skip broken outbox record {line!r}')
+                    continue
+                self._apply(record)
+                self._records += 1
+
+    def _apply(self, record: dict):
+        op, event_id = record.get('op'), record.get('id')
+        if op == 'add':
+            try:
+                self._pending[event_id] = self._load_event(record)
+            except (AttributeError, TypeError) as err:
+                logger.error(f'skip outbox event {event_id} that cannot be loaded, {type(err).__name__}: {err}, '
+                             f'{record!r}')
+                return
+            self._acked.setdefault(event_id, set())
+        elif op == 'ack' and event_id in self._pending:
+            self._acked[event_id].add(record.get('handler'))
+        elif op == 'done':
+            self._pending.pop(event_id, None)
+            self._acked.pop(event_id, None)
+
+    @staticmethod
+    def _load_event(record: dict) -> events.Event:
+        event = getattr(events, record.get('type'))(**record.get('data'))
+        event.outbox_id = record.get('id')
+        return event
+
+    def _write(self, records: List[dict], fsync: bool):
+        with open(self.file, 'a', encoding='utf-8') as fh:
+            fh.write(''.join(f'{json.dumps(r, ensure_ascii=False)}\n' for r in records))
+            fh.flush()
+            if fsync:
+                os.fsync(fh.fileno())
+        self._records += len(records)
+        if self._records >= self.compact_threshold:
+            self._compact()
+
+    def _compact(self):
+        records = []
+        for event_id, event in self._pending.items():
+            records.append({'op': 'add', 'id': event_id, 'type': type(event).__name__, 'data': asdict(event)})
+            records.extend({'op': 'ack', 'id': event_id, 'handler': h} for h in sorted(self._acked[event_id]))
+        atomic_write(self.file, ''.join(f'{json.dumps(r, ensure_ascii=False)}\n' for r in records))
+        self._records = len(records)
+
+    def add(self, new_events: List[events.Event]):
+        """event 寫入 outbox 並 fsync 之後，event.outbox_id 設為紀錄 id；寫入失敗時 event 不記錄在 outbox"""
+        if not new_events:
+            return
+        records = [{'op': 'add', 'id': uuid.uuid4().hex, 'type': type(event).__name__, 'data': asdict(event)}
+                   for event in new_events]
+        with self._lock:
+            # 先加入 _pending，_write 觸發 compaction 時新的 event 才會保留
+            for event, record in zip(new_events, records):
+                self._pending[record['id']] = event
+                self._acked[record['id']] = set()
+            try:
+                self._write(records, fsync=True)
+            except OSError:
+                for record in records:
+                    self._pending.pop(record['id'])
+                    self._acked.pop(record['id'])
+                raise
+            for event, record in zip(new_events, records):
+                event.outbox_id = record['id']
+
+    def is_acked(self, event_id: str, handler: str) -> bool:
+        with self._lock:
+            return handler in self._acked.get(event_id, ())
+
+    def ack(self, event_id: str, handler: str):
+        """ack 不 fsync，遺失的 ack 只會讓 replay 時該 handler 再執行一次"""
+        with self._lock:
+            if event_id not in self._pending:
+                return
+            self._acked[event_id].add(handler)
+            self._write([{'op': 'ack', 'id': event_id, 'handler': handler}], fsync=False)
+
+    def done(self, event_id: str):
+        self._finish([event_id])
+
+    def _finish(self, event_ids: List[str]):
+        with self._lock:
+            event_ids = [i for i in event_ids if i in self._pending]
+            for event_id in event_ids:
+                self._pending.pop(event_id)
+                self._acked.pop(event_id)
+            if event_ids:
+                self._write([{'op': 'done', 'id': i} for i in event_ids], fsync=False)
+
+    def pending(self) -> List[Tuple[str, events.Event]]:
+        with self._lock:
+            return list(self._pending.items())
+
+
+_outboxes = {}  # type: Dict[str, FileOutbox]
+_outboxes_guard = threading.Lock()
+
+
+def get_outbox(file: str) -> FileOutbox:
+    """同一個 outbox 檔案在 process 中只有一個 FileOutbox"""
+    with _outboxes_guard:
+        key = os.path.abspath(file)
+        outbox = _outboxes.get(key)
+        if outbox is None:
+            outbox = _outboxes[key] = FileOutbox(file)
+        return outbox
@@ -0,0 +1,174 @@
+"""
+SwitchBot Open API 用量控管
+
+SwitchBot 雲端對每個帳號 (token) 有每日 request 次數上限，這裡在呼叫端先行控管:
+1. 每個 token 一個 token bucket 限制瞬間流量
+2. 每個 token 每日 (UTC) 用量計數，剩餘額度低於保留量時，依 priority 先捨棄非必要的呼叫 (狀態更新)，
+   保留額度給設備控制指令
+3. 每日用量計數在背景 (至多每 save_interval 秒一次) 寫入檔案，服務結束時 close() 寫入最新計數，重啟後延續
+"""
+import os
+import json
+import time
+import hashlib
+import datetime
+import threading
+import logging
+from typing import Dict, Optional
+from switchbot.adapters.file_datastore import atomic_write
+
+logger = logging.getLogger(__name__)
+
+
+class Priority:
+    CRITICAL = 0  # 設備控制、場景執行
+    NORMAL = 1  # 設備列表、webhook 設定
+    LOW = 2  # 設備狀態更新，額度不足時最先捨棄
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self) -> float:
+        """取得一個 token 回傳 0，否則回傳需要等待的秒數"""
+        self._refill(time.monotonic())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RequestQuota:
+    """
+    rate/burst: token bucket 每秒補充量與容量
+    daily_limit: 每個 token 每日 request 上限
+    reserve: 各 priority 需要保留的剩餘額度比例，剩餘額度低於保留量時該 priority 的呼叫被捨棄
+    max_wait: 呼叫遇到 bucket 用盡時最多延後等待的秒數，LOW 呼叫只在每日剩餘額度低於保留量時直接捨棄
+    file: 每日用量計數檔，None 則不保存
+    save_interval: 用量變動之後延遲寫入計數檔的秒數，期間的變動合併為一次寫入
+    """
+    reserve = {
+        Priority.CRITICAL: 0.0,
+        Priority.NORMAL: 0.05,
+        Priority.LOW: 0.2,
+    }
+
+    def __init__(self, daily_limit: int = 10000, rate: float = 5.0, burst: float = 10.0,
+                 max_wait: float = 2.0, file: Optional[str] = None, save_interval: float = 1.0):
+        self.daily_limit = daily_limit
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+        self.file = file
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._buckets = {}  # type: Dict[str, TokenBucket]
+        self._used = {}  # type: Dict[str, int]
+        self._day = self._today()
+        self._version = 0  # 用量每次變動加一，較舊的計數不會覆蓋較新的
+        self._saved_version = 0
+        self._timer = None  # type: Optional[threading.Timer]
+        self._load()
+
+    @staticmethod
+    def _today() -> str:
+        return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d')
+
+    @staticmethod
+    def _key(token: str) -> str:
+        """計數檔不保存 token 原文"""
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()[:16]
+
+    def _load(self):
+        if not self.file or not os.path.exists(self.file):
+            return
+        try:
+            with open(self.file, encoding='utf-8') as f:
+                data = json.load(f)
+            used = {k: int(v) for k, v in data.get('used', {}).items()} if data.get('day') == self._day else {}
+        except (OSError, ValueError, TypeError, AttributeError) as err:
+            logger.warning(f'quota file {self.file} unreadable, start with empty usage, {type(err).__name__}: {err}')
+            return
+        self._used = used
+
+    def _rollover(self):
+        today = self._today()
+        if today != self._day:
+            self._day = today
+            self._used = {}
+            self._version += 1
+
+    def _schedule_save(self):
+        """在 _lock 之中呼叫，背景寫入計數檔，request 不需要等待 fsync"""
+        if self.file and self._timer is None:
+            self._timer = threading.Timer(self.save_interval, self._scheduled_save)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _scheduled_save(self):
+        with self._lock:
+            self._timer = None
+        self.save()
+
+    def save(self):
+        """寫入目前的用量計數，多個 thread 同時寫入時依序進行，已寫入較新計數時略過"""
+        if not self.file:
+            return
+        with self._save_lock:
+            with self._lock:
+                if self._version <= self._saved_version:
+                    return
+                version = self._version
+                content = json.dumps({'day': self._day, 'used': self._used})
+            atomic_write(self.file, content)
+            self._saved_version = version
+
+    def close(self):
+        """取消排程中的寫入並立即寫入最新的用量計數 (服務結束時呼叫)"""
+        with self._lock:
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        self.save()
+
+    def remaining(self, token: str) -> int:
+        with self._lock:
+            self._rollover()
+            return max(0, self.daily_limit - self._used.get(self._key(token), 0))
+
+    def acquire(self, token: str, priority: int = Priority.NORMAL) -> bool:
+        """
+        取得一次 request 額度，回傳 False 表示該呼叫應被捨棄
+        bucket 用盡時各 priority 都最多延後 max_wait 秒
+        """
+        key = self._key(token)
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            with self._lock:
+                self._rollover()
+                remaining = self.daily_limit - self._used.get(key, 0)
+                if remaining <= self.daily_limit * self.reserve.get(priority, 0.0) or remaining <= 0:
+                    logger.warning(f'daily quota low ({remaining}), shed priority {priority} request')
+                    return False
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = TokenBucket(rate=self.rate, capacity=self.burst)
+                wait = bucket.try_acquire()
+                if wait == 0:
+                    self._used[key] = self._used.get(key, 0) + 1
+                    self._version += 1
+                    self._schedule_save()
+                    return True
+            if time.monotonic() + wait > deadline:
+                logger.warning(f'request rate exceeded, shed priority {priority} request')
+                return False
+            time.sleep(wait)
@@ -1,7 +1,11 @@
 import abc
+import json
 import logging
-from typing import Set, List
+from typing import Set, List, Dict, Tuple, Optional
+from sqlalchemy import select, insert, update, delete, func
+from sqlalchemy.orm import Session
 from switchbot.domain import model
+from switchbot.adapters import orm
 
 logger = logging.getLogger(__name__)
 
@@ -90,8 +94,7 @@ class MemoryRepository(AbstractRepository):
         return len(self._users)
 
     def get_dev_last_change_report(self, uid: str, dev_id: str) -> model.SwitchBotChangeReport:
-        return next((c for u in self._users if u.uid == uid
-                     for c in u.changes[::-1] if c.context.get("deviceMac") == dev_id), None)
+        return next((u.get_dev_last_change_report(dev_id=dev_id) for u in self._users if u.uid == uid), None)
 
     def get_by_dev_id(self, dev_id: str) -> model.SwitchBotUserRepo:
         return next((u for u in self._users for d in u.devices if d.device_id == dev_id), None)
@@ -100,7 +103,7 @@ class MemoryRepository(AbstractRepository):
         u = self.get_by_uid(uid=uid)
         if not u:
             raise ValueError(f'uid {uid} not exist')
-        return next((state for state in u.states if state.device_id == dev_id))
+        return u.get_dev_state(dev_id=dev_id)
 
     def get_by_secret(self, secret: str) -> model.SwitchBotUserRepo:
         return next((u for u in self._users if u.secret == secret), None)
@@ -140,7 +143,12 @@ class JsonFileRepository(AbstractRepository):
         self.session.add(user=u)
 
     def _get_by_dev_id(self, dev_id: str) -> model.SwitchBotUserRepo:
-        return self.session.get_by_dev_id(dev_id=dev_id)
+        u = self.session.get_by_dev_id(dev_id=dev_id)
+        if u is None and self.seen:
+            # seen 用戶的設備清單可能在本次 uow 中被 request_sync 改變，尚未 reindex
+            self.session.reindex(self.seen)
+            u = self.session.get_by_dev_id(dev_id=dev_id)
+        return u
 
     def _get_by_secret(self, secret: str) -> model.SwitchBotUserRepo:
         return self.session.get_by_secret(secret=secret)
@@ -157,7 +165,192 @@ class JsonFileRepository(AbstractRepository):
         super().__init__()
         self.session = session  # type:'file_datastore.FileDatastore'
 
-# class SqlAlchemyRepository(AbstractRepository):
-#     def __init__(self, session):
-#         super().__init__()
-#         self.session = session
+
+class _UserRows:
+    """用戶載入時的 row snapshot，flush 時與目前用戶資料比對，只寫入有差異的 row"""
+
+    def __init__(self, user: dict = None, devices: dict = None, states: dict = None,
+                 changes: list = None, subscribers: set = None):
+        self.user = user  # type: Optional[dict]
+        self.devices = devices or {}  # type: Dict[str, dict]
+        self.states = states or {}  # type: Dict[str, dict]
+        self.changes = changes or []  # type: List[Tuple[int, dict]]
+        self.subscribers = subscribers or set()  # type: Set[str]
+
+
+def _row_of(obj, table) -> dict:
+    return {c.name: getattr(obj, c.name) for c in table.columns if c.name not in ('user_id', 'id')}
+
+
+def _change_row_of(c: model.SwitchBotChangeReport) -> dict:
+    return {
+        'device_id': c.context.get('deviceMac'),
+        'time_of_sample': c.context.get('timeOfSample'),
+        'event_type': c.event_type,
+        'event_version': c.event_version,
+        'context': c.context,
+    }
+
+
+class SqlAlchemyRepository(AbstractRepository):
+    """
+    以 SQLAlchemy Core table (orm.py) 實作的 data mapper：
+    用戶拆成 users/devices/states/change_reports/subscribers 多個 table，
+    flush 時只針對有修改 (dirty) 的用戶，以載入時的 row snapshot 比對，逐 row insert/update/delete，
+    例如 report_change 只會 insert 一筆 change_reports row (加上 users.version 的 compare-and-swap update)；
+    users.version 與載入時不同表示用戶已被其他 session 修改，raise model.ConcurrentUpdateError
+    """
+
+    def __init__(self, session):
+        super().__init__()
+        self.session = session  # type: Session
+        self._identity_map = {}  # type: Dict[str, Tuple[model.SwitchBotUserRepo, _UserRows]]
+        self._deleted = set()  # type: Set[str]
+
+    def _load(self, uid: Optional[str]) -> Optional[model.SwitchBotUserRepo]:
+        if uid is None or uid in self._deleted:
+            return None
+        if uid in self._identity_map:
+            return self._identity_map[uid][0]
+        user_row = self.session.execute(select(orm.users).where(orm.users.c.uid == uid)).mappings().first()
+        if user_row is None:
+            return None
+        dev_rows = self.session.execute(
+            select(orm.devices).where(orm.devices.c.user_id == uid)).mappings().all()
+        state_rows = self.session.execute(
+            select(orm.states).where(orm.states.c.user_id == uid)).mappings().all()
+        change_rows = self.session.execute(
+            select(orm.change_reports).where(orm.change_reports.c.user_id == uid)
+            .order_by(orm.change_reports.c.id)).mappings().all()
+        subscriber_rows = self.session.execute(
+            select(orm.subscribers.c.subscriber_id).where(orm.subscribers.c.user_id == uid)).scalars().all()
+        rows = _UserRows(
+            user=dict(user_row),
+            devices={r['device_id']: {k: v for k, v in r.items() if k != 'user_id'} for r in dev_rows},
+            states={r['device_id']: {k: v for k, v in r.items() if k != 'user_id'} for r in state_rows},
+            changes=[(r['id'], {k: v for k, v in r.items() if k not in ('user_id', 'id')}) for r in change_rows],
+            subscribers=set(subscriber_rows)
+        )
+        u = model.SwitchBotUserRepo(
+            uid=user_row['uid'],
+            secret=user_row['secret'],
+            token=user_row['token'],
+            devices=[model.SwitchBotDevice(**data) for data in rows.devices.values()],
+            states=[model.SwitchBotStatus(**data) for data in rows.states.values()],
+            changes=[model.SwitchBotChangeReport(
+                event_type=data['event_type'],
+                event_version=data['event_version'],
+                context=data['context']) for _, data in rows.changes],
+            scenes=list(user_row['scenes'] or []),
+            webhooks=list(user_row['webhooks'] or []),
+            subscribers=set(rows.subscribers),
+            version=user_row['version']
+        )
+        self._identity_map[uid] = (u, rows)
+        return u
+
+    def _get_by_uid(self, uid: str) -> model.SwitchBotUserRepo:
+        return self._load(uid)
+
+    def _get_by_secret(self, secret: str) -> model.SwitchBotUserRepo:
+        u = next((u for u, _ in self._identity_map.values() if u.secret == secret), None)
+        if u is not None:
+            return u
+        return self._load(self.session.execute(
+            select(orm.users.c.uid).where(orm.users.c.secret == secret)).scalar())
+
+    def _get_by_dev_id(self, dev_id: str) -> model.SwitchBotUserRepo:
+        u = next((u for u, _ in self._identity_map.values() if u.get_dev_by_id(dev_id) is not None), None)
+        if u is not None:
+            return u
+        return self._load(self.session.execute(
+            select(orm.devices.c.user_id).where(orm.devices.c.device_id == dev_id)).scalar())
+
+    def _add(self, u: model.SwitchBotUserRepo):
+        existing = self._get_by_secret(secret=u.secret)
+        if existing is not None:
+            logger.warning(f'user secret already used by {existing.uid}, skip')
+            return
+        self._deleted.discard(u.uid)
+        self._identity_map[u.uid] = (u, _UserRows())
+
+    def _delete(self, uid):
+        if self._load(uid) is None:
+            return
+        _, rows = self._identity_map.pop(uid)
+        if rows.user is not None:
+            self._deleted.add(uid)
+
+    def _count(self) -> int:
+        count = self.session.execute(select(func.count()).select_from(orm.users)).scalar()
+        added = sum(1 for _, rows in self._identity_map.values() if rows.user is None)
+        return count + added - len(self._deleted)
+
+    def flush(self):
+        """write row level changes of added/deleted/dirty users into session"""
+        for uid in self._deleted:
+            for table in [orm.devices, orm.states, orm.change_reports, orm.subscribers]:
+                self.session.execute(delete(table).where(table.c.user_id == uid))
+            self.session.execute(delete(orm.users).where(orm.users.c.uid == uid))
+        self._deleted = set()
+        for uid, (u, rows) in self._identity_map.items():
+            if rows.user is not None and not u.dirty:
+                continue
+            self._flush_user(u, rows)
+            u.mark_clean()
+
+    def _flush_user(self, u: model.SwitchBotUserRepo, rows: _UserRows):
+        uid = u.uid
+        user_row = {'uid': uid, 'secret': u.secret, 'token': u.token,
+                    'scenes': list(u.scenes), 'webhooks': list(u.webhooks), 'version': u.version + 1}
+        if rows.user is None:
+            self.session.execute(insert(orm.users).values(**user_row))
+        else:
+            values = {k: v for k, v in user_row.items() if v != rows.user.get(k)}
+            result = self.session.execute(update(orm.users).where(
+                orm.users.c.uid == uid, orm.users.c.version == u.version).values(**values))
+            if result.rowcount != 1:
+                raise model.ConcurrentUpdateError(f'user {uid} version {u.version} was changed by another session')
+        u.version += 1
+        rows.user = user_row
+
+        for table, origin, current in [
+            (orm.devices, rows.devices, {d.device_id: _row_of(d, orm.devices) for d in u.devices}),
+            (orm.states, rows.states, {s.device_id: _row_of(s, orm.states) for s in u.states}),
+        ]:
+            for dev_id in origin.keys() - current.keys():
+                self.session.execute(delete(table).where(
+                    table.c.user_id == uid, table.c.device_id == dev_id))
+            for dev_id, data in current.items():
+                if dev_id not in origin:
+                    self.session.execute(insert(table).values(user_id=uid, **data))
+                elif origin[dev_id] != data:
+                    self.session.execute(update(table).where(
+                        table.c.user_id == uid, table.c.device_id == dev_id).values(**data))
+            origin.clear()
+            origin.update(current)
+
+        remaining = {}  # type: Dict[str, List[int]]
+        for row_id, data in rows.changes:
+            remaining.setdefault(json.dumps(data, sort_keys=True), []).append(row_id)
+        changes = []
+        for c in u.changes:
+            data = _change_row_of(c)
+            ids = remaining.get(json.dumps(data, sort_keys=True))
+            if ids:
+                row_id = ids.pop(0)
+            else:
+                row_id = self.session.execute(
+                    insert(orm.change_reports).values(user_id=uid, **data)).inserted_primary_key[0]
+            changes.append((row_id, data))
+        for row_id in (row_id for ids in remaining.values() for row_id in ids):
+            self.session.execute(delete(orm.change_reports).where(orm.change_reports.c.id == row_id))
+        rows.changes = changes
+
+        subscriber_ids = set(u.subscribers)
+        for subscriber_id in rows.subscribers - subscriber_ids:
+            self.session.execute(delete(orm.subscribers).where(
+                orm.subscribers.c.user_id == uid, orm.subscribers.c.subscriber_id == subscriber_id))
+        for subscriber_id in subscriber_ids - rows.subscribers:
+            self.session.execute(insert(orm.subscribers).values(user_id=uid, subscriber_id=subscriber_id))
+        rows.subscribers = subscriber_ids
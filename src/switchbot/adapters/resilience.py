@@ -0,0 +1,147 @@
+"""
+呼叫外部 api 的 resilience 工具: jittered exponential backoff、circuit breaker 與 request deadline
+"""
+import time
+import random
+import threading
+import logging
+import contextlib
+import contextvars
+from typing import Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def backoff_delays(retries: int, base: float = 0.2, cap: float = 2.0) -> Iterator[float]:
+    """full jitter exponential backoff，第 n 次重試等待 uniform(0, min(cap, base * 2 ** n)) 秒"""
+    for n in range(retries):
+        yield random.uniform(0, min(cap, base * 2 ** n))
+
+
+class CircuitBreaker:
+    """
+    連續失敗 failure_threshold 次後 OPEN，OPEN 期間直接拒絕呼叫 (fail fast)，
+    reset_timeout 秒後 HALF_OPEN 放行一個試探呼叫，成功則 CLOSED，失敗則重新 OPEN
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None  # type: Optional[float]
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+                self._probing = False
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def cancel(self):
+        """allow() 放行後實際沒有送出呼叫，釋放 HALF_OPEN 的試探名額"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    logger.warning(f'circuit open after {self._failures} failures')
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def stats(self) -> Dict:
+        state = self.state
+        with self._lock:
+            return {'state': state, 'failures': self._failures}
+
+
+class CircuitBreakers:
+    """依 key (endpoint) 各自獨立的 circuit breaker"""
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._breakers = {}  # type: Dict[str, CircuitBreaker]
+
+    def get(self, key: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = self._breakers[key] = CircuitBreaker(
+                    failure_threshold=self.failure_threshold, reset_timeout=self.reset_timeout)
+            return breaker
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {key: breaker.stats() for key, breaker in breakers.items()}
+
+
+_current_deadline = contextvars.ContextVar('deadline', default=None)  # type: contextvars.ContextVar
+
+
+class Deadline:
+    """
+    request 必須完成的期限，以 scope() 設定為目前 context 的 deadline，
+    下游呼叫 (例如 SwitchBotApiServer) 以 current_deadline() 取得並據以縮短 timeout、放棄重試；
+    新 thread (ThreadPoolExecutor worker) 不會繼承 deadline
+    """
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.expires_at = time.monotonic() + timeout
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def clamp(self, timeout: float) -> float:
+        """timeout 不超過剩餘時間"""
+        return min(timeout, self.remaining())
+
+    @contextlib.contextmanager
+    def scope(self):
+        token = _current_deadline.set(self)
+        try:
+            yield self
+        finally:
+            _current_deadline.reset(token)
+
+    def __repr__(self):
+        return f'Deadline(remaining={self.remaining():.3f})'
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current_deadline.get()
@@ -1,5 +1,7 @@
 """"""
 import inspect
+import functools
+from typing import Callable
 from switchbot.service_layer import handlers, messagebus, unit_of_work
 from switchbot.adapters import orm, iot_api_server
 
@@ -7,14 +9,24 @@ from switchbot.adapters import orm, iot_api_server
 def bootstrap(
         uow: unit_of_work.AbstractUnitOfWork = unit_of_work.JsonFileUnitOfWork(),
         start_orm: bool = False,
-        iot: iot_api_server.AbstractIotApiServer = iot_api_server.SwitchBotApiServer()
+        iot: iot_api_server.AbstractIotApiServer = iot_api_server.SwitchBotApiServer(),
+        event_workers: int = 0,
+        tracer: Callable[[messagebus.MessageTrace], None] = None
 ) -> messagebus.MessageBus:
     """todo: Register >> inject iot_api_server"""
 
     if start_orm:
-        orm.start_mappers()
+        if not isinstance(uow, unit_of_work.SqlAlchemyUnitOfWork):
+            raise ValueError(f'start_orm requires SqlAlchemyUnitOfWork, got {type(uow).__name__}')
+        orm.start_mappers(engine=uow.engine)
 
-    dependencies = {'uow': uow, 'iot': iot}
+    bus = None  # type: messagebus.MessageBus
+
+    def publish(event):
+        """handler 在 message bus 之外 (背景 thread) 產生的 event 交給 bus 處理"""
+        bus.handle(event)
+
+    dependencies = {'uow': uow, 'iot': iot, 'publish': publish}
     injected_event_handlers = {
         event_type: [
             inject_dependencies(handler, dependencies)
@@ -27,11 +39,14 @@ def bootstrap(
         for command_type, handler in handlers.COMMAND_HANDLERS.items()
     }
 
-    return messagebus.MessageBus(
+    bus = messagebus.MessageBus(
         uow=uow,
         event_handlers=injected_event_handlers,
         command_handlers=injected_command_handlers,
+        event_workers=event_workers,
+        tracer=tracer,
     )
+    return bus
 
 
 def inject_dependencies(handler, dependencies):
@@ -41,4 +56,8 @@ def inject_dependencies(handler, dependencies):
         for name, dependency in dependencies.items()
         if name in params
     }
-    return lambda message: handler(message, **deps)
+
+    @functools.wraps(handler)
+    def injected(message):
+        return handler(message, **deps)
+    return injected
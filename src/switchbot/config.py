@@ -22,6 +22,70 @@ def get_webhook_uri():
     return f"{get_api_uri()}/change"
 
 
+def get_datastore_group_commit_window():
+    """group commit window in seconds, 0 means every commit is written immediately"""
+    return float(os.getenv("DATASTORE_GROUP_COMMIT_MS", "0")) / 1000
+
+
+def get_datastore_snapshot_format():
+    """
+    datastore snapshot file format, 'json' (pretty-printed) or 'binary' (length-prefixed compact JSON records);
+    'binary' gives smaller files and faster writes but reads slightly slower than 'json'
+    """
+    return os.getenv("DATASTORE_SNAPSHOT_FORMAT", "json")
+
+
+def get_change_history_retention():
+    """(max change reports per device, max age in milliseconds)"""
+    max_count = int(os.getenv("CHANGE_HISTORY_MAX_COUNT", "100"))
+    max_age = int(os.getenv("CHANGE_HISTORY_MAX_AGE_HOURS", "168")) * 60 * 60 * 1000
+    return max_count, max_age
+
+
+def get_change_batch_window():
+    """/change webhook batch window in seconds, shared by all devices; 0 means change reports are handled synchronously"""
+    return float(os.getenv("CHANGE_BATCH_WINDOW_MS", "0")) / 1000
+
+
+def get_outbox_enabled():
+    """persist domain events in a datastore outbox and replay them on startup"""
+    return os.getenv("EVENT_OUTBOX", "1") == "1"
+
+
+def get_event_workers():
+    """number of background threads handling domain events, 0 means events are handled inline"""
+    return int(os.getenv("EVENT_WORKERS", "0"))
+
+
+def get_dev_state_fetch_concurrency():
+    """max number of device states fetched in parallel for one user"""
+    return max(1, int(os.getenv("DEV_STATE_FETCH_CONCURRENCY", "8")))
+
+
+def get_dev_ctrl_concurrency():
+    """max number of device commands sent in parallel, shared by all EXECUTE intents"""
+    return max(1, int(os.getenv("DEV_CTRL_CONCURRENCY", "8")))
+
+
+def get_fulfillment_deadline():
+    """seconds a /fulfillment request may take, device commands unfinished by then are reported PENDING"""
+    return float(os.getenv("FULFILLMENT_DEADLINE", "5"))
+
+
+def get_switchbot_api_quota():
+    """kwargs of quota.RequestQuota for SwitchBot Open API calls"""
+    return dict(
+        daily_limit=int(os.getenv("SWITCHBOT_API_DAILY_LIMIT", "10000")),
+        rate=float(os.getenv("SWITCHBOT_API_RATE", "5")),
+        burst=float(os.getenv("SWITCHBOT_API_BURST", "10")),
+        file=os.getenv("SWITCHBOT_API_QUOTA_FILE", ".quota"),
+    )
+
+
+def get_sqlite_uri():
+    return os.getenv("SQLITE_URI", "sqlite:///.datastore.sqlite")
+
+
 def get_postgres_uri():
     host = os.environ.get("DB_HOST", "localhost")
     port = 54321 if host == "localhost" else 5432
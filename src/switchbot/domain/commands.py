@@ -67,6 +67,12 @@ class ReportChange(Command):
     # context: dict
 
 
+@dataclass
+class ReportChanges(Command):
+    """webhook report change 批次處理，changes 為多筆 ReportChange.change"""
+    changes: List[dict]
+
+
 @dataclass
 class Disconnect(Command):
     """訂閱用戶取消訂閱"""
@@ -97,3 +103,21 @@ class SendDevCtrlCmd(Command):
     cmd_type: str
     cmd_value: str
     cmd_param: Union[dict, str]
+
+
+@dataclass
+class DevCtrlCmd:
+    """SendDevCtrlCmds 中單一設備的控制指令"""
+    dev_id: str
+    cmd_type: str
+    cmd_value: str
+    cmd_param: Union[dict, str]
+
+
+@dataclass
+class SendDevCtrlCmds(Command):
+    """同時控制用戶多個設備，deadline (沒有 deadline 時為 timeout 秒) 之前未完成的指令回報 PENDING"""
+    uid: str
+    subscriber_id: str
+    cmds: List[DevCtrlCmd]
+    timeout: float = 5.0
@@ -3,7 +3,7 @@ from dataclasses import dataclass
 
 
 class Event:
-    pass
+    outbox_id = None  # 寫入 outbox 之後的紀錄 id，不是 dataclass 欄位
 
 
 @dataclass
@@ -40,6 +40,7 @@ class UserWebhookUpdated(Event):
 @dataclass
 class UserDevReportChanged(Event):
     """表示新訂閱用戶的設備狀態更新之後又有狀態變化，需要 pub ReportSubscriberDevState"""
+    uid: str
     dev_id: str
     change: dict
 
@@ -63,6 +64,13 @@ class UserDevStateChanged(Event):
     dev_id: str
 
 
+@dataclass
+class UserDevCtrlCmdCompleted(Event):
+    """表示回報 PENDING 的設備控制指令已在背景完成，需要更新設備狀態"""
+    uid: str
+    dev_id: str
+
+
 @dataclass
 class UserDevListChanged(Event):
     """表示用戶設備清單有變更，若是有訂閱第三方服務的情況下，需要被通知"""
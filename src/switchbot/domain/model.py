@@ -1,6 +1,7 @@
+import bisect
 import logging
 import uuid
-from typing import List, Set, Dict, Optional
+from typing import List, Set, Dict, Optional, Callable, Iterable, Iterator
 from dataclasses import dataclass
 from marshmallow import Schema, fields, post_load, post_dump
 from switchbot.domain import events
@@ -8,6 +9,11 @@ from switchbot.domain import events
 logger = logging.getLogger(__name__)
 
 
+class ConcurrentUpdateError(Exception):
+    """用戶資料同時被其他 unit of work 修改 (取得用戶 lock 逾時或 version 不符)，handler 可以重試"""
+    pass
+
+
 class SwitchBotChangeReport:
     """
     "eventType": "changeReport",
@@ -44,12 +50,77 @@ class SwitchBotChangeReport:
 
     @classmethod
     def load(cls, data: dict):
-        _schema = SwitchBotChangeReportSchema()
-        return _schema.load(data)
+        return _change_report_schema.load(data)
 
     def dump(self):
-        _schema = SwitchBotChangeReportSchema()
-        return _schema.dump(self)
+        return _change_report_schema.dump(self)
+
+
+class SwitchBotChangeHistory:
+    """
+    用戶設備 change report 歷史，每個設備 (deviceMac) 一個依 timeOfSample 排序的 ring buffer：
+    只保留最近 max_count 筆，且不早於該設備最新 sample max_age 毫秒的 change report，
+    last() 為 O(1)，range() 以 bisect 查詢為 O(log n)
+    """
+    max_count = 100
+    max_age = 7 * 24 * 60 * 60 * 1000
+
+    def __init__(self, changes: Iterable[SwitchBotChangeReport] = (),
+                 max_count: Optional[int] = None, max_age: Optional[int] = None):
+        if max_count is not None:
+            self.max_count = max_count
+        if max_age is not None:
+            self.max_age = max_age
+        self._reports = {}  # type: Dict[str, List[SwitchBotChangeReport]]
+        self._times = {}  # type: Dict[str, List[int]]
+        self._count = 0
+        for change in changes:
+            self.append(change)
+
+    @classmethod
+    def configure(cls, max_count: int, max_age: int):
+        cls.max_count = max_count
+        cls.max_age = max_age
+
+    def append(self, change: SwitchBotChangeReport):
+        dev_id = change.context.get('deviceMac')
+        t = change.context.get('timeOfSample') or 0
+        times = self._times.setdefault(dev_id, [])
+        reports = self._reports.setdefault(dev_id, [])
+        n = bisect.bisect_right(times, t)
+        times.insert(n, t)
+        reports.insert(n, change)
+        self._count += 1
+        self._trim(dev_id)
+
+    def _trim(self, dev_id: str):
+        times = self._times[dev_id]
+        k = len(times) - self.max_count if self.max_count else 0
+        if self.max_age:
+            k = max(k, bisect.bisect_left(times, times[-1] - self.max_age))
+        if k > 0:
+            del times[:k]
+            del self._reports[dev_id][:k]
+            self._count -= k
+
+    def last(self, dev_id: str) -> Optional[SwitchBotChangeReport]:
+        reports = self._reports.get(dev_id)
+        return reports[-1] if reports else None
+
+    def range(self, dev_id: str, since: Optional[int] = None, until: Optional[int] = None
+              ) -> List[SwitchBotChangeReport]:
+        """change reports of device with since <= timeOfSample <= until"""
+        times = self._times.get(dev_id, [])
+        start = 0 if since is None else bisect.bisect_left(times, since)
+        end = len(times) if until is None else bisect.bisect_right(times, until)
+        return self._reports.get(dev_id, [])[start:end]
+
+    def __iter__(self) -> Iterator[SwitchBotChangeReport]:
+        for reports in self._reports.values():
+            yield from reports
+
+    def __len__(self):
+        return self._count
 
 
 class SwitchBotStatus:
@@ -123,12 +194,10 @@ class SwitchBotStatus:
 
     @classmethod
     def load(cls, data: dict):
-        _schema = SwitchBotStatusSchema()
-        return _schema.load(data)
+        return _status_schema.load(data)
 
     def dump(self):
-        _schema = SwitchBotStatusSchema()
-        return _schema.dump(self)
+        return _status_schema.dump(self)
 
 
 class SwitchBotDevice:
@@ -220,12 +289,10 @@ class SwitchBotDevice:
 
     @classmethod
     def load(cls, data: dict):
-        _schema = SwitchBotDeviceSchema()
-        return _schema.load(data)
+        return _device_schema.load(data)
 
     def dump(self):
-        _schema = SwitchBotDeviceSchema()
-        return _schema.dump(self)
+        return _device_schema.dump(self)
 
 
 class SwitchBotScene:
@@ -242,12 +309,10 @@ class SwitchBotScene:
 
     @classmethod
     def load(cls, data: dict):
-        _schema = SwitchBotSceneSchema()
-        return _schema.load(data)
+        return _scene_schema.load(data)
 
     def dump(self):
-        _schema = SwitchBotSceneSchema()
-        return _schema.dump(self)
+        return _scene_schema.dump(self)
 
 
 class SwitchBotCommandSchema(Schema):
@@ -268,12 +333,22 @@ class SwitchBotCommand:
 
     @classmethod
     def load(cls, data: dict):
-        _schema = SwitchBotCommandSchema()
-        return _schema.load(data)
+        return _command_schema.load(data)
 
     def dump(self):
-        _schema = SwitchBotCommandSchema()
-        return _schema.dump(self)
+        return _command_schema.dump(self)
+
+
+@dataclass
+class SwitchBotCommandResult:
+    """設備控制指令執行結果"""
+    SUCCESS = 'SUCCESS'
+    PENDING = 'PENDING'
+    ERROR = 'ERROR'
+
+    dev_id: str
+    status: str
+    error_code: Optional[str] = None
 
 
 @dataclass
@@ -301,27 +376,65 @@ class SwitchBotUserRepo:
             states: List[SwitchBotStatus],
             scenes: List[SwitchBotScene],
             webhooks: List[SwitchBotWebhook],
-            subscribers: Set
+            subscribers: Set,
+            version: int = 0
     ):
         self.uid = uid
         self.secret = secret
         self.token = token
-        self.devices = devices  # type: List[SwitchBotDevice]
-        self.changes = changes  # type: List[SwitchBotChangeReport]
-        self.states = states  # type: List[SwitchBotStatus]
-        self._states = []  # type: List[Dict]
+        self.devices = devices
+        self.changes = changes if isinstance(changes, SwitchBotChangeHistory) \
+            else SwitchBotChangeHistory(changes)  # type: SwitchBotChangeHistory
+        self.states = states
         self.scenes = scenes  # type: List[SwitchBotScene]
         self.webhooks = webhooks  # type: List[SwitchBotWebhook]
         self.subscribers = subscribers  # type: Set
+        self.version = version  # type: int  # 每次 commit 加一，用於 optimistic concurrency
         self.events = []  # type: List[events.Event]
+        self._dirty = False
+        self._write_hook = None  # type: Optional[Callable[[SwitchBotUserRepo], None]]
+
+    @property
+    def devices(self) -> List[SwitchBotDevice]:
+        """devices 以 device_id 為 key 存放 (保留加入順序)，對外仍以 list 呈現並序列化"""
+        return list(self._devices.values())
+
+    @devices.setter
+    def devices(self, devices: Iterable[SwitchBotDevice]):
+        self._devices = {dev.device_id: dev for dev in devices}  # type: Dict[str, SwitchBotDevice]
+
+    @property
+    def states(self) -> List[SwitchBotStatus]:
+        return list(self._states.values())
+
+    @states.setter
+    def states(self, states: Iterable[SwitchBotStatus]):
+        self._states = {s.device_id: s for s in states}  # type: Dict[str, SwitchBotStatus]
+
+    @property
+    def dirty(self) -> bool:
+        return self._dirty
+
+    def set_write_hook(self, hook: Optional[Callable[['SwitchBotUserRepo'], None]]):
+        """copy-on-write: hook 會在用戶資料每次被修改之前呼叫，讓 datastore session 取得用戶 lock 並保存修改前的 snapshot"""
+        self._write_hook = hook
+
+    def mark_clean(self):
+        self._dirty = False
+
+    def _mark_dirty(self):
+        if self._write_hook is not None:
+            self._write_hook(self)
+        self._dirty = True
 
     def set_dev_ctrl_cmd_sent(self, dev_id: str, cmd: SwitchBotCommand):
         logger.debug(f"dev {dev_id}, cmd {cmd}")
         logger.warning(f"todo: set_dev_ctrl_cmd_sent")
         logger.debug(f"user device {self.devices}")
-        dev = next((d for d in self.devices if d.device_id == dev_id), None)
+        dev = self._devices.get(dev_id)
         if dev:
             if cmd.commandType == "command" and cmd.command in ["turnOn", "turnOff"]:
+                self._mark_dirty()
                 dev.target_state.update({"power": "on"} if cmd.command == "turnOn" else {"power": "off"})
             else:
                 raise NotImplementedError
@@ -330,12 +443,18 @@ class SwitchBotUserRepo:
 
     @classmethod
     def load(cls, data: dict):
-        _schema = SwitchBotUserRepoSchema()
-        return _schema.load(data)
+        return _user_repo_schema.load(data)
 
     def dump(self):
-        _schema = SwitchBotUserRepoSchema()
-        return _schema.dump(self)
+        return _user_repo_schema.dump(self)
+
+    @classmethod
+    def load_many(cls, data: List[dict]) -> List['SwitchBotUserRepo']:
+        return _user_repo_schema.load(data, many=True)
+
+    @classmethod
+    def dump_many(cls, users: Iterable['SwitchBotUserRepo']) -> List[dict]:
+        return _user_repo_schema.dump(users, many=True)
 
     def __eq__(self, other):
         if not isinstance(other, SwitchBotUserRepo):
@@ -354,98 +473,115 @@ class SwitchBotUserRepo:
         return self.devices
 
     def query(self, dev_id_list: List[str]) -> List[SwitchBotStatus]:
-        targets = [next((dev for dev in self.devices if dev.device_id == dev_id)) for dev_id in dev_id_list]
+        targets = [self._devices[dev_id] for dev_id in dev_id_list]
         return [dev.state for dev in targets]
 
     def report_state(self, state: SwitchBotStatus):
         """todo: target_state clean up"""
-        dev = next((dev for dev in self.devices if dev.device_id == state.device_id))
+        dev = self._devices[state.device_id]
+        self._mark_dirty()
         dev.state = state
         # for k in dev.target_state.keys():
         if dev.target_state:
             logger.warning("todo: dev target_state not clean up yet")
 
     def request_sync(self, devices: List[SwitchBotDevice]):
-        sync_dev_id_list = [dev.device_id for dev in devices]
-        user_dev_id_list = [dev.device_id for dev in self.devices]
+        sync_devices = {dev.device_id: dev for dev in devices}
         _is_user_dev_list_changed = False
-        for sync_dev_id in sync_dev_id_list:
-            if sync_dev_id in user_dev_id_list:
-                sync_dev = next((dev for dev in devices if dev.device_id == sync_dev_id), None)
-                user_dev = next((dev for dev in self.devices if dev.device_id == sync_dev_id), None)
-                if sync_dev != user_dev:  # device modified
-                    self._update_device(device=sync_dev)
-                    _is_user_dev_list_changed = True
-                else:  # device already exist
-                    pass
-            else:  # device new added
-                sync_dev = next((dev for dev in devices if dev.device_id == sync_dev_id), None)
-                self.devices.append(sync_dev)
+        for sync_dev_id, sync_dev in sync_devices.items():
+            user_dev = self._devices.get(sync_dev_id)
+            if user_dev is None:  # device new added
+                self._mark_dirty()
+                self._devices[sync_dev_id] = sync_dev
                 _is_user_dev_list_changed = True
-        for user_dev_id in user_dev_id_list:
-            if user_dev_id not in sync_dev_id_list:
-                self._remove_device(dev_id=user_dev_id)
+            elif sync_dev != user_dev:  # device modified
+                self._update_device(device=sync_dev)
                 _is_user_dev_list_changed = True
+            else:  # device already exist
+                pass
+        for user_dev_id in self._devices.keys() - sync_devices.keys():
+            self._remove_device(dev_id=user_dev_id)
+            _is_user_dev_list_changed = True
         self.events.append(events.UserDevListFetched(uid=self.uid))
         if _is_user_dev_list_changed:
             self.events.append(events.UserDevListChanged(uid=self.uid))
 
     def get_dev_by_id(self, dev_id) -> SwitchBotDevice:
-        return next((d for d in self.devices if d.device_id == dev_id), None)
+        return self._devices.get(dev_id)
 
     def get_dev_state(self, dev_id: str) -> SwitchBotStatus:
-        return next((s for s in self.states if s.device_id == dev_id), None)
+        return self._states.get(dev_id)
 
     def update_dev_state(self, state: SwitchBotStatus):
-        n, s = next(((n, s) for n, s in enumerate(self.states)
-                     if s.device_id == state.device_id), (None, None))
+        s = self._states.get(state.device_id)
         if s is None:
-            self.states.append(state)
+            self._mark_dirty()
+            self._states[state.device_id] = state
         else:
             if s != state:
+                self._mark_dirty()
                 self.events.append(events.UserDevStateChanged(uid=self.uid, dev_id=state.device_id))
-                del self.states[n]
-                self.states.append(state)
+                del self._states[state.device_id]
+                self._states[state.device_id] = state
             else:  # dev status report repeatedly
                 logger.debug(f"update dev state with same status, skip")
                 pass
 
     def add_change_report(self, change: SwitchBotChangeReport):
+        self._mark_dirty()
         self.changes.append(change)
         self.events.append(
-            events.UserDevReportChanged(dev_id=change.context.get("deviceMac"),
+            events.UserDevReportChanged(uid=self.uid, dev_id=change.context.get("deviceMac"),
                                         change=change.dump())
         )
 
+    def add_change_reports(self, changes: Iterable[SwitchBotChangeReport]):
+        """批次加入 change report，每個設備只產生一個 UserDevReportChanged (該設備最新的 change report)"""
+        latest = {}  # type: Dict[str, SwitchBotChangeReport]
+        for change in changes:
+            self._mark_dirty()
+            self.changes.append(change)
+            dev_id = change.context.get("deviceMac")
+            last = latest.get(dev_id)
+            if last is None or (change.context.get("timeOfSample") or 0) >= (last.context.get("timeOfSample") or 0):
+                latest[dev_id] = change
+        for dev_id, change in latest.items():
+            self.events.append(events.UserDevReportChanged(uid=self.uid, dev_id=dev_id, change=change.dump()))
+
     def get_dev_last_change_report(self, dev_id: str) -> SwitchBotChangeReport:
-        dev_c_report = [c for c in self.changes if c.context.get('deviceMac') == dev_id]
-        sorted_changes = sorted(dev_c_report, key=lambda c: c.context.get('timeOfSample'))
-        return sorted_changes[-1] if len(sorted_changes) else None
+        return self.changes.last(dev_id)
+
+    def get_dev_change_reports(self, dev_id: str, since: int = None, until: int = None
+                               ) -> List[SwitchBotChangeReport]:
+        return self.changes.range(dev_id, since=since, until=until)
 
     def disconnect(self):
-        for dev_id in [dev.device_id for dev in self.devices]:
+        for dev_id in list(self._devices):
             self._remove_device(dev_id=dev_id)
 
     def subscribe(self, subscriber_id: str):
+        if subscriber_id not in self.subscribers:
+            self._mark_dirty()
         self.subscribers.add(subscriber_id)
         logger.debug(f'user add subscriber {subscriber_id}, {self.subscribers}')
 
     def unsubscribe(self, subscriber_id: str):
+        if subscriber_id in self.subscribers:
+            self._mark_dirty()
         self.subscribers.remove(subscriber_id)
         logger.debug(f'user remove subscriber {subscriber_id}, {self.subscribers}')
 
     def _update_device(self, device: SwitchBotDevice):
-        index = next((n for n, origin in enumerate(self.devices) if origin.device_id == device.device_id),
-                     None)
-        if index:
-            self.devices[index] = device
+        if device.device_id in self._devices:
+            self._mark_dirty()
+            self._devices[device.device_id] = device
         else:
             raise ValueError(f'device({device}) not exist')
 
     def _remove_device(self, dev_id: str):
-        index = next((n for n, dev in enumerate(self.devices) if dev.device_id == dev_id), None)
-        if index is not None:
-            del self.devices[index]
+        if dev_id in self._devices:
+            self._mark_dirty()
+            del self._devices[dev_id]
         else:
             raise ValueError(f'device({dev_id}) not exist')
 
@@ -453,6 +589,7 @@ class SwitchBotUserRepo:
         self.events.append(events.UserRequestReload(uid=self.uid))
 
     def set_webhook_uri(self, uri):
+        self._mark_dirty()
         self.webhooks = [uri]
         self.events.append(events.UserWebhookUpdated(uid=self.uid))
 
@@ -574,12 +711,13 @@ class SwitchBotUserRepoSchema(Schema):
     uid = fields.String(data_key='userId')
     secret = fields.String(data_key='userSecret')
     token = fields.String(data_key='userToken')
-    devices = fields.List(fields.Nested(SwitchBotDeviceSchema()))
-    states = fields.List(fields.Nested(SwitchBotStatusSchema()))
-    changes = fields.List(fields.Nested(SwitchBotChangeReportSchema()))
+    devices = fields.Nested(SwitchBotDeviceSchema, many=True)
+    states = fields.Nested(SwitchBotStatusSchema, many=True)
+    changes = fields.Nested(SwitchBotChangeReportSchema, many=True)
     scenes = fields.List(fields.Str(), load_default=[])
     webhooks = fields.List(fields.Str(), load_default=[])
     subscribers = fields.List(fields.Str(), load_default=set())
+    version = fields.Integer(load_default=0)
 
     @post_load
     def make_user_repo(self, data, **kwargs):
@@ -588,7 +726,19 @@ class SwitchBotUserRepoSchema(Schema):
 
     @post_dump
     def remove_skip_values(self, data, **kwargs):
+        if data.get('subscribers') is not None:
+            # subscribers 是 set，排序後輸出，dump 結果不受 hash seed 影響
+            data['subscribers'] = sorted(data['subscribers'])
         return {
             key: value for key, value in data.items()
-            if value is not None
+            if value is not None and not (key == 'version' and value == 0)
         }
+
+
+# schema 在 module 載入時建立一次，各 load/dump 共用 (marshmallow schema 的 load/dump 不保存狀態，可多 thread 共用)
+_change_report_schema = SwitchBotChangeReportSchema()
+_status_schema = SwitchBotStatusSchema()
+_device_schema = SwitchBotDeviceSchema()
+_scene_schema = SwitchBotSceneSchema()
+_command_schema = SwitchBotCommandSchema()
+_user_repo_schema = SwitchBotUserRepoSchema()
@@ -6,7 +6,7 @@ import json
 # from switchbot import bootstrap
 from switchbot import config
 from switchbot.domain.model import SwitchBotDevice, SwitchBotStatus, SwitchBotScene
-from switchbot.adapters import iot_api_server
+from switchbot.adapters import iot_api_server, file_datastore
 from switchbot.adapters.iot_api_server import SwitchBotAPIServerError
 
 # from switchbot.service_layer import unit_of_work
@@ -286,6 +286,24 @@ def delete(url):
     click.echo(f'OK')
 
 
+# 'datastore' 子命令集
+@switchbotcli.group(help="Manage datastore files.")
+def datastore():
+    """Commands for the service datastore."""
+    pass
+
+
+@datastore.command()
+@click.argument('src')
+@click.argument('dst')
+@click.option('--format', 'snapshot_format', type=click.Choice(file_datastore.SNAPSHOT_FORMATS),
+              default=file_datastore.SNAPSHOT_BINARY, help="Snapshot format of DST.")
+def convert(src, dst, snapshot_format):
+    """Convert datastore snapshot SRC (json or binary) to DST."""
+    count = file_datastore.convert_snapshot(src, dst, snapshot_format)
+    click.echo(f"Converted {count} users to {snapshot_format} {dst}")
+
+
 # 程序入口
 if __name__ == '__main__':
     switchbotcli()
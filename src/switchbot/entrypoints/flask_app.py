@@ -1,3 +1,4 @@
+import atexit
 import logging
 import json
 import base64
@@ -6,19 +7,35 @@ from http import HTTPStatus
 import requests
 from flask import Flask, jsonify, request, url_for, redirect
 import logging.config as logging_config
-from switchbot.domain import commands
-from switchbot.service_layer import unit_of_work
-from switchbot.adapters import iot_api_server
+from switchbot.domain import commands, model
+from switchbot.service_layer import unit_of_work, change_batcher
+from switchbot.adapters import iot_api_server, iot_cache, quota, resilience
 from switchbot import bootstrap, views, config, gh_intent
 
 logging_config.dictConfig(config.logging_config)
 logger = logging.getLogger(__name__)
+model.SwitchBotChangeHistory.configure(*config.get_change_history_retention())
 app = Flask(__name__)
+api_quota = quota.RequestQuota(**config.get_switchbot_api_quota())
 bus = bootstrap.bootstrap(
-    uow=unit_of_work.JsonFileUnitOfWork(),
+    uow=unit_of_work.JsonFileUnitOfWork(
+        group_commit_window=config.get_datastore_group_commit_window(),
+        outbox=config.get_outbox_enabled(),
+        snapshot_format=config.get_datastore_snapshot_format()
+    ),
     start_orm=False,
-    iot=iot_api_server.SwitchBotApiServer()
+    iot=iot_cache.CachedIotApiServer(
+        iot_api_server.SwitchBotApiServer(quota=api_quota)
+    ),
+    event_workers=config.get_event_workers()
 )
+atexit.register(bus.close)
+atexit.register(api_quota.close)
+bus.replay_outbox()
+change_reports = change_batcher.ChangeReportBatcher(
+    bus=bus, window=config.get_change_batch_window()) if config.get_change_batch_window() > 0 else None
+if change_reports:
+    atexit.register(change_reports.close)
 
 
 class InvalidSrcServer(Exception):
@@ -56,6 +73,7 @@ def _check_api_access_token(http_request: requests.Request):
 
 @app.route('/fulfillment', methods=['POST'])
 def fulfillment():
+    deadline = resilience.Deadline(config.get_fulfillment_deadline())
     try:
         # check request access token
         token = _check_api_access_token(http_request=request)
@@ -97,38 +115,42 @@ def fulfillment():
             gh_execute_dto = gh_intent.ExecuteRequest.load(post_data)
             assert isinstance(gh_execute_dto, gh_intent.ExecuteRequest)
             assert len(gh_execute_dto.inputs) == 1
-            _responses_dto = []
+            _dev_cmds = []
+            _dev_states = {}
             for cmd_dto in gh_execute_dto.inputs[0].payload.commands:
                 assert isinstance(cmd_dto, gh_intent.ExecuteCmdItem)
                 for cmd_exec_dto in cmd_dto.execution[:1]:
                     logger.debug(f"cmd_exec_dto type {type(cmd_exec_dto)}")
                     assert isinstance(cmd_exec_dto, gh_intent.ExecuteCmdExecItem)
                     if cmd_exec_dto.command == "action.devices.commands.OnOff":
-                        _cmd_type = 'command'
                         _cmd_value = 'turnOn' if cmd_exec_dto.params.get("on") else 'turnOff'
-                        _cmd_param = 'default'
-                        cmd_devs_dto = cmd_dto.devices
-                        for cmd_dev_dto in cmd_devs_dto:
-                            cmd = commands.SendDevCtrlCmd(
-                                uid=uid,
-                                subscriber_id=subscriber_id,
+                        for cmd_dev_dto in cmd_dto.devices:
+                            _dev_cmds.append(commands.DevCtrlCmd(
                                 dev_id=cmd_dev_dto.id,
-                                cmd_type=_cmd_type,
+                                cmd_type='command',
                                 cmd_value=_cmd_value,
-                                cmd_param=_cmd_param
-                            )
-                            bus.handle(cmd)
-                            _cmd_resp_dto = gh_intent.ExecuteCommandResponseItem(
-                                ids=[f"{cmd_dev_dto.id}"],
-                                status="PENDING",
-                                states={
-                                    "online": True,
-                                    "on": True if cmd_exec_dto.params.get("on") else False
-                                }
-                            )
-                            _responses_dto.append(_cmd_resp_dto)
+                                cmd_param='default'
+                            ))
+                            _dev_states[cmd_dev_dto.id] = {
+                                "online": True,
+                                "on": True if cmd_exec_dto.params.get("on") else False
+                            }
                     else:
                         raise NotImplementedError
+            # 所有設備指令一次驗證、同時送出並一次 commit，deadline 之前未完成的回報 PENDING
+            results = bus.handle(commands.SendDevCtrlCmds(
+                uid=uid,
+                subscriber_id=subscriber_id,
+                cmds=_dev_cmds
+            ), deadline=deadline)
+            _responses_dto = [
+                gh_intent.ExecuteCommandResponseItem(
+                    ids=[result.dev_id],
+                    status=result.status,
+                    states=_dev_states[result.dev_id] if result.status != model.SwitchBotCommandResult.ERROR else None,
+                    errorCode=result.error_code
+                ) for result in results
+            ]
             response = gh_intent.ExecuteResponse(
                 requestId=gh_execute_dto.requestId,
                 payload=gh_intent.ExecuteResponsePayload(
@@ -139,7 +161,7 @@ def fulfillment():
             return jsonify(response), HTTPStatus.OK
         elif intent_id == "action.devices.DISCONNECT":
             cmd = commands.Unsubscribe(uid=uid, subscriber_id=subscriber_id)
-            bus.handle(cmd)
+            bus.handle(cmd, deadline=deadline)
             logger.info(f"FULFILLMENT {request_id}")
             return jsonify({}), HTTPStatus.OK
         else:
@@ -162,8 +184,11 @@ def report_change():
         if not isinstance(data, dict):
             return jsonify({}), HTTPStatus.BAD_REQUEST
 
-        cmd = commands.ReportChange(change=request.json)
-        bus.handle(cmd)
+        if change_reports:
+            change_reports.submit(data)
+        else:
+            cmd = commands.ReportChange(change=data)
+            bus.handle(cmd)
         return jsonify({}), HTTPStatus.OK
 
     except ApiAccessTokenError:
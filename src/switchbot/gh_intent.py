@@ -107,10 +107,10 @@ class ExecuteRequest:
 
     @classmethod
     def load(cls, data: dict):
-        return ExecuteRequestSchema().load(data)
+        return _execute_request_schema.load(data)
 
     def dump(self) -> dict:
-        return ExecuteRequestSchema().dump(self)
+        return _execute_request_schema.dump(self)
 
 
 # 以下為 Response 部分
@@ -180,10 +180,10 @@ class ExecuteResponse:
 
     @classmethod
     def load(cls, data: dict):
-        return ExecuteResponseSchema().load(data)
+        return _execute_response_schema.load(data)
 
     def dump(self) -> dict:
-        return ExecuteResponseSchema().dump(self)
+        return _execute_response_schema.dump(self)
 
 
 class QueryDeviceItemSchema(Schema):
@@ -254,10 +254,10 @@ class QueryRequest:
 
     @classmethod
     def load(cls, data: dict):
-        return QueryRequestSchema().load(data)
+        return _query_request_schema.load(data)
 
     def dump(self) -> dict:
-        return QueryRequestSchema().dump(self)
+        return _query_request_schema.dump(self)
 
 
 class QueryDeviceStatusSchema(Schema):
@@ -331,10 +331,10 @@ class QueryResponse:
 
     @classmethod
     def load(cls, data: dict):
-        return QueryResponseSchema().load(data)
+        return _query_response_schema.load(data)
 
     def dump(self) -> dict:
-        return QueryResponseSchema().dump(self)
+        return _query_response_schema.dump(self)
 
 
 class SyncInputSchema(Schema):
@@ -368,10 +368,10 @@ class SyncRequest:
 
     @classmethod
     def load(cls, data: dict):
-        return SyncRequestSchema().load(data)
+        return _sync_request_schema.load(data)
 
     def dump(self) -> dict:
-        return SyncRequestSchema().dump(self)
+        return _sync_request_schema.dump(self)
 
 
 class SyncDeviceInfoSchema(Schema):
@@ -519,10 +519,10 @@ class SyncDevice:
 
     @classmethod
     def load(cls, data: dict):
-        return SyncResponseSchema().load(data)
+        return _sync_response_schema.load(data)
 
     def dump(self) -> dict:
-        return SyncResponseSchema().dump(self)
+        return _sync_response_schema.dump(self)
 
 
 class SyncResponsePayload:
@@ -541,7 +541,16 @@ class SyncResponse:
 
     @classmethod
     def load(cls, data: dict):
-        return SyncResponseSchema().load(data)
+        return _sync_response_schema.load(data)
 
     def dump(self) -> dict:
-        return SyncResponseSchema().dump(self)
+        return _sync_response_schema.dump(self)
+
+
+# intent request/response 共用的 schema instance
+_execute_request_schema = ExecuteRequestSchema()
+_execute_response_schema = ExecuteResponseSchema()
+_query_request_schema = QueryRequestSchema()
+_query_response_schema = QueryResponseSchema()
+_sync_request_schema = SyncRequestSchema()
+_sync_response_schema = SyncResponseSchema()
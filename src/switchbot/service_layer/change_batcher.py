@@ -0,0 +1,63 @@
+"""
+webhook change report 批次處理
+
+/change webhook 只把 change report 放進 ChangeReportBatcher 就回應，
+batcher 是所有設備共用的批次 window (不是個別設備的 debounce)：
+收到第一筆 change report 後等待固定的 window 秒 (之後收到的 change report 不會延長 window)，
+或累積到 max_batch 筆時，把期間所有設備的 change report 以一個 commands.ReportChanges 交給 message bus 處理；
+同一設備在同一批中的多筆 change report 由 handler 合併為一次狀態更新
+"""
+import threading
+import logging
+from typing import List
+from switchbot.domain import commands
+
+logger = logging.getLogger(__name__)
+
+
+class ChangeReportBatcher:
+    """
+    所有設備共用一個批次 window，window 到期時在 threading.Timer 的 thread 中呼叫 bus.handle，
+    累積到 max_batch 筆時則在 submit 的 thread 中處理；flush 依序執行，同一時間只有一批在處理
+    """
+    def __init__(self, bus, window: float = 0.2, max_batch: int = 500):
+        self.bus = bus
+        self.window = window
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = []  # type: List[dict]
+        self._timer = None  # type: threading.Timer
+        self.batches = 0
+
+    def submit(self, change: dict):
+        with self._lock:
+            self._pending.append(change)
+            if len(self._pending) >= self.max_batch:
+                flush_now = True
+            else:
+                flush_now = False
+                if self._timer is None:
+                    self._timer = threading.Timer(self.window, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if flush_now:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            changes, self._pending = self._pending, []
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if not changes:
+            return
+        with self._flush_lock:
+            try:
+                self.bus.handle(commands.ReportChanges(changes=changes))
+                self.batches += 1
+            except Exception:
+                logger.exception(f"handle {len(changes)} change reports fail")
+
+    def close(self):
+        self.flush()
@@ -1,15 +1,35 @@
+import contextvars
+import functools
 import logging
-from typing import List, Dict, Callable, Type  # , TYPE_CHECKING
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import List, Dict, Callable, Optional, Type  # , TYPE_CHECKING
 from switchbot import config
 from switchbot.domain import commands, events, model
-from switchbot.adapters import iot_api_server
+from switchbot.adapters import iot_api_server, resilience
 # if TYPE_CHECKING:
 #     from . import unit_of_work
 from . import unit_of_work
+from .messagebus import no_conflict_retry
 
 logger = logging.getLogger(__name__)
 
+_dev_ctrl_executor = None  # type: Optional[ThreadPoolExecutor]
+_dev_ctrl_executor_guard = threading.Lock()
 
+
+def _get_dev_ctrl_executor() -> ThreadPoolExecutor:
+    """所有 EXECUTE 共用的設備控制 thread pool，同時送出的指令不超過 config.get_dev_ctrl_concurrency()"""
+    global _dev_ctrl_executor
+    with _dev_ctrl_executor_guard:
+        if _dev_ctrl_executor is None:
+            _dev_ctrl_executor = ThreadPoolExecutor(max_workers=config.get_dev_ctrl_concurrency(),
+                                                    thread_name_prefix='dev-ctrl')
+        return _dev_ctrl_executor
+
+
+# 指令送出之後才記錄目標狀態，重新執行 handler 會重複送出指令
+@no_conflict_retry
 def send_dev_ctrl_cmd(
         cmd: commands.SendDevCtrlCmd,
         uow: unit_of_work.AbstractUnitOfWork,
@@ -40,6 +60,99 @@ def send_dev_ctrl_cmd(
         pass
 
 
+def _dev_ctrl_error_code(err: BaseException) -> str:
+    if isinstance(err, (iot_api_server.SwitchBotAPIRetryableError, iot_api_server.SwitchBotAPIQuotaExceeded,
+                        iot_api_server.SwitchBotAPICircuitOpen)):
+        return 'transientError'
+    return 'hardError'
+
+
+@no_conflict_retry
+def send_dev_ctrl_cmds(
+        cmd: commands.SendDevCtrlCmds,
+        uow: unit_of_work.AbstractUnitOfWork,
+        iot: iot_api_server.AbstractIotApiServer,
+        publish: Callable[[events.Event], None]
+) -> List[model.SwitchBotCommandResult]:
+    """
+    用戶與訂閱者只驗證一次，以共用的設備控制 thread pool 同時送出所有設備控制指令，
+    目前的 deadline (沒有 deadline 時為 cmd.timeout 秒) 之前完成的回報 SUCCESS / ERROR，
+    deadline 之前開始的指令在 handler 的 context 中送出 (timeout 縮短為 deadline 剩餘時間)，
+    未完成的回報 PENDING，deadline 之後才輪到的指令在背景繼續送出 (不受 deadline 限制)；
+    只有 SUCCESS 設備的目標狀態一次寫入並 commit，PENDING 設備的指令結果未知，不記錄目標狀態，
+    背景完成後 publish UserDevCtrlCmdCompleted 更新設備狀態，失敗只記錄 log；結果依 cmd.cmds 順序回傳；
+    與送出指令同時的其他修改造成 ConcurrentUpdateError 時，bus 不重新執行 (指令已送出)
+    """
+    deadline = resilience.current_deadline()
+    with uow:
+        u = uow.users.get_by_uid(uid=cmd.uid)
+        if u is None:
+            raise ValueError(f"uid {cmd.uid} not exist in users")
+        if cmd.subscriber_id not in u.subscribers:
+            raise ValueError(f"subscriber {cmd.subscriber_id} not in user {cmd.uid} subscribers")
+        secret, token = u.secret, u.token
+        dev_cmds = [c for c in cmd.cmds if u.get_dev_by_id(c.dev_id) is not None]
+        # finished/errors/pending 以 lock 保護，指令完成與回報 PENDING 之間不會遺漏背景完成的通知
+        lock = threading.Lock()
+        finished, pending = set(), set()
+        errors = {}  # type: Dict[int, BaseException]
+
+        def _send(dev_cmd: commands.DevCtrlCmd, context: contextvars.Context):
+            error = None
+            try:
+                call = iot.send_dev_ctrl_cmd
+                if deadline is not None and not deadline.expired:
+                    # worker thread 不會繼承 contextvars，以 handler 的 context 執行才能取得 deadline
+                    call = functools.partial(context.run, call)
+                call(secret=secret, token=token, dev_id=dev_cmd.dev_id,
+                     cmd_type=dev_cmd.cmd_type, cmd_value=dev_cmd.cmd_value, cmd_param=dev_cmd.cmd_param)
+            except Exception as err:
+                error = err
+                logger.warning(f"user {cmd.uid} device {dev_cmd.dev_id} ctrl cmd fail, {type(err).__name__}: {err}")
+            with lock:
+                finished.add(id(dev_cmd))
+                if error is not None:
+                    errors[id(dev_cmd)] = error
+                completed_late = id(dev_cmd) in pending
+            if completed_late and error is None:
+                publish(events.UserDevCtrlCmdCompleted(uid=cmd.uid, dev_id=dev_cmd.dev_id))
+
+        if dev_cmds:
+            executor = _get_dev_ctrl_executor()
+            # 同一個 Context 不能同時在多個 thread 執行，每個指令各自複製一份
+            futures = [executor.submit(_send, c, contextvars.copy_context()) for c in dev_cmds]
+            # 不等待 PENDING 的指令
+            wait(futures, timeout=deadline.remaining() if deadline else cmd.timeout)
+
+        results = []
+        with lock:
+            for dev_cmd in cmd.cmds:
+                error_code = None
+                if u.get_dev_by_id(dev_cmd.dev_id) is None:
+                    status, error_code = model.SwitchBotCommandResult.ERROR, 'deviceNotFound'
+                elif id(dev_cmd) not in finished:
+                    status = model.SwitchBotCommandResult.PENDING
+                    pending.add(id(dev_cmd))
+                elif id(dev_cmd) in errors:
+                    status = model.SwitchBotCommandResult.ERROR
+                    error_code = _dev_ctrl_error_code(errors[id(dev_cmd)])
+                else:
+                    status = model.SwitchBotCommandResult.SUCCESS
+                results.append(model.SwitchBotCommandResult(dev_id=dev_cmd.dev_id, status=status,
+                                                            error_code=error_code))
+        for dev_cmd, result in zip(cmd.cmds, results):
+            if result.status == model.SwitchBotCommandResult.SUCCESS:
+                u.set_dev_ctrl_cmd_sent(
+                    dev_id=dev_cmd.dev_id,
+                    cmd=model.SwitchBotCommand(
+                        commandType=dev_cmd.cmd_type,
+                        command=dev_cmd.cmd_value,
+                        parameter=dev_cmd.cmd_param)
+                )
+        uow.commit()
+    return results
+
+
 def report_state(
         cmd: commands.ReportState,
         uow: unit_of_work.AbstractUnitOfWork
@@ -93,6 +206,34 @@ def report_change(
         uow.commit()
 
 
+def report_changes(
+        cmd: commands.ReportChanges,
+        uow: unit_of_work.AbstractUnitOfWork
+):
+    """
+    批次寫入 change report，整批只 commit 一次，每個設備只觸發一次狀態更新，
+    找不到設備的 change report 記錄 log 後略過，不影響同批其他 change report
+    """
+    with uow:
+        user_changes = {}  # type: Dict[str, List[model.SwitchBotChangeReport]]
+        users = {}  # type: Dict[str, model.SwitchBotUserRepo]
+        for change in cmd.changes:
+            dev_id = change.get("context", {}).get("deviceMac", None)
+            u = uow.users.get_by_dev_id(dev_id=dev_id) if dev_id else None
+            if u is None:
+                logger.warning(f"dev_id {dev_id} not exist in users, skip change {change}")
+                continue
+            users[u.uid] = u
+            user_changes.setdefault(u.uid, []).append(model.SwitchBotChangeReport(
+                event_type=change.get("eventType"),
+                event_version=change.get("eventVersion"),
+                context=change.get("context")
+            ))
+        for uid, changes in user_changes.items():
+            users[uid].add_change_reports(changes)
+        uow.commit()
+
+
 def request_sync(
         cmd: commands.RequestSync,
         uow: unit_of_work.AbstractUnitOfWork
@@ -200,13 +341,28 @@ def fetch_user_dev_all_states(
         uow: unit_of_work.AbstractUnitOfWork,
         iot: iot_api_server.AbstractIotApiServer
 ):
+    """
+    以 config.get_dev_state_fetch_concurrency() 個 thread 同時查詢用戶所有設備狀態，
+    單一設備查詢失敗只記錄 log 不影響其他設備，查詢結果依設備順序一次寫入並 commit
+    """
     with uow:
         u = uow.users.get_by_uid(uid=event.uid)
-        for d in u.devices:
-            u.update_dev_state(
-                state=iot.get_dev_status(
-                    secret=u.secret, token=u.token, dev_id=d.device_id)
-            )
+        dev_ids = [d.device_id for d in u.devices]
+
+        def _get_dev_status(dev_id: str):
+            try:
+                return iot.get_dev_status(secret=u.secret, token=u.token, dev_id=dev_id)
+            except Exception as err:
+                logger.warning(f"fetch user {u.uid} device {dev_id} state fail, {type(err).__name__}: {err}")
+                return None
+
+        if dev_ids:
+            with ThreadPoolExecutor(max_workers=min(config.get_dev_state_fetch_concurrency(), len(dev_ids)),
+                                    thread_name_prefix='dev-state') as executor:
+                states = list(executor.map(_get_dev_status, dev_ids))
+            for state in states:
+                if state is not None:
+                    u.update_dev_state(state=state)
         # u.events.append(events.UserDevStatesAllFetched(uid=u.uid))
         uow.commit()
 
@@ -235,11 +391,27 @@ def fetch_user_dev_state(
         iot: iot_api_server.AbstractIotApiServer
 ):
     with uow:
-        u = uow.users.get_by_dev_id(dev_id=event.dev_id)
-        u.update_dev_state(
-            state=iot.get_dev_status(
-                secret=u.secret, token=u.token, dev_id=event.dev_id)
-        )
+        u = uow.users.get_by_uid(uid=event.uid)
+        state = iot.apply_change_report(dev_id=event.dev_id, context=event.change.get('context', {}))
+        if state is None:
+            state = iot.get_dev_status(secret=u.secret, token=u.token, dev_id=event.dev_id)
+        u.update_dev_state(state=state)
+        uow.commit()
+
+
+def refresh_user_dev_state(
+        event: events.UserDevCtrlCmdCompleted,
+        uow: unit_of_work.AbstractUnitOfWork,
+        iot: iot_api_server.AbstractIotApiServer
+):
+    """背景完成的設備控制指令，重新查詢設備狀態，狀態有變更時經由 UserDevStateChanged 通知訂閱者"""
+    with uow:
+        u = uow.users.get_by_uid(uid=event.uid)
+        if u is None:
+            return
+        state = iot.get_dev_status(secret=u.secret, token=u.token, dev_id=event.dev_id)
+        if state is not None:
+            u.update_dev_state(state=state)
         uow.commit()
 
 
@@ -273,6 +445,7 @@ EVENT_HANDLERS = {
     events.UserDevListFetched: [setup_user_switchbot_webhook],
     events.UserWebhookUpdated: [fetch_user_dev_all_states],
     events.UserDevReportChanged: [fetch_user_dev_state],
+    events.UserDevCtrlCmdCompleted: [refresh_user_dev_state],
     events.UserDevStateChanged: [notify_subscriber_user_dev_state_changed],
     events.UserDevListChanged: [notify_subscriber_user_dev_list_changed],
 }  # type: Dict[Type[events.Event], List[Callable]]
@@ -285,6 +458,8 @@ COMMAND_HANDLERS = {
     commands.RequestSync: request_sync,
     commands.ReportState: report_state,
     commands.ReportChange: report_change,
+    commands.ReportChanges: report_changes,
     commands.SendDevCtrlCmd: send_dev_ctrl_cmd,
+    commands.SendDevCtrlCmds: send_dev_ctrl_cmds,
     commands.Disconnect: unlink_user,
 }  # type: Dict[Type[commands.Command], Callable]
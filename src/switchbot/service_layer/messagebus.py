@@ -1,7 +1,14 @@
 """"""
-from switchbot.domain import commands, events
+from switchbot.domain import commands, events, model
+from switchbot.adapters.resilience import Deadline
+import contextlib
 import logging
-from typing import Callable, Dict, List, Union, Type, TYPE_CHECKING
+import queue
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple, Union, Type, TYPE_CHECKING
 # if TYPE_CHECKING:
 #     from . import unit_of_work
 from . import unit_of_work
@@ -11,45 +18,222 @@ logger = logging.getLogger(__name__)
 Message = Union[commands.Command, events.Event]
 
 
+@dataclass
+class MessageTrace:
+    """一次 handler 執行的紀錄，交給 MessageBus tracer"""
+    message: Message
+    handler: str
+    duration: float
+    spawned: int
+    outcome: str  # 'ok' or 'error'
+    error: Optional[BaseException] = None
+
+
+class EventDispatcher:
+    """
+    event 交給背景 worker thread 處理，依 event 的 uid 固定分派到同一個 worker，
+    同一個 key 的 event (包含 handler 再產生的 event) 依序處理
+    """
+
+    def __init__(self, handle: Callable[[events.Event], List[Message]], workers: int):
+        self._handle = handle
+        self._queues = [queue.Queue() for _ in range(workers)]  # type: List[queue.Queue]
+        self._unfinished = 0
+        self._cond = threading.Condition()
+        self._threads = [
+            threading.Thread(target=self._run, args=(q,), name=f'event-worker-{n}', daemon=True)
+            for n, q in enumerate(self._queues)
+        ]
+        for t in self._threads:
+            t.start()
+
+    @staticmethod
+    def _key(event: events.Event):
+        return event.uid
+
+    def dispatch(self, event: events.Event):
+        with self._cond:
+            self._unfinished += 1
+        self._queues[hash(self._key(event)) % len(self._queues)].put(event)
+
+    def _run(self, q: queue.Queue):
+        while True:
+            event = q.get()
+            if event is None:
+                break
+            try:
+                for message in self._handle(event):
+                    if isinstance(message, events.Event):
+                        self.dispatch(message)
+                    else:
+                        logger.error(f"{message} was not an Event, drop")
+            except Exception:
+                logger.exception("Exception dispatching event %s", event)
+            finally:
+                with self._cond:
+                    self._unfinished -= 1
+                    self._cond.notify_all()
+
+    def join(self, timeout: float = None) -> bool:
+        """等待所有已分派的 event (包含後續產生的 event) 處理完畢"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._unfinished == 0, timeout=timeout)
+
+    def close(self, timeout: float = None):
+        self.join(timeout=timeout)
+        for q in self._queues:
+            q.put(None)
+        for t in self._threads:
+            t.join(timeout=timeout)
+
+
+def no_conflict_retry(handler: Callable) -> Callable:
+    """標記有對外副作用 (例如送出設備控制指令) 的 handler，遇到 ConcurrentUpdateError 時 bus 不重新執行"""
+    handler.conflict_retry = False
+    return handler
+
+
 class MessageBus:
-    queue: List[Message]
+    """
+    command 在呼叫端 thread 同步處理並回傳 exception；
+    event_workers 大於 0 時，event 改由 EventDispatcher 在背景 worker thread 處理，handle 只需等待 command 完成
+    每次 handle 使用自己的 message queue，多個 thread 可以同時呼叫 handle；
+    tracer 會收到每個 handler 執行的 MessageTrace (訊息類型、handler、耗時、產生的 event 數、結果)；
+    handler 遇到 model.ConcurrentUpdateError (用戶同時被其他 uow 修改) 時最多重試 conflict_retries 次，
+    以 no_conflict_retry 標記的 handler 不重試，直接拋出 exception
+    """
+    conflict_retries = 3
 
     def __init__(
             self,
             uow: unit_of_work.AbstractUnitOfWork,
             event_handlers: Dict[Type[events.Event], List[Callable]],
             command_handlers: Dict[Type[commands.Command], Callable],
+            event_workers: int = 0,
+            tracer: Callable[[MessageTrace], None] = None,
     ):
         self.uow = uow
+        self.tracer = tracer
         self.event_handlers = event_handlers
         self.command_handlers = command_handlers
+        self.dispatcher = EventDispatcher(self.handle_event, event_workers) if event_workers > 0 else None
 
-    def handle(self, message: Message):
-        self.queue = [message]  # type:List[Message]
-        while self.queue:
-            message = self.queue.pop(0)
+    def handle(self, message: Message, deadline: Deadline = None) -> Any:
+        """
+        處理 message 及其後續產生的 event，message 為 command 時回傳該 command handler 的回傳值；
+        有 deadline 時 command handler 在 deadline.scope() 之中執行，後續的 event 不受 deadline 限制
+        """
+        result = None
+        message_queue = deque([message])  # type: Deque[Message]
+        while message_queue:
+            message = message_queue.popleft()
             logger.info(f"handling msg {message} ...")
             if isinstance(message, events.Event):
-                self.handle_event(message)
+                if self.dispatcher:
+                    self.dispatcher.dispatch(message)
+                else:
+                    message_queue.extend(self.handle_event(message))
             elif isinstance(message, commands.Command):
-                self.handle_command(message)
+                with deadline.scope() if deadline else contextlib.nullcontext():
+                    command_result, spawned = self.handle_command(message)
+                if result is None:
+                    result = command_result
+                message_queue.extend(spawned)
             else:
                 raise Exception(f"{message} was not an Event or Command")
+        return result
+
+    def join(self, timeout: float = None) -> bool:
+        """等待背景處理中的 event 完成"""
+        return self.dispatcher.join(timeout=timeout) if self.dispatcher else True
 
-    def handle_event(self, event: events.Event):
+    def close(self, timeout: float = None):
+        if self.dispatcher:
+            self.dispatcher.close(timeout=timeout)
+
+    def _call(self, handler: Callable, message: Message):
+        retries = self.conflict_retries if getattr(handler, 'conflict_retry', True) else 0
+        for attempt in range(retries + 1):
+            try:
+                return handler(message)
+            except model.ConcurrentUpdateError:
+                if attempt == retries:
+                    raise
+                logger.warning(f"concurrent update handling {message}, retry {attempt + 1}")
+
+    def _trace(self, message: Message, handler: Callable, started: float, spawned: int,
+               error: BaseException = None):
+        if self.tracer is None:
+            return
+        try:
+            self.tracer(MessageTrace(
+                message=message,
+                handler=getattr(handler, '__qualname__', repr(handler)),
+                duration=time.perf_counter() - started,
+                spawned=spawned,
+                outcome='ok' if error is None else 'error',
+                error=error
+            ))
+        except Exception:
+            logger.exception("Exception tracing message %s", message)
+
+    def handle_event(self, event: events.Event) -> List[Message]:
+        """
+        執行 event 的所有 handler，回傳 handler 產生的新 event，handler exception 只記錄 log；
+        event 來自 outbox 時，已 ack 的 handler 不再執行，全部 handler 成功才標記 done，失敗的留待 replay
+        """
+        outbox = self.uow.outbox if event.outbox_id else None
+        new_events = []
+        succeeded = True
         for handler in self.event_handlers[type(event)]:
+            key = getattr(handler, '__qualname__', repr(handler))
+            if outbox and outbox.is_acked(event.outbox_id, key):
+                continue
+            started = time.perf_counter()
             try:
-                handler(event)
-                self.queue.extend(self.uow.collect_new_events())
-            except Exception:
+                self._call(handler, event)
+                spawned = list(self.uow.collect_new_events())
+            except Exception as err:
                 logger.exception("Exception handling event %s", event)
+                self._trace(event, handler, started, 0, err)
+                succeeded = False
                 continue
+            if outbox:
+                outbox.ack(event.outbox_id, key)
+            self._trace(event, handler, started, len(spawned))
+            new_events.extend(spawned)
+        if outbox and succeeded:
+            outbox.done(event.outbox_id)
+        return new_events
 
-    def handle_command(self, command: commands.Command):
+    def replay_outbox(self) -> int:
+        """
+        重新處理 outbox 中尚未完成的 event，回傳 event 數
+        只在啟動時呼叫 (bus 開始處理新的 message 之前)，執行中失敗的 event 要等下次啟動才會 replay
+        """
+        if self.uow.outbox is None:
+            return 0
+        pending = self.uow.outbox.pending()
+        for _, event in pending:
+            logger.info(f"replay outbox event {event}")
+            if self.dispatcher:
+                self.dispatcher.dispatch(event)
+            else:
+                self.handle(event)
+        return len(pending)
+
+    def handle_command(self, command: commands.Command) -> Tuple[Any, List[Message]]:
+        """執行 command handler，回傳 handler 的回傳值與產生的新 event，handler exception 往上拋"""
+        handler = self.command_handlers.get(type(command))
+        started = time.perf_counter()
         try:
-            handler = self.command_handlers[type(command)]
-            handler(command)
-            self.queue.extend(self.uow.collect_new_events())
-        except Exception:
+            if handler is None:
+                raise KeyError(type(command))
+            result = self._call(handler, command)
+            spawned = list(self.uow.collect_new_events())
+        except Exception as err:
             logger.exception("Exception handling command %s", command)
+            self._trace(command, handler, started, 0, err)
             raise
+        self._trace(command, handler, started, len(spawned))
+        return result, spawned
@@ -1,16 +1,42 @@
 # pylint: disable=attribute-defined-outside-init
 from __future__ import annotations
 import abc
-import os
-import shutil
 import logging
-from switchbot.adapters import repository, file_datastore
+import threading
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, Session
+from switchbot import config
+from typing import List, Optional
+from switchbot.adapters import repository, file_datastore, outbox as event_outbox
+from switchbot.domain import events
 
 logger = logging.getLogger(__name__)
 
 
+class _ThreadLocal:
+    """uow 的 transaction 狀態 (session/users) 依 thread 區分，同一個 uow instance 可以同時在多個 thread 使用"""
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        try:
+            return getattr(obj._thread_state(), self.name)
+        except AttributeError:
+            raise AttributeError(self.name) from None
+
+    def __set__(self, obj, value):
+        setattr(obj._thread_state(), self.name, value)
+
+
 class AbstractUnitOfWork(abc.ABC):
     users: repository.AbstractRepository
+    outbox = None  # type: Optional[event_outbox.FileOutbox]
+
+    def _thread_state(self) -> threading.local:
+        return self.__dict__.setdefault('_local', threading.local())
 
     def __enter__(self) -> AbstractUnitOfWork:
         return self
@@ -19,7 +45,21 @@ class AbstractUnitOfWork(abc.ABC):
         self.rollback()
 
     def commit(self):
+        """
+        有 outbox 時，commit 成功之後才把用戶產生的 event 寫入 outbox，commit 失敗的 event 不會被 replay；
+        process 在 commit 與寫入 outbox 之間中斷時，該次的 event 不會 replay
+        """
+        new_events = self._uncommitted_events() if self.outbox else []
         self._commit()
+        if new_events:
+            try:
+                self.outbox.add(new_events)
+            except OSError:
+                # datastore 已 commit，event 仍在這個 process 中處理，只是中斷後無法 replay
+                logger.exception(f'failed to write {len(new_events)} events to outbox {self.outbox.file}')
+
+    def _uncommitted_events(self) -> List[events.Event]:
+        return [e for u in self.users.seen for e in u.events if e.outbox_id is None]
 
     def collect_new_events(self):
         for u in self.users.seen:
@@ -37,31 +77,46 @@ class AbstractUnitOfWork(abc.ABC):
 
 
 class JsonFileUnitOfWork(AbstractUnitOfWork):
-    def __init__(self, json_file='.datastore'):
+    """
+    datastore 常駐於 process 之中，每個 uow 只取得一個 transactional view (DatastoreSession)，
+    唯讀的 uow 不會讀寫 datastore 檔案；rollback 只需丟棄 view 中的用戶複本。
+    journal=True 時使用 append-only journal datastore，commit 只寫入有變動的用戶；
+    group_commit_window (秒) 大於 0 時，window 之內多個 uow 的 commit 合併成一次 fsync 寫入；
+    outbox=True 時 commit 的 event 寫入 {json_file}.outbox，未完成的 event 只在啟動時 (MessageBus.replay_outbox) replay；
+    snapshot_format='binary' 時 snapshot 以 length-prefixed binary record 格式寫入 (檔案較小、寫入較快，讀取稍慢；讀取時自動判斷格式)
+    """
+    session = _ThreadLocal()  # type: file_datastore.DatastoreSession
+    users = _ThreadLocal()  # type: repository.JsonFileRepository
+
+    def __init__(self, json_file='.datastore', journal: bool = False, group_commit_window: float = 0.0,
+                 outbox: bool = False, snapshot_format: str = file_datastore.SNAPSHOT_JSON):
         super().__init__()
+        if snapshot_format not in file_datastore.SNAPSHOT_FORMATS:
+            raise ValueError(f'unknown snapshot format {snapshot_format}')
         self._json_file = json_file
-        self._origin = f'{json_file}.swap'
+        self._snapshot_format = snapshot_format
+        self.outbox = event_outbox.get_outbox(f'{json_file}.outbox') if outbox else None
+        self._journal = journal
+        self._group_commit_window = group_commit_window
         self.session_factory = file_datastore.session_factory
 
     def __enter__(self):
-        if os.path.exists(self._json_file):
-            shutil.copyfile(self._json_file, self._origin)
-        self.session = self.session_factory(self._json_file)
+        self.session = self.session_factory(
+            self._json_file, journal=self._journal, group_commit_window=self._group_commit_window,
+            snapshot_format=self._snapshot_format)
         self.users = repository.JsonFileRepository(self.session)
         # self.api_server = FakeApiServer()
         return super().__enter__()
 
     def __exit__(self, *args):
-        if os.path.exists(self._origin):
-            os.remove(self._origin)
         super().__exit__(*args)
+        self.session.close()
 
     def _commit(self):
         self.session.commit()
 
     def rollback(self):
-        if os.path.exists(self._origin):
-            shutil.copyfile(self._origin, self._json_file)
+        self.session.rollback()
 
 
 class MemoryUnitOfWork(AbstractUnitOfWork):
@@ -99,29 +154,41 @@ class MemoryUnitOfWork(AbstractUnitOfWork):
 #         if os.path.exists(self._origin):
 #             shutil.copyfile(self._origin, self._file)
 
-# DEFAULT_SESSION_FACTORY = sessionmaker(
-#     bind=create_engine(
-#         config.get_postgres_uri(),
-#         isolation_level="REPEATABLE READ",
-#     )
-# )
-#
-#
-# class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
-#     def __init__(self, session_factory=DEFAULT_SESSION_FACTORY):
-#         self.session_factory = session_factory
-#
-#     def __enter__(self):
-#         self.session = self.session_factory()  # type: Session
-#         self.products = repository.SqlAlchemyRepository(self.session)
-#         return super().__enter__()
-#
-#     def __exit__(self, *args):
-#         super().__exit__(*args)
-#         self.session.close()
-#
-#     def _commit(self):
-#         self.session.commit()
-#
-#     def rollback(self):
-#         self.session.rollback()
+
+_default_session_factory = None  # type: Optional[sessionmaker]
+_default_session_factory_guard = threading.Lock()
+
+
+def default_session_factory() -> sessionmaker:
+    """config.get_sqlite_uri() 的 session factory，第一次使用時才建立 engine"""
+    global _default_session_factory
+    with _default_session_factory_guard:
+        if _default_session_factory is None:
+            _default_session_factory = sessionmaker(bind=create_engine(config.get_sqlite_uri()))
+        return _default_session_factory
+
+
+class SqlAlchemyUnitOfWork(AbstractUnitOfWork):
+    """relational backend (SQLite 或其他 SQLAlchemy 支援的資料庫)，table 需先以 orm.start_mappers 建立"""
+    session = _ThreadLocal()  # type: Session
+    users = _ThreadLocal()  # type: repository.SqlAlchemyRepository
+
+    def __init__(self, session_factory: Optional[sessionmaker] = None):
+        self.session_factory = session_factory if session_factory is not None else default_session_factory()
+        self.engine = self.session_factory.kw.get('bind')
+
+    def __enter__(self):
+        self.session = self.session_factory()  # type: Session
+        self.users = repository.SqlAlchemyRepository(self.session)
+        return super().__enter__()
+
+    def __exit__(self, *args):
+        super().__exit__(*args)
+        self.session.close()
+
+    def _commit(self):
+        self.users.flush()
+        self.session.commit()
+
+    def rollback(self):
+        self.session.rollback()
@@ -1,11 +1,27 @@
-from switchbot.adapters import repository, file_datastore
+import os
+import threading
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from switchbot.adapters import repository, file_datastore, orm
+from switchbot.service_layer import unit_of_work
 from switchbot.domain import model
 
 
-class TestJsonFileDatastore:
-    def test_get_by_dev_id(self):
-        session = file_datastore.FileDatastore(file='.datastore')
-        repo = repository.JsonFileRepository(session=session)
+@pytest.fixture(params=['json', 'sqlite'])
+def repo(request, tmp_path):
+    if request.param == 'sqlite':
+        engine = create_engine(f'sqlite:///{tmp_path / "datastore.sqlite"}')
+        orm.start_mappers(engine=engine)
+        session = sessionmaker(bind=engine)()
+        yield repository.SqlAlchemyRepository(session)
+        session.close()
+        return
+    yield repository.JsonFileRepository(session=file_datastore.FileDatastore(file=str(tmp_path / '.datastore')))
+
+
+class TestRepository:
+    def test_get_by_dev_id(self, repo):
         d = model.SwitchBotDevice(
             device_id='did-1',
             device_name='dev_name',
@@ -38,3 +54,360 @@ class TestJsonFileDatastore:
         assert repo.get_by_dev_id('did-1') == u
         assert u.get_dev_last_change_report(dev_id='did-1') == c
         assert u.get_dev_state(dev_id='did-1') == s
+
+    def test_dev_index_follows_request_sync(self, repo):
+        u = model.SwitchBotUserRepo(
+            uid='uid', secret='secret', token='token',
+            devices=[model.SwitchBotDevice(
+                device_id='did-1', device_name='dev_name', device_type='devType',
+                enable_cloud_service=True, hub_device_id='')],
+            changes=[], states=[], scenes=[], subscribers=set(), webhooks=[]
+        )
+        repo.add(u)
+        assert repo.get_by_dev_id('did-1') == u
+
+        u.request_sync(devices=[model.SwitchBotDevice(
+            device_id='did-2', device_name='dev_name', device_type='devType',
+            enable_cloud_service=True, hub_device_id='')])
+        assert repo.get_by_dev_id('did-1') is None
+        assert repo.get_by_dev_id('did-2') == u
+
+        repo.delete(uid='uid')
+        assert repo.get_by_dev_id('did-2') is None
+        assert repo.get_by_secret('secret') is None
+        assert repo.get_by_uid('uid') is None
+
+
+def _make_user(n: int) -> model.SwitchBotUserRepo:
+    return model.SwitchBotUserRepo(
+        uid=f'uid-{n}', secret=f'secret-{n}', token=f'token-{n}',
+        devices=[model.SwitchBotDevice(
+            device_id=f'did-{n}', device_name='dev_name', device_type='devType',
+            enable_cloud_service=True, hub_device_id='')],
+        changes=[], states=[], scenes=[], subscribers=set(), webhooks=[]
+    )
+
+
+class TestJournalFileDatastore:
+    def test_commit_appends_only_mutated_users(self, tmp_path):
+        file = str(tmp_path / '.datastore')
+        session = file_datastore.session_factory(file, journal=True)
+        for n in range(3):
+            session.add(_make_user(n))
+        session.commit()
+
+        session = file_datastore.session_factory(file, journal=True)
+        session.get_by_uid('uid-0')
+        u = session.get_by_uid('uid-1')
+        u.subscribe('aog')
+        session.commit()
+
+        with open(f'{file}.journal') as fh:
+            lines = fh.readlines()
+        assert len(lines) == 4
+        assert '"uid-1"' in lines[-1]
+
+    def test_recovery_replays_journal(self, tmp_path):
+        file = str(tmp_path / '.datastore')
+        session = file_datastore.session_factory(file, journal=True)
+        for n in range(3):
+            session.add(_make_user(n))
+        session.commit()
+        session.get_by_uid('uid-2').subscribe('aog')
+        session.delete('uid-0')
+        session.commit()
+
+        store = file_datastore.JournalFileDatastore(file=file)
+        assert store.count() == 2
+        assert store.get_by_uid('uid-0') is None
+        assert store.get_by_dev_id('did-2').subscribers == {'aog'}
+
+    def test_compaction_folds_journal_into_snapshot(self, tmp_path):
+        file = str(tmp_path / '.datastore')
+        store = file_datastore.JournalFileDatastore(file=file, compact_threshold=2)
+        store.write(puts=[_make_user(n) for n in range(3)], deletes=[])
+        store.compact()
+
+        assert not os.path.exists(f'{file}.journal')
+        assert not os.path.exists(f'{file}.journal.compacting')
+        store = file_datastore.JournalFileDatastore(file=file)
+        assert store.count() == 3
+
+
+class TestDatastoreSession:
+    def test_resident_datastore_reloads_only_on_external_change(self, tmp_path):
+        file = str(tmp_path / '.datastore')
+        session = file_datastore.session_factory(file)
+        session.add(_make_user(0))
+        session.commit()
+        store = file_datastore.get_datastore(file)
+        assert file_datastore.get_datastore(file) is store
+
+        resident = store.get_by_uid('uid-0')
+        file_datastore.session_factory(file).get_by_uid('uid-0')
+        assert store.get_by_uid('uid-0') is resident
+
+        other = file_datastore.FileDatastore(file)
+        other.add(_make_user(1))
+        other.commit()
+        assert file_datastore.session_factory(file).count() == 2
+
+    def test_rollback_discards_uncommitted_changes(self, tmp_path):
+        file = str(tmp_path / '.datastore')
+        session = file_datastore.session_factory(file)
+        session.add(_make_user(0))
+        session.commit()
+
+        session = file_datastore.session_factory(file)
+        session.get_by_uid('uid-0').subscribe('aog')
+        session.add(_make_user(1))
+        session.rollback()
+
+        session = file_datastore.session_factory(file)
+        assert session.get_by_uid('uid-0').subscribers == set()
+        assert session.count() == 1
+
+    def test_read_only_session_does_not_write(self, tmp_path):
+        file = str(tmp_path / '.datastore')
+        session = file_datastore.session_factory(file)
+        session.add(_make_user(0))
+        session.commit()
+        mtime = os.stat(file).st_mtime_ns
+
+        session = file_datastore.session_factory(file)
+        assert session.get_by_dev_id('did-0').uid == 'uid-0'
+        session.commit()
+        assert os.stat(file).st_mtime_ns == mtime
+
+
+class TestDurableCommit:
+    def test_failed_write_keeps_previous_datastore(self, tmp_path, monkeypatch):
+        file = str(tmp_path / '.datastore')
+        store = file_datastore.FileDatastore(file)
+        store.write(puts=[_make_user(0)], deletes=[])
+
+        def _crash(*args):
+            raise OSError('disk full')
+        monkeypatch.setattr(file_datastore.os, 'replace', _crash)
+        with pytest.raises(OSError):
+            store.write(puts=[_make_user(1)], deletes=['uid-0'])
+        monkeypatch.undo()
+
+        assert os.listdir(tmp_path) == ['.datastore']
+        assert file_datastore.FileDatastore(file).count() == 1
+        assert store.count() == 1
+        assert store.get_by_uid('uid-0') is not None
+        assert store.get_by_dev_id('did-0').uid == 'uid-0'
+        assert store.get_by_uid('uid-1') is None
+        assert store.get_by_dev_id('did-1') is None
+
+    def test_failed_group_commit_reverts_every_writer(self, tmp_path, monkeypatch):
+        file = str(tmp_path / '.datastore')
+        store = file_datastore.FileDatastore(file)
+        store.write(puts=[_make_user(0)], deletes=[])
+        store.group_commit_window = 0.2
+
+        def _crash(*args):
+            raise OSError('disk full')
+        monkeypatch.setattr(file_datastore.os, 'replace', _crash)
+        errors = []
+
+        def _write(**kwargs):
+            try:
+                store.write(**kwargs)
+            except OSError as err:
+                errors.append(err)
+        threads = [threading.Thread(target=_write, kwargs={'puts': [_make_user(1)], 'deletes': []}),
+                   threading.Thread(target=_write, kwargs={'puts': [], 'deletes': ['uid-0']})]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        monkeypatch.undo()
+
+        assert len(errors) == 2
+        assert store.count() == 1
+        assert store.get_by_uid('uid-0') is not None
+        assert store.get_by_uid('uid-1') is None
+
+    def test_failed_uow_commit_does_not_leave_added_user(self, tmp_path, monkeypatch):
+        file = str(tmp_path / '.datastore')
+        uow = unit_of_work.JsonFileUnitOfWork(json_file=file)
+
+        def _crash(*args):
+            raise OSError('disk full')
+        monkeypatch.setattr(file_datastore.os, 'replace', _crash)
+        with pytest.raises(OSError):
+            with uow:
+                uow.users.add(_make_user(0))
+                uow.commit()
+        monkeypatch.undo()
+
+        with uow:
+            assert uow.users.get_by_secret('secret-0') is None
+
+    def test_group_commit_merges_concurrent_writes(self, tmp_path):
+        file = str(tmp_path / '.datastore')
+        store = file_datastore.FileDatastore(file)
+        store.group_commit_window = 0.2
+        persisted = []
+        persist = store._persist
+
+        def _counting_persist(puts, deletes):
+            persisted.append(sorted(u.uid for u in puts))
+            persist(puts=puts, deletes=deletes)
+        store._persist = _counting_persist
+
+        threads = [threading.Thread(target=store.write, kwargs={'puts': [_make_user(n)], 'deletes': []})
+                   for n in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert persisted == [['uid-0', 'uid-1', 'uid-2']]
+        assert file_datastore.FileDatastore(file).count() == 3
+
+    def test_concurrent_sessions_do_not_lose_updates(self, tmp_path):
+        file = str(tmp_path / '.datastore')
+        session = file_datastore.session_factory(file)
+        session.add(_make_user(0))
+        session.commit()
+        session.close()
+
+        def _subscribe(n):
+            # 與 messagebus 相同，version 衝突時重新執行
+            while True:
+                _session = file_datastore.session_factory(file)
+                try:
+                    _session.get_by_uid('uid-0').subscribe(f'sub-{n}')
+                    _session.commit()
+                    return
+                except model.ConcurrentUpdateError:
+                    continue
+                finally:
+                    _session.close()
+
+        threads = [threading.Thread(target=_subscribe, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        u = file_datastore.FileDatastore(file).get_by_uid('uid-0')
+        assert u.subscribers == {f'sub-{n}' for n in range(8)}
+        assert u.version == 9
+
+    def test_reader_does_not_wait_for_writer_lock(self, tmp_path):
+        file = str(tmp_path / '.datastore')
+        session = file_datastore.session_factory(file)
+        session.add(_make_user(0))
+        session.commit()
+        session.close()
+
+        reads = []
+
+        def _read():
+            _session = file_datastore.session_factory(file)
+            reads.append(_session.get_by_dev_id('did-0').uid)
+            _session.close()
+
+        writer = file_datastore.session_factory(file)
+        writer.get_by_uid('uid-0').subscribe('aog')
+        reader = threading.Thread(target=_read)
+        reader.start()
+        reader.join(timeout=1)
+        assert reads == ['uid-0']
+        writer.commit()
+        writer.close()
+
+    def test_write_after_other_commit_raises_conflict(self, tmp_path):
+        file = str(tmp_path / '.datastore')
+        session = file_datastore.session_factory(file)
+        session.add(_make_user(0))
+        session.commit()
+        session.close()
+
+        stale = file_datastore.session_factory(file)
+        u = stale.get_by_uid('uid-0')
+
+        def _subscribe():
+            _session = file_datastore.session_factory(file)
+            _session.get_by_uid('uid-0').subscribe('line')
+            _session.commit()
+            _session.close()
+        t = threading.Thread(target=_subscribe)
+        t.start()
+        t.join()
+
+        with pytest.raises(model.ConcurrentUpdateError):
+            u.subscribe('aog')
+        stale.close()
+        assert file_datastore.FileDatastore(file).get_by_uid('uid-0').subscribers == {'line'}
+
+    def test_other_commit_does_not_persist_uncommitted_changes(self, tmp_path):
+        file = str(tmp_path / '.datastore')
+        session = file_datastore.session_factory(file)
+        session.add(_make_user(0))
+        session.add(_make_user(1))
+        session.commit()
+        session.close()
+
+        pending = file_datastore.session_factory(file)
+        pending.get_by_uid('uid-0').subscribe('LEAKED')
+
+        def _subscribe():
+            _session = file_datastore.session_factory(file)
+            _session.get_by_uid('uid-1').subscribe('line')
+            _session.commit()
+            _session.close()
+        t = threading.Thread(target=_subscribe)
+        t.start()
+        t.join()
+        pending.rollback()
+        pending.close()
+
+        reloaded = file_datastore.FileDatastore(file)
+        assert reloaded.get_by_uid('uid-0').subscribers == set()
+        assert reloaded.get_by_uid('uid-1').subscribers == {'line'}
+
+
+class TestBinarySnapshot:
+    def test_binary_snapshot_round_trip_and_convert(self, tmp_path):
+        file = str(tmp_path / '.datastore')
+        store = file_datastore.FileDatastore(file, snapshot_format=file_datastore.SNAPSHOT_BINARY)
+        users = [_make_user(n) for n in range(3)]
+        users[1].subscribe('aog')
+        store.write(puts=users, deletes=[])
+        with open(file, 'rb') as fh:
+            assert fh.read(4) == b'SBDS'
+
+        store = file_datastore.FileDatastore(file)
+        assert store.count() == 3
+        assert store.get_by_dev_id('did-1').subscribers == {'aog'}
+
+        json_file = str(tmp_path / 'datastore.json')
+        assert file_datastore.convert_snapshot(file, json_file, file_datastore.SNAPSHOT_JSON) == 3
+        assert file_datastore.read_snapshot(json_file) == file_datastore.read_snapshot(file)
+        assert os.path.getsize(file) < os.path.getsize(json_file)
+        assert file_datastore.convert_snapshot(json_file, json_file, file_datastore.SNAPSHOT_BINARY) == 3
+        with open(json_file, 'rb') as fh, open(file, 'rb') as expected:
+            assert fh.read() == expected.read()
+
+    def test_truncated_binary_snapshot_raises(self, tmp_path):
+        file = str(tmp_path / '.datastore')
+        file_datastore.FileDatastore(file, snapshot_format='binary').write(puts=[_make_user(0)], deletes=[])
+        with open(file, 'rb') as fh:
+            raw = fh.read()
+        with pytest.raises(file_datastore.DatastoreSchemaError):
+            file_datastore.decode_snapshot(raw[:-1])
+
+    def test_journal_compaction_keeps_binary_snapshot(self, tmp_path):
+        file = str(tmp_path / '.datastore')
+        store = file_datastore.JournalFileDatastore(file=file, compact_threshold=2, snapshot_format='binary')
+        store.write(puts=[_make_user(n) for n in range(3)], deletes=[])
+        store.compact()
+
+        with open(file, 'rb') as fh:
+            assert fh.read(4) == b'SBDS'
+        assert file_datastore.JournalFileDatastore(file=file).count() == 3
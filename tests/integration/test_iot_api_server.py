@@ -0,0 +1,324 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import requests
+from switchbot.adapters.iot_api_server import FakeApiServer, SwitchBotApiServer, AsyncSwitchBotApiServer, \
+    SwitchBotAPIServerError, SwitchBotAPIQuotaExceeded, SwitchBotAPIUnavailable, SwitchBotAPICircuitOpen, \
+    SwitchBotAPIClientError, SwitchBotAPITimeout, AbstractIotApiServer, AbstractAsyncIotApiServer, get_http_session
+from switchbot.adapters.quota import RequestQuota, Priority
+from switchbot.adapters.resilience import Deadline
+from switchbot.adapters.iot_cache import CachedIotApiServer
+
+
+class _FakeSwitchBotHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    failures = []  # 依序回傳的錯誤 status code
+    delays = []  # 依序延遲回應的秒數
+    bodies = []  # 依序以 200 回傳的 response 內容
+
+    def do_GET(self):
+        if self.delays:
+            time.sleep(self.delays.pop(0))
+        if self.failures:
+            self.send_response(self.failures.pop(0))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.bodies:
+            content = self.bodies.pop(0)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+            return
+        dev_id = self.path.split('/')[3]
+        state = next(s for s in FakeApiServer.jsonStates if s.get('deviceId') == dev_id)
+        content = json.dumps({'statusCode': 100, 'body': state, 'message': 'success'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def fake_switchbot_api():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _FakeSwitchBotHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_api_server_reuses_pooled_connection(fake_switchbot_api):
+    """連續查詢設備狀態共用同一條 keep-alive 連線"""
+    api = SwitchBotApiServer(pool_size=2, timeout=(1, 1), session=requests.Session())
+    api.api_uri = fake_switchbot_api
+    for _ in range(5):
+        for data in FakeApiServer.jsonStates:
+            state = api.get_dev_status(secret='secret', token='token', dev_id=data.get('deviceId'))
+            assert state.device_id == data.get('deviceId')
+
+    assert api.connection_stats() == {'connections': 1, 'requests': 10, 'reused': 9}
+    assert SwitchBotApiServer(pool_size=2).session is SwitchBotApiServer(pool_size=2).session
+
+
+def test_http_session_mounts_adapter_with_pool_size():
+    """get_http_session 依 pool_size 掛載 HTTPAdapter，http 與 https 共用同一個 adapter"""
+    session = get_http_session(3)
+    adapter = session.get_adapter('https://api.switch-bot.com')
+    assert adapter is session.get_adapter('http://127.0.0.1')
+    assert adapter._pool_connections == 3
+    assert adapter._pool_maxsize == 3
+    assert adapter.poolmanager.connection_pool_kw.get('maxsize') == 3
+    assert get_http_session(3) is session
+    assert get_http_session(4) is not session
+
+
+def test_async_api_server_fetches_states_concurrently():
+    """async client 同時查詢多個設備狀態，共用同一個 session，查詢失敗的設備單獨回傳錯誤"""
+    in_flight, max_in_flight = 0, 0
+
+    async def dev_status(request):
+        nonlocal in_flight, max_in_flight
+        assert request.headers['Authorization'] == 'token'
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.05)
+        in_flight -= 1
+        dev_id = request.match_info['dev_id']
+        state = next((s for s in FakeApiServer.jsonStates if s.get('deviceId') == dev_id), None)
+        if state is None:
+            raise web.HTTPInternalServerError()
+        return web.json_response({'statusCode': 100, 'body': state, 'message': 'success'})
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/v1.1/devices/{dev_id}/status', dev_status)
+        async with TestServer(app) as server:
+            async with AsyncSwitchBotApiServer(limit_per_host=5) as api:
+                # coroutine 介面不能當成同步的 AbstractIotApiServer 使用
+                assert isinstance(api, AbstractAsyncIotApiServer) and not isinstance(api, AbstractIotApiServer)
+                api.api_uri = str(server.make_url('')).rstrip('/')
+                dev_ids = [s.get('deviceId') for s in FakeApiServer.jsonStates] + ['not-exist']
+                results = await api.get_dev_all_status(secret='secret', token='token', dev_ids=dev_ids)
+                session = api.client.session
+                assert await api.get_dev_status(secret='secret', token='token', dev_id=dev_ids[0])
+                assert api.client.session is session
+                return results
+
+    results = asyncio.run(run())
+    assert [r.device_id for r in results[:2]] == [s.get('deviceId') for s in FakeApiServer.jsonStates]
+    assert isinstance(results[2], SwitchBotAPIServerError)
+    assert 'not-exist' in str(results[2]) and results[2].__cause__ is not None
+    assert max_in_flight == 3
+
+
+def test_api_server_quota_sheds_low_priority_first(fake_switchbot_api, tmp_path):
+    """每日額度不足時先捨棄設備狀態更新，保留額度給設備控制，用量計數重啟後延續"""
+    quota_file = str(tmp_path / 'quota')
+    quota = RequestQuota(daily_limit=10, rate=100, burst=100, file=quota_file, save_interval=0)
+    api = SwitchBotApiServer(session=requests.Session(), quota=quota)
+    api.api_uri = fake_switchbot_api
+    dev_id = FakeApiServer.jsonStates[0].get('deviceId')
+
+    for _ in range(8):
+        api.get_dev_status(secret='secret', token='token', dev_id=dev_id)
+    assert api.remaining_quota('token') == 2
+    with pytest.raises(SwitchBotAPIQuotaExceeded):
+        api.get_dev_status(secret='secret', token='token', dev_id=dev_id)
+    assert quota.acquire('token', priority=Priority.CRITICAL)
+    assert api.remaining_quota('other-token') == 10
+
+    quota.close()
+    assert RequestQuota(daily_limit=10, file=quota_file).remaining('token') == 1
+    with open(quota_file) as f:
+        assert 'token' not in f.read()
+
+
+def test_quota_file_saved_in_background_and_corrupt_file_ignored(tmp_path):
+    """用量計數延遲合併寫入，計數檔損毀時以空的用量啟動"""
+    quota_file = str(tmp_path / 'quota')
+    quota = RequestQuota(daily_limit=10, rate=100, burst=100, file=quota_file, save_interval=0.1)
+    for _ in range(3):
+        assert quota.acquire('token')
+    assert not os.path.exists(quota_file)
+    time.sleep(0.3)
+    assert RequestQuota(daily_limit=10, file=quota_file).remaining('token') == 7
+
+    assert quota.acquire('token')
+    quota.close()
+    assert RequestQuota(daily_limit=10, file=quota_file).remaining('token') == 6
+
+    with open(quota_file, 'w') as f:
+        f.write('{"day": ')
+    assert RequestQuota(daily_limit=10, file=quota_file).remaining('token') == 10
+
+
+def test_quota_token_bucket_defers_calls_up_to_max_wait():
+    """瞬間流量超過 bucket 時，各 priority 的呼叫都延後等待，等待超過 max_wait 才捨棄"""
+    quota = RequestQuota(daily_limit=100, rate=20, burst=1, max_wait=1)
+    assert quota.acquire('token', priority=Priority.LOW)
+    assert quota.acquire('token', priority=Priority.LOW)
+    assert quota.acquire('token', priority=Priority.CRITICAL)
+    assert quota.remaining('token') == 97
+
+    quota.max_wait = 0.01
+    assert not quota.acquire('token', priority=Priority.LOW)
+    assert quota.remaining('token') == 97
+
+
+def test_api_server_fetches_more_states_than_burst(fake_switchbot_api):
+    """一次更新的設備數超過 bucket 容量時，狀態更新延後等待而不是被捨棄"""
+    quota = RequestQuota(daily_limit=100, rate=50, burst=2, max_wait=1)
+    api = SwitchBotApiServer(session=requests.Session(), quota=quota)
+    api.api_uri = fake_switchbot_api
+    dev_ids = [s.get('deviceId') for s in FakeApiServer.jsonStates] * 3
+    assert len(dev_ids) > quota.burst
+
+    states = [api.get_dev_status(secret='secret', token='token', dev_id=dev_id) for dev_id in dev_ids]
+    assert [s.device_id for s in states] == dev_ids
+    assert quota.remaining('token') == 100 - len(dev_ids)
+
+
+def test_api_server_retries_idempotent_call_and_opens_circuit(fake_switchbot_api):
+    """GET 遇到 5xx 以 backoff 重試，連續失敗後 circuit breaker 開啟直接拒絕呼叫，4xx 不重試"""
+    api = SwitchBotApiServer(session=requests.Session(), retries=2, circuit_failures=3, circuit_reset=0.2)
+    api.api_uri = fake_switchbot_api
+    dev_id = FakeApiServer.jsonStates[0].get('deviceId')
+
+    _FakeSwitchBotHandler.failures = [503, 502]
+    assert api.get_dev_status(secret='secret', token='token', dev_id=dev_id).device_id == dev_id
+
+    _FakeSwitchBotHandler.failures = [404, 503]
+    with pytest.raises(SwitchBotAPIClientError):
+        api.get_dev_status(secret='secret', token='token', dev_id=dev_id)
+
+    _FakeSwitchBotHandler.failures = [503, 503, 503, 503]
+    with pytest.raises(SwitchBotAPIUnavailable):
+        api.get_dev_status(secret='secret', token='token', dev_id=dev_id)
+    assert api.circuit_stats() == {'GET /v1.1/devices/{id}/status': {'state': 'open', 'failures': 3}}
+    with pytest.raises(SwitchBotAPICircuitOpen):
+        api.get_dev_status(secret='secret', token='token', dev_id=dev_id)
+    assert _FakeSwitchBotHandler.failures == [503]
+
+    time.sleep(0.2)
+    with pytest.raises(SwitchBotAPIUnavailable):
+        api.get_dev_status(secret='secret', token='token', dev_id=dev_id)
+    time.sleep(0.2)
+    assert api.get_dev_status(secret='secret', token='token', dev_id=dev_id).device_id == dev_id
+    assert api.circuit_stats()['GET /v1.1/devices/{id}/status']['state'] == 'closed'
+
+
+def test_api_server_only_http_client_errors_reset_circuit(fake_switchbot_api):
+    """HTTP 4xx 代表 endpoint 有回應，重設 circuit 失敗次數；無法解析的 response 不影響 circuit"""
+    api = SwitchBotApiServer(session=requests.Session(), retries=0, circuit_failures=3)
+    api.api_uri = fake_switchbot_api
+    dev_id = FakeApiServer.jsonStates[0].get('deviceId')
+    key = 'GET /v1.1/devices/{id}/status'
+
+    _FakeSwitchBotHandler.failures = [503]
+    with pytest.raises(SwitchBotAPIUnavailable):
+        api.get_dev_status(secret='secret', token='token', dev_id=dev_id)
+    assert api.circuit_stats()[key] == {'state': 'closed', 'failures': 1}
+
+    _FakeSwitchBotHandler.bodies = [b'not json']
+    with pytest.raises(SwitchBotAPIClientError):
+        api.get_dev_status(secret='secret', token='token', dev_id=dev_id)
+    assert api.circuit_stats()[key] == {'state': 'closed', 'failures': 1}
+
+    _FakeSwitchBotHandler.failures = [404]
+    with pytest.raises(SwitchBotAPIClientError):
+        api.get_dev_status(secret='secret', token='token', dev_id=dev_id)
+    assert api.circuit_stats()[key] == {'state': 'closed', 'failures': 0}
+
+
+def test_api_server_calls_bounded_by_deadline(fake_switchbot_api):
+    """deadline 之內的呼叫 timeout 縮短為剩餘時間且不重試，deadline 已過的呼叫不送出"""
+    api = SwitchBotApiServer(session=requests.Session(), timeout=(1, 5), retries=2)
+    api.api_uri = fake_switchbot_api
+    dev_id = FakeApiServer.jsonStates[0].get('deviceId')
+
+    _FakeSwitchBotHandler.delays = [1.0, 1.0]
+    started = time.monotonic()
+    with Deadline(0.3).scope():
+        with pytest.raises(SwitchBotAPITimeout):
+            api.get_dev_status(secret='secret', token='token', dev_id=dev_id)
+    assert time.monotonic() - started < 0.8
+    assert _FakeSwitchBotHandler.delays == [1.0]
+
+    _FakeSwitchBotHandler.delays = []
+    with Deadline(0).scope():
+        with pytest.raises(SwitchBotAPITimeout):
+            api.get_dev_status(secret='secret', token='token', dev_id=dev_id)
+    # timeout 被 deadline 縮短而逾時不算 endpoint 失敗
+    assert api.circuit_stats()['GET /v1.1/devices/{id}/status'] == {'state': 'closed', 'failures': 0}
+    assert api.get_dev_status(secret='secret', token='token', dev_id=dev_id).device_id == dev_id
+
+
+class _SlowFakeApiServer(FakeApiServer):
+    def __init__(self):
+        super().__init__()
+        self.status_calls = 0
+
+    def get_dev_status(self, secret: str, token: str, dev_id: str):
+        self.status_calls += 1
+        time.sleep(0.1)
+        return super().get_dev_status(secret=secret, token=token, dev_id=dev_id)
+
+
+def test_cached_api_server_coalesces_in_flight_status_fetches():
+    """同一設備同時的狀態查詢只送出一次上游呼叫，其他呼叫共用結果"""
+    fake_iot = _SlowFakeApiServer()
+    api = CachedIotApiServer(fake_iot, ttl={}, default_ttl=0)
+    dev_id = FakeApiServer.jsonStates[0].get('deviceId')
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        api.get_dev_status(secret='secret', token='token', dev_id=dev_id))) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert fake_iot.status_calls == 1
+    assert [s.device_id for s in results] == [dev_id] * 5
+    assert len(set(id(s) for s in results)) == 5
+    assert api.stats() == {'hits': 0, 'misses': 5, 'calls': 1, 'coalesced': 4, 'in_flight': 0}
+
+    api.get_dev_status(secret='secret', token='token', dev_id=dev_id)
+    assert fake_iot.status_calls == 2
+
+
+def test_cached_api_server_invalidate_discards_in_flight_fetch():
+    """invalidate 之前送出的查詢結果不寫入快取，之後的查詢不與它合併；等待合併的查詢不超過 deadline"""
+    fake_iot = _SlowFakeApiServer()
+    api = CachedIotApiServer(fake_iot, ttl={}, default_ttl=60)
+    dev_id = FakeApiServer.jsonStates[0].get('deviceId')
+    results = []
+    leader = threading.Thread(target=lambda: results.append(
+        api.get_dev_status(secret='secret', token='token', dev_id=dev_id)))
+    leader.start()
+    time.sleep(0.02)
+    with Deadline(0.01).scope():
+        with pytest.raises(SwitchBotAPITimeout):
+            api.get_dev_status(secret='secret', token='token', dev_id=dev_id)
+    api.invalidate(dev_id)
+    leader.join()
+    assert results[0].device_id == dev_id
+
+    api.get_dev_status(secret='secret', token='token', dev_id=dev_id)
+    assert fake_iot.status_calls == 2
+    api.get_dev_status(secret='secret', token='token', dev_id=dev_id)
+    assert fake_iot.status_calls == 2
+    assert api.stats()['hits'] == 1
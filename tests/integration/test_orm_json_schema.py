@@ -3,6 +3,7 @@ import logging
 # import switchbot.domain.model
 # from switchbot.adapters import file_datastore
 from switchbot.domain import model
+from switchbot.adapters import codec
 
 logger = logging.getLogger(__name__)
 _dev_plug_mini_CFD2 = {
@@ -152,6 +153,59 @@ def test_switchbot_user_repo_schema():
     assert obj.dump() == data
 
 
+def test_switchbot_user_repo_schema_many():
+    data = [{
+        'userId': f'user_id_{n}',
+        'userSecret': f'secret_{n}',
+        'userToken': 'token',
+        'devices': [_dev_plug_mini_CFD2],
+        'states': [_state_plug_mini_CFD2],
+        'changes': [_change_plug_mini_FF22],
+        'scenes': [],
+        'subscribers': ['aog'],
+        'webhooks': []
+    } for n in range(3)]
+    users = model.SwitchBotUserRepo.load_many(data)
+    assert [u.uid for u in users] == ['user_id_0', 'user_id_1', 'user_id_2']
+    assert all(u.subscribers == {'aog'} for u in users)
+    assert model.SwitchBotUserRepo.dump_many(users) == data
+    assert model.SwitchBotUserRepo.dump_many(users) == [u.dump() for u in users]
+
+
+def test_datastore_codec_matches_schema():
+    """datastore codec 與 schema 的 load/dump 結果相同，dump 結果不與用戶物件共用內容"""
+    data = model.SwitchBotUserRepo.load({
+        'userId': 'user_id',
+        'userSecret': 'secret',
+        'userToken': 'token',
+        'devices': [_dev_plug_mini_CFD2, _dev_hub2, dict(_dev_wo_sweeper_mini, curtainDevicesIds=['a', 'b'],
+                                                             keyList={'k': 1})],
+        'states': [_state_plug_mini_CFD2, _state_hub2, _state_wo_sweeper_mini],
+        'changes': [_change_plug_mini_FF22],
+        'scenes': ['scene-1'],
+        'subscribers': ['line', 'aog'],
+        'webhooks': [],
+        'version': 3
+    }).dump()
+    schema_user = model.SwitchBotUserRepo.load(data)
+    codec_user = codec.load_user(data)
+    assert codec_user == schema_user
+    assert codec_user.dump() == schema_user.dump()
+    assert codec_user.subscribers == {'aog', 'line'} and codec_user.version == 3
+    assert data['subscribers'] == ['aog', 'line']
+    assert codec.dump_user(schema_user) == schema_user.dump() == data
+    assert codec.dump_users([codec_user]) == [data]
+
+    minimal = {'userId': 'uid', 'userSecret': 'secret', 'userToken': 'token',
+               'devices': [], 'states': [], 'changes': []}
+    assert codec.dump_user(codec.load_user(minimal)) == model.SwitchBotUserRepo.load(minimal).dump()
+
+    dumped = codec.dump_user(codec_user)
+    dumped['devices'][2]['curtainDevicesIds'].append('c')
+    dumped['changes'][0]['context']['powerState'] = 'OFF'
+    assert codec.dump_user(codec_user) == data
+
+
 def test_switchbot_webhook_report_change():
     data = {
         "eventType": "changeReport",
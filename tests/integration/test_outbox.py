@@ -0,0 +1,111 @@
+import json
+import os
+import pytest
+from switchbot import bootstrap
+from switchbot.adapters import iot_api_server, outbox, file_datastore
+from switchbot.domain import commands, events
+from switchbot.service_layer import unit_of_work
+
+
+@pytest.fixture(autouse=True)
+def fresh_outboxes():
+    """每個 test 都從檔案重新建立 FileOutbox，不共用前一個 test 的 process-lifetime outbox"""
+    outbox._outboxes.clear()
+    yield
+    outbox._outboxes.clear()
+
+
+class _FlakyApiServer(iot_api_server.FakeApiServer):
+    """設備列表查詢前 fail_count 次失敗"""
+    def __init__(self, fail_count: int):
+        super().__init__()
+        self.fail_count = fail_count
+        self.dev_list_calls = 0
+        self.webhook_calls = 0
+
+    def get_dev_list(self, secret: str, token: str):
+        self.dev_list_calls += 1
+        if self.dev_list_calls <= self.fail_count:
+            raise iot_api_server.SwitchBotAPIServerError
+        return super().get_dev_list(secret=secret, token=token)
+
+    def update_webhook_config(self, secret: str, token: str, url: str, enable: bool):
+        self.webhook_calls += 1
+        return super().update_webhook_config(secret=secret, token=token, url=url, enable=enable)
+
+
+def test_outbox_records_committed_events_and_marks_them_done(tmp_path):
+    json_file = str(tmp_path / 'datastore')
+    bus = bootstrap.bootstrap(uow=unit_of_work.JsonFileUnitOfWork(json_file=json_file, outbox=True),
+                              iot=iot_api_server.FakeApiServer())
+    bus.handle(commands.Register(secret='secret1', token='token1'))
+
+    assert bus.uow.outbox.pending() == []
+    with bus.uow:
+        u = bus.uow.users.get_by_secret(secret='secret1')
+        assert len(u.states) == 2
+
+
+def test_outbox_replays_unfinished_events_after_restart(tmp_path):
+    """event handler 失敗時 event 留在 outbox，重新啟動後 replay，已完成的 handler 不重複執行"""
+    json_file = str(tmp_path / 'datastore')
+    iot = _FlakyApiServer(fail_count=1)
+    bus = bootstrap.bootstrap(uow=unit_of_work.JsonFileUnitOfWork(json_file=json_file, outbox=True), iot=iot)
+    bus.handle(commands.Register(secret='secret1', token='token1'))
+
+    pending = bus.uow.outbox.pending()
+    assert [type(e) for _, e in pending] == [events.UserRegistered]
+
+    # 模擬 process 重新啟動，outbox 由檔案重新載入
+    outbox._outboxes.clear()
+    bus = bootstrap.bootstrap(uow=unit_of_work.JsonFileUnitOfWork(json_file=json_file, outbox=True), iot=iot)
+    assert [e.outbox_id for _, e in bus.uow.outbox.pending()] == [e.outbox_id for _, e in pending]
+    assert bus.replay_outbox() == 1
+
+    assert bus.uow.outbox.pending() == []
+    assert iot.dev_list_calls == 2
+    assert iot.webhook_calls == 1
+    with bus.uow:
+        u = bus.uow.users.get_by_secret(secret='secret1')
+        assert len(u.devices) == 2
+        assert len(u.states) == 2
+    assert bus.replay_outbox() == 0
+
+
+def test_outbox_skips_events_of_failed_commit(tmp_path, monkeypatch):
+    """datastore commit 失敗時 event 不寫入 outbox，重新啟動後不會 replay"""
+    json_file = str(tmp_path / 'datastore')
+    bus = bootstrap.bootstrap(uow=unit_of_work.JsonFileUnitOfWork(json_file=json_file, outbox=True),
+                              iot=iot_api_server.FakeApiServer())
+
+    def _crash(*args):
+        raise OSError('disk full')
+    monkeypatch.setattr(file_datastore.os, 'replace', _crash)
+    with pytest.raises(OSError):
+        bus.handle(commands.Register(secret='secret1', token='token1'))
+    monkeypatch.undo()
+
+    assert bus.uow.outbox.pending() == []
+    # outbox 中沒有任何 add 紀錄，寫入 outbox 與撤銷之間中斷也不會留下未 commit 的 event
+    records = []
+    if os.path.exists(f'{json_file}.outbox'):
+        with open(f'{json_file}.outbox', encoding='utf-8') as fh:
+            records = [json.loads(line) for line in fh]
+    assert [r for r in records if r['op'] == 'add'] == []
+
+
+def test_outbox_skips_records_that_cannot_be_loaded(tmp_path):
+    """event 類別或欄位改變後，無法還原的紀錄略過，不影響其他 event 的 replay"""
+    file = str(tmp_path / 'datastore.outbox')
+    records = [
+        {'op': 'add', 'id': 'renamed', 'type': 'NoSuchEvent', 'data': {'uid': 'uid'}},
+        {'op': 'add', 'id': 'changed', 'type': 'UserRegistered', 'data': {'user_id': 'uid'}},
+        {'op': 'ack', 'id': 'changed', 'handler': 'fetch_user_dev_list'},
+        {'op': 'add', 'id': 'valid', 'type': 'UserRegistered', 'data': {'uid': 'uid'}},
+    ]
+    with open(file, 'w', encoding='utf-8') as fh:
+        fh.write(''.join(f'{json.dumps(r)}\n' for r in records))
+
+    pending = outbox.get_outbox(file).pending()
+    assert [(event_id, e) for event_id, e in pending] == [('valid', events.UserRegistered(uid='uid'))]
+    assert pending[0][1].outbox_id == 'valid'
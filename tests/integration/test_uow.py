@@ -1,6 +1,13 @@
+import pytest
 from typing import List, Union
+from sqlalchemy import create_engine
+from sqlalchemy.event import listen
+from sqlalchemy.orm import sessionmaker
+from switchbot import bootstrap
+from switchbot.adapters import orm, iot_api_server
 from switchbot.adapters.iot_api_server import AbstractIotApiServer
-from switchbot.domain import model
+from switchbot.domain import model, commands
+from switchbot.service_layer import unit_of_work
 
 
 class FakeSwitchBotApiServer(AbstractIotApiServer):
@@ -34,3 +41,140 @@ class FakeSwitchBotApiServer(AbstractIotApiServer):
 
     def delete_webhook_config(self, secret: str, token: str, url: str):
         raise NotImplementedError
+
+
+@pytest.fixture
+def sqlite_uow(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "datastore.sqlite"}')
+    orm.start_mappers(engine=engine)
+    return unit_of_work.SqlAlchemyUnitOfWork(session_factory=sessionmaker(bind=engine))
+
+
+@pytest.fixture(params=['json', 'binary', 'sqlite'])
+def uow(request, tmp_path):
+    if request.param == 'sqlite':
+        return request.getfixturevalue('sqlite_uow')
+    return unit_of_work.JsonFileUnitOfWork(json_file=str(tmp_path / '.datastore'), snapshot_format=request.param)
+
+
+def _make_user() -> model.SwitchBotUserRepo:
+    return model.SwitchBotUserRepo(
+        uid='uid', secret='secret', token='token',
+        devices=[model.SwitchBotDevice(
+            device_id='did-1', device_name='dev_name', device_type='devType',
+            enable_cloud_service=True, hub_device_id='', curtain_devices_ids=['did-2'])],
+        changes=[], states=[model.SwitchBotStatus(device_id='did-1', device_type='devType', power='off')],
+        scenes=[], subscribers={'aog'}, webhooks=[]
+    )
+
+
+def test_uow_can_save_and_retrieve_user(uow):
+    with uow:
+        uow.users.add(_make_user())
+        uow.commit()
+
+    with uow:
+        u = uow.users.get_by_dev_id(dev_id='did-1')
+        assert u.uid == 'uid'
+        assert uow.users.get_by_secret(secret='secret') is u
+        assert u.subscribers == {'aog'}
+        assert u.get_dev_by_id('did-1').curtain_devices_ids == ['did-2']
+        assert u.get_dev_state(dev_id='did-1').power == 'off'
+        assert uow.users.count() == 1
+
+
+def test_uow_rolls_back_uncommitted_work(uow):
+    with uow:
+        uow.users.add(_make_user())
+        uow.commit()
+
+    with uow:
+        uow.users.get_by_uid(uid='uid').unsubscribe('aog')
+        uow.users.add(model.SwitchBotUserFactory.create_user(secret='secret2', token='token2'))
+
+    with uow:
+        assert uow.users.get_by_uid(uid='uid').subscribers == {'aog'}
+        assert uow.users.count() == 1
+
+
+def test_uow_deletes_user(uow):
+    with uow:
+        uow.users.add(_make_user())
+        uow.commit()
+
+    with uow:
+        uow.users.delete(uid='uid')
+        uow.commit()
+
+    with uow:
+        assert uow.users.get_by_dev_id(dev_id='did-1') is None
+        assert uow.users.count() == 0
+
+
+def test_sqlite_report_change_inserts_one_row(sqlite_uow):
+    with sqlite_uow:
+        sqlite_uow.users.add(_make_user())
+        sqlite_uow.commit()
+
+    statements = []
+    listen(sqlite_uow.engine, 'before_cursor_execute',
+           lambda conn, cursor, statement, *args: statements.append(statement))
+    with sqlite_uow:
+        u = sqlite_uow.users.get_by_dev_id(dev_id='did-1')
+        statements.clear()
+        u.add_change_report(model.SwitchBotChangeReport(
+            event_type='changeReport', event_version='1',
+            context={"deviceType": "WoPlugUS", "deviceMac": "did-1", "powerState": "ON",
+                     "timeOfSample": 1698720698088}))
+        sqlite_uow.commit()
+
+    writes = [s for s in statements if not s.lstrip().upper().startswith('SELECT')]
+    assert len(writes) == 2
+    assert writes[0].startswith('UPDATE users SET version')
+    assert writes[1].startswith('INSERT INTO change_reports')
+
+
+def test_sqlite_concurrent_commit_raises_conflict(sqlite_uow):
+    with sqlite_uow:
+        sqlite_uow.users.add(_make_user())
+        sqlite_uow.commit()
+
+    other = unit_of_work.SqlAlchemyUnitOfWork(session_factory=sqlite_uow.session_factory)
+    with sqlite_uow:
+        u1 = sqlite_uow.users.get_by_uid('uid')
+        with other:
+            u2 = other.users.get_by_uid('uid')
+            u2.subscribe('line')
+            other.commit()
+        u1.subscribe('alexa')
+        with pytest.raises(model.ConcurrentUpdateError):
+            sqlite_uow.commit()
+
+    with sqlite_uow:
+        u = sqlite_uow.users.get_by_uid('uid')
+        assert u.subscribers == {'aog', 'line'}
+        assert u.version == 2
+
+
+def test_sqlite_uow_defaults_to_configured_database(tmp_path, monkeypatch):
+    uri = f'sqlite:///{tmp_path / "default.sqlite"}'
+    monkeypatch.setenv('SQLITE_URI', uri)
+    monkeypatch.setattr(unit_of_work, '_default_session_factory', None)
+    uow = unit_of_work.SqlAlchemyUnitOfWork()
+    assert uow.session_factory is unit_of_work.default_session_factory()
+    assert str(uow.engine.url) == uri
+
+
+def test_bootstrap_with_orm_handles_register(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "datastore.sqlite"}')
+    bus = bootstrap.bootstrap(
+        uow=unit_of_work.SqlAlchemyUnitOfWork(session_factory=sessionmaker(bind=engine)),
+        start_orm=True,
+        iot=iot_api_server.FakeApiServer()
+    )
+    bus.handle(commands.Register(secret='secret1', token='token1'))
+
+    with bus.uow:
+        u = bus.uow.users.get_by_secret(secret='secret1')
+        assert len(u.devices) == 2
+        assert len(u.states) == 2
@@ -1,11 +1,14 @@
 import os
 import logging
 import time
+import threading
+import pytest
+from typing import Dict
 
 from switchbot import bootstrap
-from switchbot.service_layer import unit_of_work
-from switchbot.adapters import iot_api_server
-from switchbot.domain import commands
+from switchbot.service_layer import unit_of_work, change_batcher, messagebus
+from switchbot.adapters import iot_api_server, iot_cache, resilience
+from switchbot.domain import commands, model
 
 logger = logging.getLogger(__name__)
 
@@ -298,3 +301,327 @@ def test_send_dev_ctrl_cmd():
         )
     )
     assert _test_iot.dev_ctrl_cmd_sent
+
+
+class _SlowPartialFailApiServer(iot_api_server.FakeApiServer):
+    """查詢狀態需要時間，且其中一個設備查詢失敗"""
+    def __init__(self, fail_dev_id: str):
+        super().__init__()
+        self.fail_dev_id = fail_dev_id
+        self.threads = set()
+
+    def get_dev_status(self, secret: str, token: str, dev_id: str):
+        self.threads.add(threading.get_ident())
+        time.sleep(0.05)
+        if dev_id == self.fail_dev_id:
+            raise iot_api_server.SwitchBotAPIServerError
+        return super().get_dev_status(secret=secret, token=token, dev_id=dev_id)
+
+
+def test_fetch_user_dev_all_states_concurrently():
+    """用戶設備狀態同時查詢，單一設備查詢失敗不影響其他設備狀態寫入"""
+    if os.path.exists(JSON_FILE):
+        os.remove(JSON_FILE)
+    iot = _SlowPartialFailApiServer(fail_dev_id='6055F930FF22')
+    bus = bootstrap.bootstrap(uow=unit_of_work.JsonFileUnitOfWork(json_file=JSON_FILE), iot=iot)
+
+    bus.handle(commands.Register(secret='secret1', token='token1'))
+
+    u = bus.uow.users.get_by_secret(secret='secret1')
+    assert len(u.devices) == 2
+    assert [s.device_id for s in u.states] == ['6055F92FCFD2']
+    assert len(iot.threads) == 2
+
+
+class _CountingApiServer(iot_api_server.FakeApiServer):
+    def __init__(self):
+        super().__init__()
+        self.status_calls = 0
+
+    def get_dev_status(self, secret: str, token: str, dev_id: str):
+        self.status_calls += 1
+        return super().get_dev_status(secret=secret, token=token, dev_id=dev_id)
+
+
+def test_report_change_patches_cached_dev_state():
+    """change report 直接修補快取中的設備狀態，快取過期時才向雲端查詢"""
+    if os.path.exists(JSON_FILE):
+        os.remove(JSON_FILE)
+    fake_iot = _CountingApiServer()
+    iot = iot_cache.CachedIotApiServer(fake_iot)
+    bus = bootstrap.bootstrap(uow=unit_of_work.JsonFileUnitOfWork(json_file=JSON_FILE), iot=iot)
+    bus.handle(commands.Register(secret='secret1', token='token1'))
+    assert fake_iot.status_calls == 2
+
+    dev_id = '6055F92FCFD2'
+    for power_state in ['ON', 'OFF', 'ON']:
+        bus.handle(commands.ReportChange(change={
+            "eventType": "changeReport",
+            "eventVersion": "1",
+            "context": {
+                "deviceType": "WoPlugUS",
+                "deviceMac": dev_id,
+                "powerState": power_state,
+                "timeOfSample": int(time.time() * 1000)
+            }
+        }))
+    u = bus.uow.users.get_by_dev_id(dev_id=dev_id)
+    assert u.get_dev_state(dev_id=dev_id).power == 'on'
+    assert fake_iot.status_calls == 2
+
+    # webhook 欄位型別錯誤時不修補快取，改向雲端查詢
+    bus.handle(commands.ReportChange(change={
+        "eventType": "changeReport",
+        "eventVersion": "1",
+        "context": {"deviceType": "WoPlugUS", "deviceMac": dev_id, "powerState": 1,
+                    "timeOfSample": int(time.time() * 1000)}
+    }))
+    assert fake_iot.status_calls == 3
+
+    iot.ttl['Plug Mini (US)'] = 0
+    bus.handle(commands.ReportChange(change={
+        "eventType": "changeReport",
+        "eventVersion": "1",
+        "context": {"deviceType": "WoPlugUS", "deviceMac": dev_id, "powerState": "ON",
+                    "timeOfSample": int(time.time() * 1000)}
+    }))
+    assert fake_iot.status_calls == 4
+    u = bus.uow.users.get_by_dev_id(dev_id=dev_id)
+    assert u.get_dev_state(dev_id=dev_id).power == 'off'
+
+
+def test_change_report_batcher_refreshes_each_device_once():
+    """change report 批次處理，整批只 commit 一次，每個設備只更新一次狀態，找不到的設備略過"""
+    if os.path.exists(JSON_FILE):
+        os.remove(JSON_FILE)
+    fake_iot = _CountingApiServer()
+    bus = bootstrap.bootstrap(uow=unit_of_work.JsonFileUnitOfWork(json_file=JSON_FILE), iot=fake_iot)
+    bus.handle(commands.Register(secret='secret1', token='token1'))
+    assert fake_iot.status_calls == 2
+
+    batcher = change_batcher.ChangeReportBatcher(bus=bus, window=10)
+    now = int(time.time() * 1000)
+    for n, dev_id in enumerate(['6055F92FCFD2', '6055F930FF22', '6055F92FCFD2', 'not-exist', '6055F92FCFD2']):
+        batcher.submit({
+            "eventType": "changeReport",
+            "eventVersion": "1",
+            "context": {"deviceType": "WoPlugUS", "deviceMac": dev_id, "powerState": "ON", "timeOfSample": now + n}
+        })
+    assert batcher.batches == 0
+    batcher.flush()
+
+    assert batcher.batches == 1
+    assert fake_iot.status_calls == 4
+    u = bus.uow.users.get_by_secret(secret='secret1')
+    assert len(u.get_dev_change_reports(dev_id='6055F92FCFD2')) == 3
+    assert u.get_dev_last_change_report(dev_id='6055F92FCFD2').context.get('timeOfSample') == now + 4
+
+
+class _SlowDevListApiServer(iot_api_server.FakeApiServer):
+    def get_dev_list(self, secret: str, token: str):
+        time.sleep(0.2)
+        return super().get_dev_list(secret=secret, token=token)
+
+
+def test_events_dispatched_to_background_workers():
+    """event_workers 大於 0 時 command 處理完就回傳，後續 event 由背景 worker 依序處理"""
+    if os.path.exists(JSON_FILE):
+        os.remove(JSON_FILE)
+    bus = bootstrap.bootstrap(uow=unit_of_work.JsonFileUnitOfWork(json_file=JSON_FILE),
+                              iot=_SlowDevListApiServer(), event_workers=2)
+    try:
+        started = time.monotonic()
+        bus.handle(commands.Register(secret='secret1', token='token1'))
+        bus.handle(commands.Register(secret='secret2', token='token2'))
+        assert time.monotonic() - started < 0.2
+
+        assert bus.join(timeout=5)
+        for secret in ['secret1', 'secret2']:
+            u = bus.uow.users.get_by_secret(secret=secret)
+            assert len(u.devices) == 2
+            assert len(u.states) == 2
+    finally:
+        bus.close()
+
+
+def test_message_bus_traces_each_handler_and_is_thread_safe():
+    """多個 thread 同時 handle，各自的 message queue 不互相覆蓋，tracer 記錄每個 handler 執行結果"""
+    if os.path.exists(JSON_FILE):
+        os.remove(JSON_FILE)
+    traces = []
+    bus = bootstrap.bootstrap(uow=unit_of_work.JsonFileUnitOfWork(json_file=JSON_FILE),
+                              iot=iot_api_server.FakeApiServer(), tracer=traces.append)
+    threads = [threading.Thread(target=bus.handle, args=(commands.Register(secret=f'secret{n}', token='token'),))
+               for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    with bus.uow:
+        assert bus.uow.users.count() == 4
+    register_traces = [t for t in traces if isinstance(t.message, commands.Register)]
+    assert len(register_traces) == 4
+    assert all(t.handler == 'register_user' and t.outcome == 'ok' and t.spawned == 1 for t in register_traces)
+    assert len([t for t in traces if t.handler == 'fetch_user_dev_all_states']) == 4
+
+    with pytest.raises(ValueError):
+        bus.handle(commands.Unregister(uid='not-exist'))
+    assert traces[-1].outcome == 'error' and isinstance(traces[-1].error, ValueError)
+
+
+def test_message_bus_retries_handler_on_concurrent_update():
+    """handler 遇到 ConcurrentUpdateError 時 bus 重新執行 handler"""
+    calls = []
+
+    def _conflict_once(cmd):
+        calls.append(cmd)
+        if len(calls) == 1:
+            raise model.ConcurrentUpdateError('uid-1')
+
+    bus = messagebus.MessageBus(uow=unit_of_work.MemoryUnitOfWork(), event_handlers={},
+                                command_handlers={commands.Unregister: _conflict_once})
+    bus.handle(commands.Unregister(uid='uid-1'))
+    assert len(calls) == 2
+
+
+class _ConflictingApiServer(iot_api_server.FakeApiServer):
+    """送出指令的同時，其他 thread 的 uow 修改了同一個用戶"""
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    def send_dev_ctrl_cmd(self, secret: str, token: str, dev_id: str, cmd_type: str, cmd_value: str, cmd_param):
+        self.sent.append(dev_id)
+
+        def _subscribe():
+            uow = unit_of_work.JsonFileUnitOfWork(json_file=JSON_FILE)
+            with uow:
+                uow.users.get_by_secret(secret=secret).subscribe(f'sub-{len(self.sent)}')
+                uow.commit()
+        t = threading.Thread(target=_subscribe)
+        t.start()
+        t.join()
+
+
+@pytest.mark.parametrize('many', [False, True])
+def test_message_bus_does_not_resend_dev_ctrl_cmd_on_conflict(many):
+    """送出設備控制指令的 handler 遇到 ConcurrentUpdateError 時不重新執行，指令不會重複送出"""
+    if os.path.exists(JSON_FILE):
+        os.remove(JSON_FILE)
+    iot = _ConflictingApiServer()
+    bus = bootstrap.bootstrap(uow=unit_of_work.JsonFileUnitOfWork(json_file=JSON_FILE), iot=iot)
+    bus.handle(commands.Register(secret='secret1', token='token1'))
+    with bus.uow:
+        uid = bus.uow.users.get_by_secret(secret='secret1').uid
+    bus.handle(commands.Subscribe(uid=uid, subscriber_id='aog'))
+
+    dev_cmd = commands.DevCtrlCmd(dev_id='6055F92FCFD2', cmd_type='command', cmd_value='turnOn',
+                                  cmd_param='default')
+    if many:
+        cmd = commands.SendDevCtrlCmds(uid=uid, subscriber_id='aog', cmds=[dev_cmd])
+    else:
+        cmd = commands.SendDevCtrlCmd(uid=uid, subscriber_id='aog', dev_id=dev_cmd.dev_id,
+                                      cmd_type=dev_cmd.cmd_type, cmd_value=dev_cmd.cmd_value,
+                                      cmd_param=dev_cmd.cmd_param)
+    with pytest.raises(model.ConcurrentUpdateError):
+        bus.handle(cmd)
+    assert iot.sent == ['6055F92FCFD2']
+
+
+class _DevCtrlApiServer(iot_api_server.FakeApiServer):
+    """
+    設備控制指令依設備等待 gate 或失敗，有 barrier 時每個指令都要等到其他指令同時送出才完成；
+    記錄每個指令取得的 deadline，查詢設備狀態時設定 status_event
+    """
+    def __init__(self, gates: dict, errors: dict, barrier: threading.Barrier = None):
+        super().__init__()
+        self.gates = gates  # type: Dict[str, threading.Event]
+        self.errors = errors
+        self.barrier = barrier
+        self.sent = []
+        self.status_fetched = []
+        self.status_event = threading.Event()
+        self.deadlines = []
+
+    def send_dev_ctrl_cmd(self, secret: str, token: str, dev_id: str, cmd_type: str, cmd_value: str, cmd_param):
+        self.deadlines.append(resilience.current_deadline())
+        if self.barrier is not None:
+            # 依序送出時等不到其他指令，BrokenBarrierError 使該設備回報 ERROR
+            self.barrier.wait()
+        if dev_id in self.gates:
+            self.gates[dev_id].wait(timeout=5)
+        if dev_id in self.errors:
+            raise self.errors[dev_id]
+        self.sent.append(dev_id)
+
+    def get_dev_status(self, secret: str, token: str, dev_id: str):
+        self.status_fetched.append(dev_id)
+        self.status_event.set()
+        return super().get_dev_status(secret=secret, token=token, dev_id=dev_id)
+
+
+def test_send_dev_ctrl_cmds_sends_commands_in_parallel():
+    """多個設備指令同時送出：每個指令都在 barrier 等待其他指令，依序送出的話 barrier 會逾時而回報 ERROR"""
+    if os.path.exists(JSON_FILE):
+        os.remove(JSON_FILE)
+    dev_ids = ['6055F92FCFD2', '6055F930FF22']
+    iot = _DevCtrlApiServer(gates={}, errors={}, barrier=threading.Barrier(len(dev_ids), timeout=5))
+    bus = bootstrap.bootstrap(uow=unit_of_work.JsonFileUnitOfWork(json_file=JSON_FILE), iot=iot)
+    bus.handle(commands.Register(secret='secret1', token='token1'))
+    with bus.uow:
+        uid = bus.uow.users.get_by_secret(secret='secret1').uid
+    bus.handle(commands.Subscribe(uid=uid, subscriber_id='aog'))
+
+    dev_cmds = [commands.DevCtrlCmd(dev_id=dev_id, cmd_type='command', cmd_value='turnOn', cmd_param='default')
+                for dev_id in dev_ids]
+    results = bus.handle(commands.SendDevCtrlCmds(uid=uid, subscriber_id='aog', cmds=dev_cmds, timeout=10))
+    assert [(r.dev_id, r.status) for r in results] == [(dev_id, 'SUCCESS') for dev_id in dev_ids]
+    assert sorted(iot.sent) == dev_ids
+
+
+def test_send_dev_ctrl_cmds_reports_each_device():
+    """
+    多個設備指令同時送出，deadline 之前未完成的回報 PENDING 並在背景完成後更新設備狀態，
+    失敗與不存在的設備回報 ERROR，目標狀態一次 commit
+    """
+    if os.path.exists(JSON_FILE):
+        os.remove(JSON_FILE)
+    # 6055F930FF22 的指令在 gate 打開之前不會完成，deadline 到期時一定是 PENDING
+    gate = threading.Event()
+    iot = _DevCtrlApiServer(gates={'6055F930FF22': gate}, errors={})
+    bus = bootstrap.bootstrap(uow=unit_of_work.JsonFileUnitOfWork(json_file=JSON_FILE), iot=iot)
+    bus.handle(commands.Register(secret='secret1', token='token1'))
+    with bus.uow:
+        uid = bus.uow.users.get_by_secret(secret='secret1').uid
+    bus.handle(commands.Subscribe(uid=uid, subscriber_id='aog'))
+
+    dev_cmds = [commands.DevCtrlCmd(dev_id=dev_id, cmd_type='command', cmd_value='turnOn', cmd_param='default')
+                for dev_id in ['6055F92FCFD2', '6055F930FF22', 'not-exist']]
+    iot.status_fetched.clear()
+    iot.status_event.clear()
+    deadline = resilience.Deadline(0.1)
+    results = bus.handle(commands.SendDevCtrlCmds(uid=uid, subscriber_id='aog', cmds=dev_cmds), deadline=deadline)
+    # deadline 之內開始的指令取得 handler 的 deadline
+    assert len(iot.deadlines) == 2 and all(d is deadline for d in iot.deadlines)
+    assert [(r.dev_id, r.status, r.error_code) for r in results] == [
+        ('6055F92FCFD2', 'SUCCESS', None),
+        ('6055F930FF22', 'PENDING', None),
+        ('not-exist', 'ERROR', 'deviceNotFound'),
+    ]
+    with bus.uow:
+        u = bus.uow.users.get_by_uid(uid=uid)
+        assert u.get_dev_by_id('6055F92FCFD2').target_state == {'power': 'on'}
+        # PENDING 的指令結果未知，不記錄目標狀態
+        assert u.get_dev_by_id('6055F930FF22').target_state == {}
+    gate.set()
+    assert iot.status_event.wait(timeout=5)
+    assert sorted(iot.sent) == ['6055F92FCFD2', '6055F930FF22']
+    assert iot.status_fetched == ['6055F930FF22']
+
+    iot.errors = {'6055F930FF22': iot_api_server.SwitchBotAPIUnavailable('503')}
+    iot.gates = {}
+    dev_cmds = [commands.DevCtrlCmd(dev_id='6055F930FF22', cmd_type='command', cmd_value='turnOff',
+                                    cmd_param='default')]
+    results = bus.handle(commands.SendDevCtrlCmds(uid=uid, subscriber_id='aog', cmds=dev_cmds))
+    assert [(r.status, r.error_code) for r in results] == [('ERROR', 'transientError')]
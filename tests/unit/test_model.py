@@ -1,6 +1,6 @@
 import logging
 from typing import List
-from switchbot.domain import model
+from switchbot.domain import model, events
 
 logger = logging.getLogger(__name__)
 
@@ -258,3 +258,85 @@ def test_query_devices():
 #
 # def test_device_exec_diff_cmd_on_diff_device():
 #     raise NotImplementedError
+
+
+def test_user_write_hook_called_before_each_change():
+    """用戶資料每次被修改之前觸發 copy-on-write hook，唯讀操作不觸發"""
+    user = _make_initial_user_devices()
+    snapshots = []
+    user.set_write_hook(lambda u: snapshots.append(u.dump()))
+
+    user.query(dev_id_list=['6055F92FCFD2'])
+    assert not user.dirty and snapshots == []
+
+    user.subscribe('aog')
+    user.subscribe('gh')
+    assert user.dirty
+    assert len(snapshots) == 2
+    assert snapshots[0].get('subscribers') == []
+
+    user.mark_clean()
+    user.subscribe('line')
+    assert len(snapshots) == 3
+
+
+def _make_change_report(dev_id: str, time_of_sample: int) -> model.SwitchBotChangeReport:
+    return model.SwitchBotChangeReport(
+        event_type='changeReport',
+        event_version='1',
+        context={
+            "deviceType": "WoPlugUS",
+            "deviceMac": dev_id,
+            "powerState": "ON",
+            "timeOfSample": time_of_sample
+        }
+    )
+
+
+def test_change_history_retention_by_count_and_age():
+    """設備 change report 歷史保留筆數與時間上限"""
+    history = model.SwitchBotChangeHistory(max_count=3, max_age=1000)
+    for t in [100, 300, 200, 400]:
+        history.append(_make_change_report('6055F92FCFD2', t))
+    history.append(_make_change_report('6055F930FF22', 100))
+
+    assert [c.context.get('timeOfSample') for c in history.range('6055F92FCFD2')] == [200, 300, 400]
+    assert len(history) == 4
+
+    history.append(_make_change_report('6055F92FCFD2', 1250))
+    assert [c.context.get('timeOfSample') for c in history.range('6055F92FCFD2')] == [300, 400, 1250]
+    history.append(_make_change_report('6055F92FCFD2', 1350))
+    assert [c.context.get('timeOfSample') for c in history.range('6055F92FCFD2')] == [400, 1250, 1350]
+
+
+def test_user_dev_change_report_history():
+    """查詢用戶設備最近一筆與時間區間內的 change report"""
+    user = _make_initial_user_devices()
+    for t in [300, 100, 200]:
+        user.add_change_report(_make_change_report('6055F92FCFD2', t))
+
+    assert user.get_dev_last_change_report(dev_id='6055F92FCFD2').context.get('timeOfSample') == 300
+    assert user.get_dev_last_change_report(dev_id='6055F930FF22') is None
+    assert len(user.get_dev_change_reports(dev_id='6055F92FCFD2', since=150, until=300)) == 2
+    assert len(model.SwitchBotUserRepo.load(user.dump()).changes) == 3
+    assert {(e.uid, e.dev_id) for e in user.events if isinstance(e, events.UserDevReportChanged)} == \
+        {(user.uid, '6055F92FCFD2')}
+
+
+def test_user_devices_and_states_keyed_by_dev_id():
+    """設備與狀態以 device_id 查詢，序列化仍維持 list 與原本順序"""
+    user = _make_initial_user_devices()
+    dev_ids = [d.device_id for d in user.devices]
+    for state in _make_fake_dev_states():
+        user.update_dev_state(state)
+
+    assert user.get_dev_by_id(dev_ids[0]) is user.devices[0]
+    assert user.get_dev_state(dev_ids[-1]).device_id == dev_ids[-1]
+    assert user.get_dev_by_id('not-exist') is None
+
+    loaded = model.SwitchBotUserRepo.load(user.dump())
+    assert [d.device_id for d in loaded.devices] == dev_ids
+    assert [s.device_id for s in loaded.states] == [s.device_id for s in user.states]
+
+    user.request_sync(user.devices[1:])
+    assert [d.device_id for d in user.devices] == dev_ids[1:]